@@ -0,0 +1,116 @@
+import asyncio, threading
+from sam_sp.samclient import SAMClient
+from sam_sp.peopleclient import PeopleClient
+
+#
+# The async clients run the blocking requests of a SAMClient or PeopleClient in
+# worker threads (asyncio.to_thread()), so independent calls can be awaited
+# concurrently with asyncio.gather(). The wrapped client's Transport pools
+# connections and is safe to share between threads.
+#
+
+class AsyncSAMClient(object):
+
+    def __init__(self, *args, client=None, **kwargs):
+        """Asyncio counterpart of SAMClient
+
+        Either wraps an existing SAMClient (client=...) or creates one from
+        the SAMClient constructor arguments. get(), put() and post() are
+        coroutines; call() runs any other SAMClient method in a worker thread.
+        """
+        self.client = client if client is not None else \
+            SAMClient(*args, **kwargs)
+
+    async def get(self, path):
+        return await asyncio.to_thread(self.client.get, path)
+
+    async def put(self, path, data):
+        return await asyncio.to_thread(self.client.put, path, data)
+
+    async def post(self, path, data):
+        return await asyncio.to_thread(self.client.post, path, data)
+
+    async def call(self, method_name, *args, **kwargs):
+        method = getattr(self.client, method_name)
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+
+class AsyncPeopleClient(object):
+
+    def __init__(self, *args, client=None, **kwargs):
+        """Asyncio counterpart of PeopleClient
+
+        Either wraps an existing PeopleClient (client=...) or creates one from
+        the PeopleClient constructor arguments. _get() and _put() are
+        coroutines; call() runs any other PeopleClient method in a worker
+        thread.
+        """
+        self.client = client if client is not None else \
+            PeopleClient(*args, **kwargs)
+
+    async def _get(self, path):
+        return await asyncio.to_thread(self.client._get, path)
+
+    async def _put(self, path, data):
+        return await asyncio.to_thread(self.client._put, path, data)
+
+    async def call(self, method_name, *args, **kwargs):
+        method = getattr(self.client, method_name)
+        return await asyncio.to_thread(method, *args, **kwargs)
+
+
+class SyncAdapter(object):
+
+    def __init__(self, async_client):
+        """Synchronous interface to an async client
+
+        Calling a coroutine method of the adapter (e.g. adapter.get(path))
+        runs it to completion on an event loop owned by the adapter and
+        returns its result, so an async client can be used where a SAMClient
+        or PeopleClient is expected. Other attributes are those of the wrapped
+        synchronous client.
+        """
+        self.async_client = async_client
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def run(self, coro):
+        """Run a coroutine on the adapter's event loop and return its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro,
+                                                self._get_loop()).result()
+
+    def gather(self, *coros):
+        """Run coroutines concurrently and return a list of their results"""
+        async def _gather():
+            return await asyncio.gather(*coros)
+        return self.run(_gather())
+
+    def close(self):
+        with self.lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+                self.loop = None
+                self.thread = None
+
+    def __getattr__(self, name):
+        attr = getattr(self.async_client, name, None)
+        if attr is not None and asyncio.iscoroutinefunction(attr):
+            def run_method(*args, **kwargs):
+                return self.run(attr(*args, **kwargs))
+            return run_method
+        return getattr(self.async_client.client, name)
+
+    def _get_loop(self):
+        # The loop runs in its own thread, so the adapter can also be used
+        # from code that is itself running in an event loop
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever,
+                                               daemon=True)
+                self.thread.start()
+            return self.loop
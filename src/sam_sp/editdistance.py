@@ -0,0 +1,111 @@
+def levenshtein(a, b):
+    """Return the Levenshtein (insert/delete/substitute) distance of a and b
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return len(a)
+    prev = list(range(0,len(b)+1))
+    for i, ca in enumerate(a, 1):
+        curr = [i]
+        for j, cb in enumerate(b, 1):
+            cost = 0 if ca == cb else 1
+            curr.append(min(prev[j] + 1, curr[j-1] + 1, prev[j-1] + cost))
+        prev = curr
+    return prev[-1]
+
+def bounded_levenshtein(a, b, maxdist):
+    """Return the Levenshtein distance of a and b, or None if it exceeds maxdist
+    """
+    if abs(len(a) - len(b)) > maxdist:
+        return None
+    if len(a) < len(b):
+        a, b = b, a
+    if not b:
+        return len(a)
+    prev = list(range(0,len(b)+1))
+    for i, ca in enumerate(a, 1):
+        curr = [i]
+        for j, cb in enumerate(b, 1):
+            cost = 0 if ca == cb else 1
+            curr.append(min(prev[j] + 1, curr[j-1] + 1, prev[j-1] + cost))
+        if min(curr) > maxdist:
+            return None
+        prev = curr
+    return prev[-1] if prev[-1] <= maxdist else None
+
+
+class EditDistanceIndex(object):
+
+    def __init__(self, field=0):
+        """BK-tree of the distinct values of one field of Fuzzy strings
+
+        Has the same add()/remove() interface as fuzzyindex.FuzzyIndex, but
+        search() finds field values within a true Levenshtein distance of the
+        query instead of returning candidates for a make_regex() pattern.
+
+        :param field: index of the ':'-separated field of Fuzzy['instr'] to
+            index
+        :type field: int
+        """
+        self.field = field
+        self.terms = dict()
+        self.term_keys = []
+        # Each node is [term, tid, {distance: child_node}]
+        self.root = None
+
+    def add(self, key, instr):
+        term = self._get_field(instr)
+        tid = self.terms.get(term,None)
+        if tid is None:
+            tid = len(self.term_keys)
+            self.terms[term] = tid
+            self.term_keys.append(set())
+            self._insert([term, tid, dict()])
+        self.term_keys[tid].add(key)
+
+    def remove(self, key, instr):
+        tid = self.terms.get(self._get_field(instr),None)
+        if tid is not None:
+            self.term_keys[tid].discard(key)
+
+    def search(self, term, maxdist):
+        """Return a dict mapping keys to the distance of their field value
+
+        Only keys with a field value within maxdist of term are returned.
+        """
+        matches = dict()
+        if self.root is None:
+            return matches
+        nodes = [self.root]
+        while nodes:
+            node_term, tid, children = nodes.pop()
+            d = levenshtein(term, node_term)
+            if d <= maxdist:
+                for key in self.term_keys[tid]:
+                    if d < matches.get(key,maxdist+1):
+                        matches[key] = d
+            for child_d in range(max(0,d-maxdist),d+maxdist+1):
+                child = children.get(child_d,None)
+                if child is not None:
+                    nodes.append(child)
+        return matches
+
+    def _insert(self, new_node):
+        if self.root is None:
+            self.root = new_node
+            return
+        node = self.root
+        while True:
+            d = levenshtein(new_node[0], node[0])
+            child = node[2].get(d,None)
+            if child is None:
+                node[2][d] = new_node
+                return
+            node = child
+
+    def _get_field(self, instr):
+        fields = instr.split(':')
+        if self.field < len(fields):
+            return fields[self.field]
+        return ''
@@ -0,0 +1,106 @@
+from itertools import product
+from sam_sp.peopledata import make_charclasses
+
+#
+# A regex built by make_regex() requires each of its character classes to
+# match one character, and allows at most one arbitrary character between
+# consecutive classes. Any three consecutive classes therefore match three
+# characters of the target field that are separated by gaps of 1 or 2
+# positions. Indexing every such "gapped trigram" of each indexed field gives a
+# candidate filter that never rejects a string the regex would accept, so
+# confirming the candidates with the regex yields exactly the same matches as a
+# full scan.
+#
+GAPS = ((1,1),(1,2),(2,1),(2,2))
+
+class FuzzyIndex(object):
+
+    def __init__(self, field=0):
+        """Inverted index of gapped trigrams over one field of Fuzzy strings
+
+        Distinct field values ("terms") are indexed once; each term maps to
+        the set of caller-supplied keys (e.g. list positions or ids) whose
+        Fuzzy strings contain it.
+
+        :param field: index of the ':'-separated field of Fuzzy['instr'] to
+            index
+        :type field: int
+        """
+        self.field = field
+        self.terms = dict()
+        self.term_keys = []
+        self.grams = dict()
+
+    def add(self, key, instr):
+        term = self._get_field(instr)
+        tid = self.terms.get(term,None)
+        if tid is None:
+            tid = len(self.term_keys)
+            self.terms[term] = tid
+            self.term_keys.append(set())
+            for gram in self._make_grams(term):
+                tids = self.grams.get(gram,None)
+                if tids is None:
+                    tids = set()
+                    self.grams[gram] = tids
+                tids.add(tid)
+        self.term_keys[tid].add(key)
+
+    def remove(self, key, instr):
+        tid = self.terms.get(self._get_field(instr),None)
+        if tid is not None:
+            self.term_keys[tid].discard(key)
+
+    def candidates(self, instr, fuzziness):
+        """Return keys that might match make_regex(instr,fuzziness)
+
+        Returns None if instr is too short to narrow the search, in which case
+        all entries must be checked.
+        """
+        classes = make_charclasses(instr, fuzziness)
+        best_grams = None
+        best_size = None
+        for k in range(0,len(classes)-2):
+            grams = [''.join(chars) for chars in \
+                     product(classes[k],classes[k+1],classes[k+2])]
+            size = 0
+            for gram in grams:
+                size += self._count_terms(gram)
+            if best_size is None or size < best_size:
+                best_grams = grams
+                best_size = size
+                if size == 0:
+                    break
+        if best_grams is None:
+            return None
+
+        keys = set()
+        for gram in best_grams:
+            self._update_keys(keys, gram)
+        return keys
+
+    def _count_terms(self, gram):
+        # Number of terms containing gram
+        return len(self.grams.get(gram,()))
+
+    def _update_keys(self, keys, gram):
+        # Add the keys of all terms containing gram to keys
+        for tid in self.grams.get(gram,()):
+            keys.update(self.term_keys[tid])
+
+    def _get_field(self, instr):
+        fields = instr.split(':')
+        if self.field < len(fields):
+            return fields[self.field]
+        return ''
+
+    def _make_grams(self, term):
+        grams = set()
+        nchars = len(term)
+        for i in range(0,nchars):
+            for g1, g2 in GAPS:
+                j = i + g1
+                k = j + g2
+                if k < nchars:
+                    grams.add(term[i] + term[j] + term[k])
+        return grams
@@ -0,0 +1,395 @@
+import os, re, sys, mmap, struct
+from array import array
+from sam_sp.peopledata import Fuzzy
+from sam_sp.fuzzyindex import FuzzyIndex
+
+#
+# Text match files contain one Fuzzy per line, formatted by Fuzzy.__str__():
+#
+#   <instr>:<idval>:<weight>
+#
+# Binary match files hold the same data in a form that can be memory-mapped
+# and searched without creating a Python object per entry, together with a
+# FuzzyIndex of one field of the entries:
+#
+#   header         : magic, format version, byte order, indexed field, entry
+#                    count, blob length, term count, gram count, gram term
+#                    count, gram blob length
+#   ids            : int32[count]      Fuzzy idval
+#   weights        : uint16[count]     Fuzzy weight (padded to 4 bytes)
+#   offsets        : uint32[count+1]   character offsets of each instr in the
+#                                      blob
+#   blob           : UTF-8 encoded concatenation of all instr strings (padded
+#                    to 4 bytes)
+#   term_offsets   : uint32[nterms+1]  offsets of each term's entries in
+#                                      term_positions
+#   term_positions : uint32[count]     entry positions, grouped by term
+#   gram_offsets   : uint32[ngrams+1]  offsets of each gram's terms in
+#                                      gram_terms
+#   gram_terms     : uint32[ngramterms] term ids, grouped by gram
+#   gram_blob      : UTF-8 encoded concatenation of the sorted 3-character
+#                    grams
+#
+# Arrays are written in native byte order; the file is a local cache, and a
+# file written on a host with a different byte order is rejected.
+#
+RE_FUZZY_SPLIT = re.compile('^(.*):([0-9][0-9]*):([0-9][0-9]*)\s$')
+MAGIC = b'SAMFUZZ\0'
+VERSION = 2
+HEADER = struct.Struct('<8sIBBxxIIIIII')
+BYTE_ORDERS = { 'little': 1, 'big': 2 }
+
+def read_text_matchfile(filename):
+    """Generate (instr, idval, weight) tuples from a text match file"""
+    with open(filename, "r") as file:
+        while line := file.readline():
+            m = RE_FUZZY_SPLIT.match(line)
+            yield (m.group(1), int(m.group(2)), int(m.group(3)))
+
+def write_matchfile(filename, entries, field=0):
+    """Write a binary match file
+
+    :param filename: Name of the file to write
+    :type filename: str
+    :param entries: (instr, idval, weight) tuples
+    :type entries: iterable
+    :param field: The field of the entries to index
+    :type field: int
+    """
+    ids = array('i')
+    weights = array('H')
+    offsets = array('I', [0])
+    instrs = []
+    nchars = 0
+    index = FuzzyIndex(field)
+    for instr, idval, weight in entries:
+        index.add(len(ids), instr)
+        ids.append(idval)
+        weights.append(weight)
+        nchars += len(instr)
+        offsets.append(nchars)
+        instrs.append(instr)
+    if len(weights) % 2:
+        weights.append(0)
+    blob = ''.join(instrs).encode('utf-8')
+
+    term_offsets = array('I', [0])
+    term_positions = array('I')
+    for keys in index.term_keys:
+        term_positions.extend(sorted(keys))
+        term_offsets.append(len(term_positions))
+    grams = sorted(index.grams)
+    gram_offsets = array('I', [0])
+    gram_terms = array('I')
+    for gram in grams:
+        gram_terms.extend(sorted(index.grams[gram]))
+        gram_offsets.append(len(gram_terms))
+    gram_blob = ''.join(grams).encode('utf-8')
+
+    tmpname = filename + ".t"
+    with open(tmpname, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDERS[sys.byteorder],
+                               field, len(ids), len(blob),
+                               len(index.term_keys), len(grams),
+                               len(gram_terms), len(gram_blob)))
+        ids.tofile(file)
+        weights.tofile(file)
+        offsets.tofile(file)
+        file.write(blob)
+        file.write(bytes(-len(blob) % 4))
+        term_offsets.tofile(file)
+        term_positions.tofile(file)
+        gram_offsets.tofile(file)
+        gram_terms.tofile(file)
+        file.write(gram_blob)
+    os.rename(tmpname,filename)
+
+def convert_matchfile(textfile, binfile):
+    """Convert a text match file to a binary match file"""
+    write_matchfile(binfile, read_text_matchfile(textfile))
+
+def fuzzy_entries(fuzzies):
+    """Generate (instr, idval, weight) tuples from Fuzzy objects"""
+    for fuzzy in fuzzies:
+        yield (fuzzy['instr'], fuzzy['idval'], fuzzy['weight'])
+
+class MatchFile(object):
+
+    def __init__(self, filename):
+        """Read-only, memory-mapped view of a binary match file
+
+        Entries are accessed by position. Indexing returns a Fuzzy for
+        compatibility, but the instr(), idval(), weight() and match() methods
+        read the mapped arrays directly. The file's FuzzyIndex is read by
+        MatchIndex.
+        """
+        self.filename = filename
+        with open(filename, "rb") as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        mv = memoryview(self.mm)
+        if len(mv) < HEADER.size:
+            raise RuntimeError(filename + ": not a binary match file")
+        (magic, version, byte_order, field, count, bloblen, nterms, ngrams,
+         ngramterms, gramlen) = HEADER.unpack_from(mv, 0)
+        if magic != MAGIC:
+            raise RuntimeError(filename + ": not a binary match file")
+        if version != VERSION:
+            raise RuntimeError(filename + ": unsupported match file version " +\
+                               str(version))
+        if byte_order != BYTE_ORDERS[sys.byteorder]:
+            raise RuntimeError(filename + ": match file byte order mismatch")
+        self.count = count
+        pos = HEADER.size
+        self.ids = mv[pos:pos+4*count].cast('i')
+        pos += 4*count
+        self.weights = mv[pos:pos+2*count].cast('H')
+        pos += 2*(count + count%2)
+        self.offsets = mv[pos:pos+4*(count+1)].cast('I')
+        pos += 4*(count+1)
+        self.blobpos = pos
+        self.bloblen = bloblen
+        self._blob = None
+        pos += bloblen + (-bloblen % 4)
+        self.field = field
+        self.nterms = nterms
+        self.term_offsets = mv[pos:pos+4*(nterms+1)].cast('I')
+        pos += 4*(nterms+1)
+        self.term_positions = mv[pos:pos+4*count].cast('I')
+        pos += 4*count
+        self.ngrams = ngrams
+        self.gram_offsets = mv[pos:pos+4*(ngrams+1)].cast('I')
+        pos += 4*(ngrams+1)
+        self.gram_terms = mv[pos:pos+4*ngramterms].cast('I')
+        pos += 4*ngramterms
+        self.grampos = pos
+        self.gramlen = gramlen
+        self._grams = None
+
+    @property
+    def blob(self):
+        # Decode the string blob once, as a single str; positions in offsets
+        # are character positions in this str
+        if self._blob is None:
+            self._blob = str(self.mm[self.blobpos:self.blobpos+self.bloblen],
+                             'utf-8')
+        return self._blob
+
+    @property
+    def grams(self):
+        # The sorted grams, decoded once as a single str of 3-character grams
+        if self._grams is None:
+            self._grams = str(self.mm[self.grampos:self.grampos+self.gramlen],
+                              'utf-8')
+        return self._grams
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return Fuzzy(self.ids[i],self.weights[i],self.instr(i))
+
+    def __iter__(self):
+        for i in range(0,self.count):
+            yield self[i]
+
+    def instr(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i+1]]
+
+    def idval(self, i):
+        return self.ids[i]
+
+    def weight(self, i):
+        return self.weights[i]
+
+    def match(self, pattern, i):
+        """Match a compiled pattern against the instr of entry i
+
+        The pattern must not start with '^'; re.match() is anchored at the
+        start of the entry anyway, and '^' would only match at the start of
+        the blob.
+        """
+        return pattern.match(self.blob, self.offsets[i], self.offsets[i+1])
+
+    def find_gram(self, gram):
+        """Return the number of an indexed gram, or None"""
+        grams = self.grams
+        lo = 0
+        hi = self.ngrams
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if grams[3*mid:3*mid+3] < gram:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.ngrams and grams[3*lo:3*lo+3] == gram:
+            return lo
+        return None
+
+    def gram_term_ids(self, g):
+        return self.gram_terms[self.gram_offsets[g]:self.gram_offsets[g+1]]
+
+    def term_entries(self, tid):
+        return self.term_positions[self.term_offsets[tid]:
+                                   self.term_offsets[tid+1]]
+
+
+#
+# Changes to individual orgs are appended to a journal file next to the match
+# files rather than rewriting them. Each line either removes all entries for an
+# id or adds an entry:
+#
+#   -<idval>
+#   +<instr>:<idval>:<weight>
+#
+def append_journal(filename, removed_ids, entries):
+    """Append removals of ids, then (instr, idval, weight) entries, to a journal
+    """
+    with open(filename, "a") as file:
+        for idval in removed_ids:
+            file.write('-' + str(idval) + "\n")
+        for instr, idval, weight in entries:
+            file.write('+' + str(Fuzzy(idval,weight,instr)) + "\n")
+
+def apply_journal(filename, table):
+    """Apply the changes in a journal file to a MatchTable
+
+    Returns the number of changes applied.
+    """
+    nchanges = 0
+    with open(filename, "r") as file:
+        while line := file.readline():
+            if line.startswith('-'):
+                table.remove(int(line[1:]))
+            else:
+                m = RE_FUZZY_SPLIT.match(line[1:])
+                table.add([(m.group(1), int(m.group(2)), int(m.group(3)))])
+            nchanges += 1
+    return nchanges
+
+class MatchTable(object):
+
+    def __init__(self, matchfile):
+        """A MatchFile plus in-memory changes
+
+        Entries added after the MatchFile was opened are appended at positions
+        after those of the MatchFile; removed entries keep their positions but
+        are no longer matched. Positions are therefore stable, and can be used
+        as index keys.
+        """
+        self.base = matchfile
+        self.nbase = len(matchfile)
+        self.instrs = []
+        self.ids = []
+        self.weights = []
+        self.dead = set()
+        # idval -> positions; built when first needed
+        self.positions = None
+
+    def __len__(self):
+        return self.nbase + len(self.ids)
+
+    def __getitem__(self, i):
+        return Fuzzy(self.idval(i),self.weight(i),self.instr(i))
+
+    def __iter__(self):
+        for i in self.live_positions():
+            yield self[i]
+
+    def instr(self, i):
+        if i < self.nbase:
+            return self.base.instr(i)
+        return self.instrs[i-self.nbase]
+
+    def idval(self, i):
+        if i < self.nbase:
+            return self.base.idval(i)
+        return self.ids[i-self.nbase]
+
+    def weight(self, i):
+        if i < self.nbase:
+            return self.base.weight(i)
+        return self.weights[i-self.nbase]
+
+    def match(self, pattern, i):
+        if i in self.dead:
+            return None
+        if i < self.nbase:
+            return self.base.match(pattern, i)
+        return pattern.match(self.instrs[i-self.nbase])
+
+    def live_positions(self):
+        if not self.dead:
+            return range(0,len(self))
+        return [i for i in range(0,len(self)) if i not in self.dead]
+
+    def get_entries(self, idval):
+        """Return the live (instr, idval, weight) entries for an id"""
+        return [(self.instr(i),idval,self.weight(i)) \
+                for i in self._get_positions().get(idval,[])]
+
+    def entries(self):
+        for i in self.live_positions():
+            yield (self.instr(i),self.idval(i),self.weight(i))
+
+    def add(self, entries):
+        """Append (instr, idval, weight) entries and return their positions"""
+        positions = self._get_positions()
+        added = []
+        for instr, idval, weight in entries:
+            i = len(self)
+            self.instrs.append(instr)
+            self.ids.append(idval)
+            self.weights.append(weight)
+            positions.setdefault(idval,[]).append(i)
+            added.append(i)
+        return added
+
+    def remove(self, idval):
+        """Remove all entries for an id and return their positions"""
+        removed = self._get_positions().pop(idval,[])
+        self.dead.update(removed)
+        return removed
+
+    def _get_positions(self):
+        if self.positions is None:
+            positions = dict()
+            for i in range(0,len(self)):
+                if i not in self.dead:
+                    positions.setdefault(self.idval(i),[]).append(i)
+            self.positions = positions
+        return self.positions
+
+class MatchIndex(FuzzyIndex):
+
+    def __init__(self, table):
+        """FuzzyIndex of a MatchTable
+
+        Entries of the table's MatchFile are found with the index stored in
+        the file, so no per-entry work is done here; entries added to the
+        table are indexed in memory. Entries removed from the table may still
+        be returned as candidates, but MatchTable.match() does not match them.
+        """
+        base = table.base
+        FuzzyIndex.__init__(self, base.field)
+        self.base = base
+        for i in range(table.nbase,len(table)):
+            if i not in table.dead:
+                FuzzyIndex.add(self, i, table.instr(i))
+
+    def remove(self, key, instr):
+        if key >= self.base.count:
+            FuzzyIndex.remove(self, key, instr)
+
+    def _count_terms(self, gram):
+        n = FuzzyIndex._count_terms(self, gram)
+        g = self.base.find_gram(gram)
+        if g is not None:
+            n += self.base.gram_offsets[g+1] - self.base.gram_offsets[g]
+        return n
+
+    def _update_keys(self, keys, gram):
+        FuzzyIndex._update_keys(self, keys, gram)
+        g = self.base.find_gram(gram)
+        if g is not None:
+            for tid in self.base.gram_term_ids(g):
+                keys.update(self.base.term_entries(tid))
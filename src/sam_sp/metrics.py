@@ -0,0 +1,236 @@
+import os, json, time, threading
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0)
+
+# Path segments that are kept in URL templates; all segments after the first
+# other than these are ids, names, etc., and are replaced by '*'
+LITERAL_SEGMENTS = ('AMIE', 'state', 'cleared', 'create_project', 'admin',
+                    'externalOrgs')
+
+METRICS_FILE = 'sam-sp-http-metrics'
+
+def url_template(path):
+    """Return the template of a SAM or PeopleDB API path
+
+    Variable path segments are replaced by '*', and query parameters are
+    reduced to their sorted names, e.g. "person/jdoe?idtype=accessglobalid"
+    becomes "person/*?idtype". This keeps the number of templates small.
+    """
+    path, sep, query = path.partition('?')
+    segments = path.strip('/').split('/')
+    template = '/'.join([segments[0]] + \
+                        [s if s in LITERAL_SEGMENTS else '*' \
+                         for s in segments[1:]])
+    if query:
+        names = sorted(set(p.partition('=')[0] for p in query.split('&') if p))
+        template += '?' + '&'.join(names)
+    return template
+
+class EndpointMetrics(object):
+
+    def __init__(self):
+        """Request counts, latencies and sizes for one URL template"""
+        self.count = 0
+        self.total_secs = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.statuses = dict()
+        self.retries = 0
+
+    def record(self, secs, status, bytes_out, bytes_in):
+        self.count += 1
+        self.total_secs += secs
+        self.buckets[bisect_left(LATENCY_BUCKETS, secs)] += 1
+        self.bytes_out += bytes_out
+        self.bytes_in += bytes_in
+        # Keyed by str, as status may be an int or 'error'
+        status = str(status)
+        self.statuses[status] = self.statuses.get(status,0) + 1
+
+    def to_dict(self):
+        cumulative = []
+        n = 0
+        for le, count in zip(LATENCY_BUCKETS + ('+Inf',), self.buckets):
+            n += count
+            cumulative.append([le, n])
+        return {
+            'count': self.count,
+            'total_secs': self.total_secs,
+            'buckets': cumulative,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'statuses': dict(sorted(self.statuses.items())),
+            'retries': self.retries,
+        }
+
+class RequestMetrics(object):
+
+    def __init__(self):
+        """Per-endpoint HTTP request metrics
+
+        Metrics are kept per (host, method, URL template); see url_template().
+        Recording a request only updates a few counters, so metrics can be
+        left on in production. write() saves them in Prometheus text format
+        or as JSON, and start_export() does so periodically. Other counters
+        (e.g. response cache hits) can be added to the output with
+        add_stats().
+        """
+        self.lock = threading.Lock()
+        self.endpoints = dict()
+        # name -> function returning a dict of numbers, or None
+        self.stats_sources = dict()
+        self.started = time.time()
+        self.export_thread = None
+        self.export_stop = threading.Event()
+
+    def record(self, host, method, template, secs, status, bytes_out=0,
+               bytes_in=0):
+        """Record a request; status is the HTTP status or 'error'"""
+        with self.lock:
+            self._get_endpoint(host, method, template).record(
+                secs, status, bytes_out, bytes_in)
+
+    def record_retry(self, host, method, template):
+        with self.lock:
+            self._get_endpoint(host, method, template).retries += 1
+
+    def add_stats(self, name, get_stats):
+        """Include the numbers returned by get_stats() in the output
+
+        get_stats() is called each time the metrics are written, and should
+        return a dict of numbers (e.g. ResponseCache.get_stats()), or None if
+        there are none. They are written as "<name>" in JSON and as
+        sam_sp_<name>_<key> gauges in Prometheus format.
+        """
+        with self.lock:
+            self.stats_sources[name] = get_stats
+
+    def to_dict(self):
+        with self.lock:
+            endpoints = [dict(host=host, method=method, endpoint=template,
+                              **metrics.to_dict()) \
+                         for (host, method, template), metrics \
+                         in sorted(self.endpoints.items())]
+            stats_sources = sorted(self.stats_sources.items())
+        result = {
+            'started': int(self.started),
+            'updated': int(time.time()),
+            'endpoints': endpoints,
+        }
+        for name, get_stats in stats_sources:
+            stats = get_stats()
+            if stats is not None:
+                result[name] = stats
+        return result
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        metrics = self.to_dict()
+        endpoints = metrics['endpoints']
+        lines = []
+        def add_metric(name, type, help, samples):
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' ' + type)
+            lines.extend(samples)
+        def labels(ep, **extra):
+            pairs = [('host', ep['host']), ('method', ep['method']),
+                     ('endpoint', ep['endpoint'])] + list(extra.items())
+            return '{' + ','.join(k + '="' + _escape(v) + '"' \
+                                  for k, v in pairs) + '}'
+
+        name = 'sam_sp_http_request_duration_seconds'
+        samples = []
+        for ep in endpoints:
+            for le, n in ep['buckets']:
+                samples.append(name + '_bucket' + labels(ep, le=str(le)) + \
+                               ' ' + str(n))
+            samples.append(name + '_sum' + labels(ep) + ' ' + \
+                           repr(ep['total_secs']))
+            samples.append(name + '_count' + labels(ep) + ' ' + \
+                           str(ep['count']))
+        add_metric(name, 'histogram', 'HTTP request latency', samples)
+
+        add_metric('sam_sp_http_requests_total', 'counter',
+                   'HTTP requests by status (or "error")',
+                   ['sam_sp_http_requests_total' + \
+                    labels(ep, status=status) + ' ' + str(n) \
+                    for ep in endpoints \
+                    for status, n in ep['statuses'].items()])
+        for key, name, help in (
+                ('retries', 'sam_sp_http_retries_total', 'HTTP request retries'),
+                ('bytes_out', 'sam_sp_http_request_bytes_total',
+                 'HTTP request body bytes sent'),
+                ('bytes_in', 'sam_sp_http_response_bytes_total',
+                 'HTTP response body bytes received')):
+            add_metric(name, 'counter', help,
+                       [name + labels(ep) + ' ' + str(ep[key]) \
+                        for ep in endpoints])
+        with self.lock:
+            sources = sorted(self.stats_sources)
+        for source in sources:
+            for key, value in sorted(metrics.get(source,{}).items()):
+                name = 'sam_sp_' + source + '_' + key
+                add_metric(name, 'gauge', source + ' ' + key,
+                           [name + ' ' + str(value)])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, dirname, format='prometheus'):
+        """Write the metrics to a file in dirname, replacing older metrics
+
+        The file is sam-sp-http-metrics.prom (Prometheus text format) or
+        sam-sp-http-metrics.json, depending on format.
+        """
+        if format == 'json':
+            filename = os.path.join(dirname, METRICS_FILE + '.json')
+            text = json.dumps(self.to_dict(), indent=1)
+        else:
+            filename = os.path.join(dirname, METRICS_FILE + '.prom')
+            text = self.to_prometheus()
+        tmpname = filename + '.t'
+        with open(tmpname, 'w') as file:
+            file.write(text)
+        os.rename(tmpname, filename)
+        return filename
+
+    def start_export(self, dirname, interval=60, format='prometheus',
+                     logger=None):
+        """Write the metrics every interval seconds in a background thread"""
+        if self.export_thread is not None:
+            return
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        def export():
+            while not self.export_stop.wait(interval):
+                try:
+                    self.write(dirname, format)
+                except Exception as err:
+                    # Keep exporting; the problem may be temporary
+                    if logger is not None:
+                        logger.warning("Unable to write HTTP metrics: " + \
+                                       str(err))
+        self.export_thread = threading.Thread(target=export, daemon=True,
+                                              name='http-metrics-export')
+        self.export_thread.start()
+
+    def stop_export(self):
+        if self.export_thread is not None:
+            self.export_stop.set()
+            self.export_thread.join()
+            self.export_thread = None
+            self.export_stop.clear()
+
+    def _get_endpoint(self, host, method, template):
+        key = (host, method, template)
+        metrics = self.endpoints.get(key,None)
+        if metrics is None:
+            metrics = EndpointMetrics()
+            self.endpoints[key] = metrics
+        return metrics
+
+def _escape(value):
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n',
+                                                                      '\\n')
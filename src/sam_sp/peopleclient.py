@@ -1,19 +1,65 @@
 import sys, os, json, time, re
+import sqlite3, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import requests
-from miscfuncs import truthy
 import tempfile
 from miscfuncs import to_expanded_string
-from spexception import ServiceProviderTemporaryError
 from sam_sp.peopledata import (Fuzzy, PeopleInternalOrg,
                                PeopleExternalOrg, PeoplePerson, make_regex)
+from sam_sp.fuzzyindex import FuzzyIndex
+from sam_sp.editdistance import EditDistanceIndex, bounded_levenshtein
+from sam_sp.transport import Transport
+from sam_sp.metrics import url_template
+from sam_sp.matchfile import (MatchFile, MatchTable, MatchIndex,
+                              write_matchfile, convert_matchfile,
+                              fuzzy_entries, append_journal, apply_journal)
 
 INTERNAL_ORGS = dict()
 EXTERNAL_ORGS = dict()
+# External orgs in EXTERNAL_ORGS, by NSF org code
+EXTERNAL_ORGS_BY_NSF_CODE = dict()
 EXTERNAL_ORG_FUZZIES = []
-RE_FUZZY_SPLIT = re.compile('^(.*):([0-9][0-9]*):([0-9][0-9]*)\s$')
-PERSONS = dict()
-VERIFY_SSL = truthy(os.environ.get("VERIFY_SSL","true"))
+EXTERNAL_ORG_INDEX = FuzzyIndex()
+EXTERNAL_ORG_EDIT_INDEX = EditDistanceIndex(0)
+# Fuzzies of each person, by upid; person records are read from the cache
+PERSON_FUZZIES = dict()
+PERSON_INDEX = FuzzyIndex(1)
+PERSON_EDIT_INDEX = EditDistanceIndex(1)
+# Serializes changes to the cached orgs and their match data, which may be
+# made from several threads (see TaskService), with lookups that read more
+# than one of them or iterate over them
+ORGS_LOCK = threading.RLock()
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS person (
+    upid INTEGER PRIMARY KEY,
+    lastChanged INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS internal_org (
+    acronym TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS external_org (
+    org_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS watermark (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+# Format of the data in the cache database, kept as the "cache_format" row of
+# the watermark table. A database with a different format (or none) is
+# emptied when it is opened, so its contents are downloaded again rather than
+# misread; bump this whenever the stored records change.
+CACHE_FORMAT = 1
+
+# Fuzzy matching engines: "regex" uses make_regex() patterns, "editdistance"
+# uses true Levenshtein distance (at most 2) over the same normalized fuzzy
+# strings, and "compare" returns "regex" results but logs any differences
+# from "editdistance" results
+MATCH_ENGINES = ('regex', 'editdistance', 'compare')
 
 class PeopleCache(object):
     def __init__(self):
@@ -22,51 +68,190 @@ class PeopleCache(object):
         if not Path(self.tempdir).is_dir():
             os.makedirs(self.tempdir)
         self.eorgmatchfile = self.tempdir + "/match-external-org"
+        self.eorgmatchbinfile = self.tempdir + "/match-external-org.bin"
+        # Changes to individual orgs since the match files were written; they
+        # are merged into the match files the next time these are loaded
+        self.eorgmatchjournal = self.tempdir + "/match-external-org.journal"
+
+        # Persons, internal orgs and external orgs are kept in a SQLite
+        # database, keyed by upid, acronym and org id respectively. The
+        # "watermark" table records, for each type of data, the unix time
+        # just before peopledb was last queried; this is used the next time
+        # peopledb is queried to get just the updates.
+        self.dbfile = self.tempdir + "/people.db"
+
+        # Files used by earlier versions; their contents are imported into the
+        # database when it is first created
         self.eorgfile = self.tempdir + "/external-org"
         self.iorgfile = self.tempdir + "/internal-org"
         self.personfile = self.tempdir + "/person"
-
-        # person-updated contains three lines: the first line is the unix time
-        # just before peopledb is queried, the second line is the number
-        # of bytes in the personfile, and the third line is the modification
-        # time of the personfile. The first time is used the next time peopledb
-        # is queried to get just the updates, and the size and second time
-        # are used to validate the person-updated file.
         self.personupdated = self.tempdir + "/person-updated"
 
+        self.lock = threading.RLock()
+        new_db = not self._have_file(self.dbfile)
+        self.db = sqlite3.connect(self.dbfile, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        if self.get_watermark("cache_format") != CACHE_FORMAT:
+            self._clear()
+            if new_db:
+                self._import_legacy_files()
+
     def have_ext_org_matchfile(self):
         return self._have_file(self.eorgmatchfile)
 
-    def have_ext_org_file(self):
-        return self._have_file(self.eorgfile)
+    def have_ext_org_matchbinfile(self):
+        return self._have_file(self.eorgmatchbinfile)
+
+    def have_ext_org_matchjournal(self):
+        return self._have_file(self.eorgmatchjournal)
+
+    def have_ext_orgs(self):
+        return self._have_rows("external_org")
+
+    def have_int_orgs(self):
+        return self._have_rows("internal_org")
+
+    def have_persons(self):
+        return self._have_rows("person")
+
+    def get_external_orgs(self):
+        rows = self._query("SELECT data FROM external_org ORDER BY org_id")
+        return [json.loads(row[0]) for row in rows]
+
+    def put_external_orgs(self, orgs, replace=False):
+        rows = [(int(org_id), json.dumps(org)) for org_id, org in orgs]
+        with self.lock, self.db:
+            if replace:
+                self.db.execute("DELETE FROM external_org")
+            self.db.executemany(
+                "INSERT INTO external_org (org_id, data) VALUES (?, ?) " +\
+                "ON CONFLICT(org_id) DO UPDATE SET data = excluded.data",
+                rows)
+
+    def get_internal_orgs(self):
+        rows = self._query("SELECT data FROM internal_org ORDER BY acronym")
+        return [json.loads(row[0]) for row in rows]
+
+    def put_internal_orgs(self, orgs, replace=False):
+        rows = [(org['acronym'], json.dumps(org)) for org in orgs]
+        with self.lock, self.db:
+            if replace:
+                self.db.execute("DELETE FROM internal_org")
+            self.db.executemany(
+                "INSERT INTO internal_org (acronym, data) VALUES (?, ?) " +\
+                "ON CONFLICT(acronym) DO UPDATE SET data = excluded.data",
+                rows)
+
+    def get_person(self, upid):
+        rows = self._query("SELECT data FROM person WHERE upid = ?",
+                           (int(upid),))
+        return json.loads(rows[0][0]) if rows else None
+
+    def get_person_last_changed(self, upid):
+        rows = self._query("SELECT lastChanged FROM person WHERE upid = ?",
+                           (int(upid),))
+        return rows[0][0] if rows else None
+
+    def iter_persons(self):
+        # Use a separate cursor so persons can be read a few at a time
+        with self.lock:
+            cursor = self.db.execute("SELECT data FROM person ORDER BY upid")
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                break
+            for row in rows:
+                yield json.loads(row[0])
+
+    def put_persons(self, persons, qtime=None):
+        """Upsert persons and, if qtime is given, record it as the watermark
+
+        Both are done in a single transaction.
+        """
+        rows = [(int(person['upid']), int(person['lastChanged']),
+                 json.dumps(self._strip_person(person))) for person in persons]
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT INTO person (upid, lastChanged, data) " +\
+                "VALUES (?, ?, ?) ON CONFLICT(upid) DO UPDATE SET " +\
+                "lastChanged = excluded.lastChanged, data = excluded.data",
+                rows)
+            if qtime is not None:
+                self._set_watermark("person", qtime)
+
+    def person_last_run(self):
+        return self.get_watermark("person")
 
-    def have_int_org_file(self):
-        return self._have_file(self.iorgfile)
+    def get_watermark(self, name):
+        rows = self._query("SELECT value FROM watermark WHERE name = ?",
+                           (name,))
+        return rows[0][0] if rows else 0
 
-    def have_person_file(self):
-        return self._have_file(self.personfile)
+    def set_watermark(self, name, value):
+        with self.lock, self.db:
+            self._set_watermark(name, value)
 
-    def person_file_metadata(self):
+    def _set_watermark(self, name, value):
+        self.db.execute("INSERT INTO watermark (name, value) VALUES (?, ?) " +\
+                        "ON CONFLICT(name) DO UPDATE SET value = excluded.value",
+                        (name, int(value)))
+
+    def _clear(self):
+        # Drop all cached data, including the watermarks, and record the
+        # current format
+        with self.lock, self.db:
+            for table in ("person", "internal_org", "external_org",
+                          "watermark"):
+                self.db.execute("DELETE FROM " + table)
+            self._set_watermark("cache_format", CACHE_FORMAT)
+
+    def _strip_person(self, person):
+        # Fuzzies are not saved; they can be made from the other fields
+        if 'fuzzies' not in person:
+            return person
+        return {key: val for key, val in person.items() if key != 'fuzzies'}
+
+    def _have_rows(self, table):
+        rows = self._query("SELECT 1 FROM " + table + " LIMIT 1")
+        return len(rows) > 0
+
+    def _query(self, sql, parms=()):
+        with self.lock:
+            return self.db.execute(sql, parms).fetchall()
+
+    def _import_legacy_files(self):
+        # Import the JSON files used before the SQLite database existed so
+        # that existing caches do not have to be downloaded again
+        if self._have_file(self.iorgfile):
+            with open(self.iorgfile, "r") as file:
+                orgdata = json.load(file)
+            self.put_internal_orgs(orgdata.values())
+        if self._have_file(self.eorgfile):
+            with open(self.eorgfile, "r") as file:
+                orgdata = json.load(file)
+            self.put_external_orgs(orgdata.items())
         if self._have_file(self.personfile):
-            size = os.stat(self.personfile).st_size
-            mtime = os.stat(self.personfile).st_mtime
-            return (size, mtime)
-        return (None, None)
-
-    def person_file_updated(self):
-        if self._have_file(self.personfile) and \
-           self._have_file(self.personupdated):
-            personfile_size = os.stat(self.personfile).st_size
-            personfile_mtime = os.stat(self.personfile).st_mtime
-            (recorded_qtime, recorded_size, recorded_mtime) = \
-                self._get_recorded_person_metadata()
-            if recorded_qtime and recorded_size and recorded_mtime and \
-               recorded_size == personfile_size and \
-               recorded_mtime == personfile_mtime:
-                    return recorded_qtime
-        return 0
-    
-    def _get_recorded_person_metadata(self):
+            # The person file is append-only, so later records for a upid
+            # supersede earlier ones
+            qtime = self._get_legacy_person_qtime()
+            persons = dict()
+            with open(self.personfile, "r") as file:
+                for rec in file:
+                    rdict = json.loads(rec)
+                    persons[int(rdict['upid'])] = rdict
+            self.put_persons(persons.values(), qtime)
+        for filename in (self.iorgfile, self.eorgfile, self.personfile,
+                         self.personupdated):
+            if Path(filename).is_file():
+                os.remove(filename)
+
+    def _get_legacy_person_qtime(self):
+        # person-updated contains three lines: the unix time just before
+        # peopledb was queried, and the size and modification time of the
+        # person file, which are used to validate the person-updated file.
+        if not self._have_file(self.personupdated):
+            return 0
         qtime = None
         size = None
         mtime = None
@@ -77,16 +262,34 @@ class PeopleCache(object):
                 size = int(float(line))
             if (line := file.readline()):
                 mtime = int(float(line))
-        return (qtime, size, mtime)
-        
-                        
+        personfile_size = os.stat(self.personfile).st_size
+        personfile_mtime = int(os.stat(self.personfile).st_mtime)
+        if qtime and size == personfile_size and mtime == personfile_mtime:
+            return qtime
+        return 0
+
     def _have_file(self,filename):
         return (Path(filename).is_file() and os.stat(filename).st_size > 0)
 
 class PeopleClient(object):
 
-    def __init__(self, url=None, user=None, password=None, logger=None):
+    def __init__(self, url=None, user=None, password=None, logger=None,
+                 match_engine='regex', max_org_matches=25, page_size=5000,
+                 load_parallelism=4, org_refresh_interval=3600,
+                 transport=None):
         self.cache = PeopleCache()
+        if match_engine not in MATCH_ENGINES:
+            raise RuntimeError("Unknown match engine: " + str(match_engine))
+        self.match_engine = match_engine
+        self.max_org_matches = int(max_org_matches)
+        self.page_size = int(page_size)
+        self.load_parallelism = max(1,int(load_parallelism))
+        # Seconds between checks for changed orgs; 0 to never check
+        self.org_refresh_interval = int(org_refresh_interval)
+        self.unknown_org_ids = set()
+        # The cached orgs are shared by all clients, and so is their lock
+        self.org_update_lock = ORGS_LOCK
+        self.logger = logger
         if not url:
             return
         if not url.endswith("/"):
@@ -94,15 +297,11 @@ class PeopleClient(object):
         self.url = url
         self.user = user
         self.password = password
-        self.session = requests.Session()
-        self.session.auth = (user, password)
-        self.logger = logger
-
-    def _reconnect(self):
-        if self.logger is not None:
-            self.logger.debug("Re-establishing session")
-        self.session = requests.Session()
-        self.session.auth = (self.user, self.password)
+        self.auth = (user, password)
+        # The transport may be shared with other clients
+        if transport is None:
+            transport = Transport(logger=logger)
+        self.transport = transport
 
     def get_internal_orgs(self):
         global INTERNAL_ORGS
@@ -146,6 +345,7 @@ class PeopleClient(object):
         if 'nsfOrgCode' in response:
             current_nsf_org_code = response['nsfOrgCode']
             if current_nsf_org_code == nsf_org_code:
+                self._update_cached_external_org(response)
                 return response
         response['nsfOrgCode'] = nsf_org_code
         request_data = json.dumps(response)
@@ -162,50 +362,38 @@ class PeopleClient(object):
         return org
 
     def get_cached_org_by_nsf_code(self, nsf_org_code):
-        global EXTERNAL_ORGS
+        global EXTERNAL_ORGS, EXTERNAL_ORGS_BY_NSF_CODE
         if not EXTERNAL_ORGS:
             self.load_external_orgs()
-        for org in EXTERNAL_ORGS.values():
-            if EXTERNAL_ORGS.get('nsfOrgCode',None) == nsf_org_code:
-                return org
-        return None
+        return EXTERNAL_ORGS_BY_NSF_CODE.get(nsf_org_code,None)
 
     def get_external_orgs(self):
         global EXTERNAL_ORGS
         if not EXTERNAL_ORGS:
             self.load_external_orgs()
-        ids = sorted(EXTERNAL_ORGS.keys())
-        orgs = []
-        for org_id in ids:
-            org = EXTERNAL_ORGS[org_id]
-            orgs.append(org)
+        with self.org_update_lock:
+            ids = sorted(EXTERNAL_ORGS.keys())
+            orgs = []
+            for org_id in ids:
+                org = EXTERNAL_ORGS[org_id]
+                orgs.append(org)
         return orgs
 
     def fuzzymatch_org(self, **kwargs):
         global EXTERNAL_ORG_FUZZIES
         if not EXTERNAL_ORG_FUZZIES:
-            self._load_org_matchfile()
-        
-        name = PeopleExternalOrg.get_normalized_match_param('name',kwargs)
-        city = PeopleExternalOrg.get_normalized_match_param('city',kwargs)
-        name_city = name + " " + city
-        address = PeopleExternalOrg.get_normalized_match_param('address',kwargs)
-        matches = []
-        matches.extend(self._fuzzyfind_org(name,city,address))
-        matches.extend(self._fuzzyfind_org(name_city,city,address))
-
-        name = PeopleExternalOrg.reduce_to_essentials(name)
-        city = PeopleExternalOrg.reduce_to_essentials(city)
-        name_city = PeopleExternalOrg.reduce_to_essentials(name_city)
-        address = PeopleExternalOrg.reduce_to_essentials(address)
-        matches.extend(self._fuzzyfind_org(name,city,address))
-        matches.extend(self._fuzzyfind_org(name_city,city,address))
+            with self.org_update_lock:
+                if not EXTERNAL_ORG_FUZZIES:
+                    self._load_org_matchfile()
 
-        weighted_unique_ids = self._sort_unique_weighted(matches)
+        weighted_unique_ids = self._match_orgs(self._make_org_variants(kwargs))
+        org_ids = [int(org_id) for org_id in weighted_unique_ids]
+        if self.max_org_matches > 0:
+            org_ids = org_ids[0:self.max_org_matches]
+        cached_orgs = self._get_cached_external_orgs(org_ids)
         matched_orgs = []
-        for org_id in weighted_unique_ids:
-            org_dict = self.get_external_org_by_id(org_id)
-            
+        for org_id in org_ids:
+            org_dict = cached_orgs.get(org_id,None)
             if org_dict is not None:
                 org = PeopleExternalOrg(org_dict)
                 matched_orgs.append(org.essential_fields())
@@ -216,10 +404,28 @@ class PeopleClient(object):
             return labeled_list
         return []
     
+    def _make_org_variants(self, kwargs):
+        # The (name,city,address) variants of a fuzzymatch_org() query
+        name = PeopleExternalOrg.get_normalized_match_param('name',kwargs)
+        city = PeopleExternalOrg.get_normalized_match_param('city',kwargs)
+        name_city = name + " " + city
+        address = PeopleExternalOrg.get_normalized_match_param('address',kwargs)
+        variants = []
+        variants.append((name,city,address))
+        variants.append((name_city,city,address))
+
+        name = PeopleExternalOrg.reduce_to_essentials(name)
+        city = PeopleExternalOrg.reduce_to_essentials(city)
+        name_city = PeopleExternalOrg.reduce_to_essentials(name_city)
+        address = PeopleExternalOrg.reduce_to_essentials(address)
+        variants.append((name,city,address))
+        variants.append((name_city,city,address))
+        return variants
+
     def load_internal_orgs(self):
         global INTERNAL_ORGS
-        filename = self.cache.iorgfile
-        if not self.cache.have_int_org_file():
+        if not self.cache.have_int_orgs():
+            qtime = int(time.time())
             results = self._get("orgs")
             allorgs = dict()
             for rec in results:
@@ -227,60 +433,82 @@ class PeopleClient(object):
                 acronym = internal_org['acronym']
                 allorgs[acronym] = internal_org
             INTERNAL_ORGS = allorgs
-            tmpname = filename + ".t"
-            with open(tmpname, "w") as file:
-                json.dump(INTERNAL_ORGS, file, indent=4)
-            os.rename(tmpname,filename)
+            self.cache.put_internal_orgs(INTERNAL_ORGS.values(), replace=True)
+            self.cache.set_watermark("internal_org", qtime)
         else:
-            with open(filename, "r") as file:
-                orgdata = json.load(file)
             orgs = dict()
-            for acronym in orgdata.keys():
-                org = PeopleInternalOrg(orgdata[acronym])
-                orgs[acronym] = org
+            for orgdata in self.cache.get_internal_orgs():
+                org = PeopleInternalOrg(orgdata)
+                orgs[org['acronym']] = org
             INTERNAL_ORGS = orgs
+            self._refresh_internal_orgs()
+
+    def refresh_internal_orgs(self):
+        """Load internal orgs if they are not loaded, otherwise merge changes
+
+        Changed orgs are requested at most every org_refresh_interval seconds.
+        """
+        global INTERNAL_ORGS
+        if not INTERNAL_ORGS:
+            self.load_internal_orgs()
+        else:
+            self._refresh_internal_orgs()
+
+    def _refresh_internal_orgs(self):
+        # Merge internal orgs changed since the last download or refresh
+        global INTERNAL_ORGS
+        last_run = self._get_org_refresh_last_run("internal_org")
+        if last_run is None:
+            return
+        qtime = int(time.time())
+        results = self._get("orgs?lastRun=" + str(last_run))
+        changed = []
+        for rec in results or []:
+            org = PeopleInternalOrg(rec)
+            if INTERNAL_ORGS.get(org['acronym'],None) != org:
+                changed.append(org)
+        self._update_cached_internal_orgs(changed)
+        self.cache.set_watermark("internal_org", qtime)
+
+    def _get_org_refresh_last_run(self, name):
+        # Return the watermark for an org type if it is time to refresh that
+        # type, else None
+        if self.org_refresh_interval <= 0:
+            return None
+        last_run = self.cache.get_watermark(name)
+        if int(time.time()) - last_run < self.org_refresh_interval:
+            return None
+        return last_run
 
     def _get(self, path):
         url = self._build_full_url(path)
-        result = self._try_get(url)
+        result = self._try_get(url, url_template(path))
         
         if result.status_code == 200:
             return json.loads(result.text)
         elif result.status_code == 404:
             return None
-        elif result.status_code == 500 and "Object not found" in response.text:
+        elif result.status_code == 500 and "Object not found" in result.text:
             return None
 
         self._raise_request_error('GET',url,result)
                          
-    def _try_get(self, url):
-        global VERIFY_SSL
-        result = None
-        try:
-            result = self.session.get(url, verify=VERIFY_SSL)
-            
-        except requests.exceptions.Timeout as te:
-            raise ServiceProviderTemporaryError(te);
-
-        return result
+    def _try_get(self, url, template=None):
+        # Timeouts and repeated 503 results raise ServiceProviderTemporaryError
+        return self.transport.get(url, auth=self.auth, template=template)
 
     def _put(self, path, data):
         url = self._build_full_url(path)
-        result = self._try_put(url, data)
+        result = self._try_put(url, data, url_template(path))
                          
         if result.status_code == 200:
             return json.loads(result.text)
 
         self._raise_request_error('PUT',url,result)
 
-    def _try_put(self, url, data):
-        global VERIFY_SSL
-        try:
-            result = self.session.put(url, data=data, verify=VERIFY_SSL)
-        except requests.exceptions.Timeout as te:
-            raise ServiceProviderTemporaryError(te);
-
-        return result
+    def _try_put(self, url, data, template=None):
+        return self.transport.put(url, data=data, auth=self.auth,
+                                  template=template)
 
     def _raise_request_error(self, method, url, result):
         raise RuntimeError("People API returned " + str(result.status_code) + \
@@ -288,34 +516,118 @@ class PeopleClient(object):
                            " result:\n" + to_expanded_string(result.text))
 
     def _update_cached_internal_org(self, org):
+        self._update_cached_internal_orgs([org])
+
+    def _update_cached_internal_orgs(self, orgs):
         global INTERNAL_ORGS
-        if not INTERNAL_ORGS:
+        if not INTERNAL_ORGS or not orgs:
             return
-        INTERNAL_ORGS[org['acronym']] = org
+        with self.org_update_lock:
+            for org in orgs:
+                INTERNAL_ORGS[org['acronym']] = org
+            self.cache.put_internal_orgs(orgs)
     
     def load_external_orgs(self):
         global EXTERNAL_ORGS
-        filename = self.cache.eorgfile
-        if not self.cache.have_ext_org_file():
-            results = self._get("protected/admin/externalOrgs?name=%%")
-            allorgs = dict()
-            for rec in results:
-                external_org = PeopleExternalOrg(rec)
-                idx = self._get_org_id(external_org)
-                allorgs[idx] = external_org
-            EXTERNAL_ORGS = allorgs
-            tmpname = filename + ".t"
-            with open(tmpname, "w") as file:
-                json.dump(EXTERNAL_ORGS, file, indent=4)
-            os.rename(tmpname,filename)
+        if not self.cache.have_ext_orgs():
+            self._download_external_orgs()
         else:
-            with open(filename, "r") as file:
-                orgdata = json.load(file)
             orgs = dict()
-            for org_id in orgdata.keys():
-                org = PeopleExternalOrg(orgdata[org_id])
-                orgs[int(org_id)] = org
-            EXTERNAL_ORGS = orgs
+            for orgdata in self.cache.get_external_orgs():
+                org = PeopleExternalOrg(orgdata)
+                orgs[self._get_org_id(org)] = org
+            with self.org_update_lock:
+                EXTERNAL_ORGS = orgs
+                self._index_external_orgs()
+            self._refresh_external_orgs()
+
+    def refresh_external_orgs(self):
+        """Load external orgs if they are not loaded, otherwise merge changes
+
+        Changed orgs are requested at most every org_refresh_interval seconds.
+        """
+        global EXTERNAL_ORGS
+        if not EXTERNAL_ORGS:
+            self.load_external_orgs()
+        else:
+            self._refresh_external_orgs()
+
+    def _refresh_external_orgs(self, force=False):
+        # Merge external orgs changed since the last download or refresh; only
+        # the match file entries of changed orgs are replaced. If force is
+        # False, this is done at most every org_refresh_interval seconds.
+        global EXTERNAL_ORGS
+        if force:
+            last_run = self.cache.get_watermark("external_org")
+        else:
+            last_run = self._get_org_refresh_last_run("external_org")
+        if last_run is None:
+            return
+        qtime = int(time.time())
+        results = self._get("protected/admin/externalOrgs?name=%%&lastRun=" +\
+                            str(last_run))
+        changed = []
+        for rec in results or []:
+            org = PeopleExternalOrg(rec)
+            if EXTERNAL_ORGS.get(self._get_org_id(org),None) != org:
+                changed.append(org)
+        self._update_cached_external_orgs(changed)
+        self.cache.set_watermark("external_org", qtime)
+
+    def _download_external_orgs(self):
+        global EXTERNAL_ORGS
+        qtime = int(time.time())
+        results = self._get("protected/admin/externalOrgs?name=%%")
+        allorgs = dict()
+        for rec in results:
+            external_org = PeopleExternalOrg(rec)
+            idx = self._get_org_id(external_org)
+            allorgs[idx] = external_org
+        with self.org_update_lock:
+            # Orgs deleted since the last download no longer match
+            removed = [org_id for org_id in EXTERNAL_ORGS \
+                       if org_id not in allorgs]
+            EXTERNAL_ORGS = allorgs
+            self._index_external_orgs()
+            self.cache.put_external_orgs(EXTERNAL_ORGS.items(), replace=True)
+            self.cache.set_watermark("external_org", qtime)
+            for org_id in removed:
+                self._remove_org_fuzzies(org_id)
+
+    def _index_external_orgs(self):
+        global EXTERNAL_ORGS, EXTERNAL_ORGS_BY_NSF_CODE
+        by_nsf_code = dict()
+        for org in EXTERNAL_ORGS.values():
+            nsf_org_code = org.get('nsfOrgCode',None)
+            if nsf_org_code:
+                by_nsf_code[nsf_org_code] = org
+        EXTERNAL_ORGS_BY_NSF_CODE = by_nsf_code
+
+    def _get_cached_external_orgs(self, org_ids):
+        # Return a dict of the given external orgs from the cache. Changed
+        # orgs are merged every org_refresh_interval seconds, or at once if
+        # any of the orgs are not cached (e.g. orgs added since the last
+        # refresh); orgs are never downloaded in full from here.
+        # Ids that are still missing after a refresh (e.g. orgs deleted from
+        # PeopleDB since the match file was built) are removed from the match
+        # file and remembered so they do not trigger another refresh.
+        global EXTERNAL_ORGS
+        self.refresh_external_orgs()
+        for org_id in org_ids:
+            if org_id not in EXTERNAL_ORGS and \
+               org_id not in self.unknown_org_ids:
+                self._refresh_external_orgs(force=True)
+                break
+        orgs = dict()
+        for org_id in org_ids:
+            org = EXTERNAL_ORGS.get(org_id,None)
+            if org is not None:
+                orgs[org_id] = org
+            elif org_id not in self.unknown_org_ids:
+                with self.org_update_lock:
+                    self._remove_org_fuzzies(org_id)
+                self.unknown_org_ids.add(org_id)
+        return orgs
 
     def _get_org_id(self, org):
         org_id = org.get('id',None)
@@ -324,39 +636,132 @@ class PeopleClient(object):
         return int(org_id)
         
     def _update_cached_external_org(self, org):
-        global EXTERNAL_ORGS
-        if not EXTERNAL_ORGS:
+        self._update_cached_external_orgs([org])
+
+    def _update_cached_external_orgs(self, orgs):
+        global EXTERNAL_ORGS, EXTERNAL_ORGS_BY_NSF_CODE
+        if not EXTERNAL_ORGS or not orgs:
+            return
+        with self.org_update_lock:
+            items = []
+            for org in orgs:
+                org_id = self._get_org_id(org)
+                old_org = EXTERNAL_ORGS.get(org_id,None)
+                if old_org is not None:
+                    old_nsf_org_code = old_org.get('nsfOrgCode',None)
+                    if EXTERNAL_ORGS_BY_NSF_CODE.get(old_nsf_org_code,None) \
+                       is old_org:
+                        del EXTERNAL_ORGS_BY_NSF_CODE[old_nsf_org_code]
+                EXTERNAL_ORGS[org_id] = org
+                nsf_org_code = org.get('nsfOrgCode',None)
+                if nsf_org_code:
+                    EXTERNAL_ORGS_BY_NSF_CODE[nsf_org_code] = org
+                self.unknown_org_ids.discard(org_id)
+                items.append((org_id, org))
+            self.cache.put_external_orgs(items)
+            for org in orgs:
+                self._update_org_fuzzies(org)
+
+    def _update_org_fuzzies(self, org):
+        # Replace the match file entries of one org with its current fuzzies,
+        # both in memory and (via the journal) on disk. Changes that do not
+        # affect the fuzzies, e.g. setting the NSF org code, are skipped.
+        global EXTERNAL_ORG_FUZZIES
+        if not self.cache.have_ext_org_matchfile():
             return
         org_id = self._get_org_id(org)
-        EXTERNAL_ORGS[org_id] = org
-        
+        entries = list(fuzzy_entries(PeopleExternalOrg(org).make_fuzzies()))
+        if isinstance(EXTERNAL_ORG_FUZZIES, MatchTable):
+            if EXTERNAL_ORG_FUZZIES.get_entries(org_id) == entries:
+                return
+            self._replace_org_fuzzies(org_id, entries)
+        append_journal(self.cache.eorgmatchjournal, [org_id], entries)
+
+    def _remove_org_fuzzies(self, org_id):
+        # Remove the match file entries of a deleted org
+        global EXTERNAL_ORG_FUZZIES
+        if not self.cache.have_ext_org_matchfile():
+            return
+        if isinstance(EXTERNAL_ORG_FUZZIES, MatchTable):
+            self._replace_org_fuzzies(org_id, [])
+        append_journal(self.cache.eorgmatchjournal, [org_id], [])
+
+    def _replace_org_fuzzies(self, org_id, entries):
+        global EXTERNAL_ORG_FUZZIES, EXTERNAL_ORG_INDEX, EXTERNAL_ORG_EDIT_INDEX
+        fuzzies = EXTERNAL_ORG_FUZZIES
+        use_edit_index = self.match_engine != 'regex'
+        for i in fuzzies.remove(org_id):
+            instr = fuzzies.instr(i)
+            EXTERNAL_ORG_INDEX.remove(i, instr)
+            if use_edit_index:
+                EXTERNAL_ORG_EDIT_INDEX.remove(i, instr)
+        for i in fuzzies.add(entries):
+            instr = fuzzies.instr(i)
+            EXTERNAL_ORG_INDEX.add(i, instr)
+            if use_edit_index:
+                EXTERNAL_ORG_EDIT_INDEX.add(i, instr)
+
     def _load_org_matchfile(self):
-        global EXTERNAL_ORG_FUZZIES, RE_FUZZY_SPLIT
+        global EXTERNAL_ORG_FUZZIES
+        # The text match file is kept for reference; matching uses the
+        # memory-mapped binary match file, which is converted from the text
+        # file if it is missing, older than the text file (e.g. the text file
+        # was replaced) or in an unsupported format
         if not self.cache.have_ext_org_matchfile():
             self._build_org_matchfile()
-        fuzzies = []
-        filename = self.cache.eorgmatchfile
-        with open(filename, "r") as file:
-            while line := file.readline():
-                m = RE_FUZZY_SPLIT.match(line)
-                data = m.group(1)
-                idval = m.group(2)
-                weight = m.group(3)
-                fuzzy = Fuzzy(idval,weight,data)
-                fuzzies.append(fuzzy)
-        EXTERNAL_ORG_FUZZIES = fuzzies
+        textfile = self.cache.eorgmatchfile
+        binfile = self.cache.eorgmatchbinfile
+        if not self.cache.have_ext_org_matchbinfile() or \
+           os.path.getmtime(binfile) < os.path.getmtime(textfile):
+            convert_matchfile(textfile, binfile)
+        try:
+            matchfile = MatchFile(binfile)
+        except RuntimeError as e:
+            if self.logger is not None:
+                self.logger.debug("Rebuilding " + binfile + ": " + str(e))
+            convert_matchfile(textfile, binfile)
+            matchfile = MatchFile(binfile)
+        EXTERNAL_ORG_FUZZIES = MatchTable(matchfile)
+        if self.cache.have_ext_org_matchjournal():
+            # Merge the journal into the match files
+            apply_journal(self.cache.eorgmatchjournal, EXTERNAL_ORG_FUZZIES)
+            self._write_org_matchfiles()
+            EXTERNAL_ORG_FUZZIES = MatchTable(MatchFile(binfile))
+        self._index_org_fuzzies()
+
+    def _index_org_fuzzies(self):
+        global EXTERNAL_ORG_FUZZIES, EXTERNAL_ORG_INDEX, EXTERNAL_ORG_EDIT_INDEX
+        # Index the name field; keys are positions in EXTERNAL_ORG_FUZZIES.
+        # The trigram index is stored in the binary match file; only the
+        # edit distance index, which the "regex" engine does not use, is
+        # built entry by entry.
+        fuzzies = EXTERNAL_ORG_FUZZIES
+        edit_index = EditDistanceIndex(0)
+        if self.match_engine != 'regex':
+            for i in fuzzies.live_positions():
+                edit_index.add(i, fuzzies.instr(i))
+        EXTERNAL_ORG_INDEX = MatchIndex(fuzzies)
+        EXTERNAL_ORG_EDIT_INDEX = edit_index
 
     def _build_org_matchfile(self):
         global EXTERNAL_ORG_FUZZIES
         if len(EXTERNAL_ORG_FUZZIES) == 0:
             self._build_org_fuzzy_data()
+        self._write_org_matchfiles()
 
+    def _write_org_matchfiles(self):
+        global EXTERNAL_ORG_FUZZIES
         filename = self.cache.eorgmatchfile
         tmpname = filename + ".t"
         with open(tmpname, "w") as file:
             for fuzzy in EXTERNAL_ORG_FUZZIES:
                 file.write(str(fuzzy)+"\n")
         os.rename(tmpname,filename)
+        write_matchfile(self.cache.eorgmatchbinfile,
+                        fuzzy_entries(EXTERNAL_ORG_FUZZIES))
+        # The match files now include any changes in the journal
+        if os.path.exists(self.cache.eorgmatchjournal):
+            os.remove(self.cache.eorgmatchjournal)
 
     def _build_org_fuzzy_data(self):
         global EXTERNAL_ORG_FUZZIES
@@ -366,31 +771,137 @@ class PeopleClient(object):
             fuzzies.extend(org_fuzzies)
         EXTERNAL_ORG_FUZZIES = fuzzies
 
-    def _fuzzyfind_org(self,name,city,address):
-        matches = []
+    def _match_orgs(self, variants):
+        # The match data is read under the lock, as _replace_org_fuzzies()
+        # changes it in place
+        engine = self.match_engine
+        if engine == 'editdistance':
+            with self.org_update_lock:
+                matches = self._editfind_org(variants)
+            return self._sort_unique_weighted(matches)
+        with self.org_update_lock:
+            matches = self._fuzzyfind_org(variants)
+            if engine == 'compare':
+                edit_matches = self._editfind_org(variants)
+        org_ids = self._sort_unique_weighted(matches)
+        if engine == 'compare':
+            edit_org_ids = self._sort_unique_weighted(edit_matches)
+            self._report_engine_differences('org', variants, org_ids,
+                                            edit_org_ids)
+        return org_ids
+
+    def _fuzzyfind_org(self,variants):
+        global EXTERNAL_ORG_FUZZIES, EXTERNAL_ORG_INDEX
+        fuzzies = EXTERNAL_ORG_FUZZIES
+        # Every (fuzziness,variant) pattern is an alternative of one regex,
+        # lowest fuzziness first. Alternatives are tried in order, so the group
+        # that matches gives the lowest fuzziness at which a fuzzy matches any
+        # variant, and the fuzzies are only scanned once. A fuzzy that matches
+        # is also checked against the patterns of each higher fuzziness, so
+        # every weight that one pattern per (fuzziness,variant) would give is
+        # returned.
+        alternatives = []
+        groups = []
+        level_patterns = []
+        candidates = set()
         for fuzziness in range(0,3):
-            matched_fuzzies = self._find_org(fuzziness,name,city,address)
-            for matched_fuzzy in matched_fuzzies:
-                org_id = matched_fuzzy['idval']
-                weight = str(fuzziness) + str(matched_fuzzy['weight'])
-                matches.append(weight+":"+str(org_id))
-        return matches
+            level_alternatives = []
+            for name, city, address in variants:
+                group = 'g' + str(len(groups))
+                rawpat = self._make_org_regex(fuzziness,name,city,address)
+                alternatives.append('(?P<' + group + '>' + rawpat + ')')
+                level_alternatives.append(rawpat)
+                groups.append((group,fuzziness))
+                # The index returns a superset of the matching entries; the
+                # pattern confirms them
+                if candidates is not None:
+                    keys = EXTERNAL_ORG_INDEX.candidates(name,fuzziness)
+                    if keys is None:
+                        candidates = None
+                    else:
+                        candidates.update(keys)
+            level_patterns.append(
+                re.compile('(?:' + '|'.join(level_alternatives) + ')'))
+        # No '^': MatchFile.match() anchors each match at the entry's start
+        pattern = re.compile('(?:' + '|'.join(alternatives) + ')')
+        if candidates is None:
+            candidates = fuzzies.live_positions()
+        else:
+            candidates = sorted(candidates)
 
-    def _find_org(self,fuzziness,name,city,address):
-        global EXTERNAL_ORG_FUZZIES
+        matches = set()
+        for i in candidates:
+            m = fuzzies.match(pattern, i)
+            if m is None:
+                continue
+            for group, fuzziness in groups:
+                if m.group(group) is not None:
+                    break
+            org_id = fuzzies.idval(i)
+            self._add_match(matches, fuzziness, fuzzies.weight(i), org_id)
+            for higher in range(fuzziness+1,3):
+                if fuzzies.match(level_patterns[higher], i):
+                    self._add_match(matches, higher, fuzzies.weight(i),
+                                    org_id)
+        return list(matches)
+
+    def _editfind_org(self,variants):
+        global EXTERNAL_ORG_FUZZIES, EXTERNAL_ORG_EDIT_INDEX
         fuzzies = EXTERNAL_ORG_FUZZIES
+        matches = set()
+        for name, city, address in variants:
+            if name:
+                candidates = EXTERNAL_ORG_EDIT_INDEX.search(name,2).keys()
+            else:
+                candidates = fuzzies.live_positions()
+            for i in candidates:
+                fuzziness = self._get_edit_fuzziness((name,city),
+                                                     fuzzies.instr(i),2)
+                if fuzziness is None:
+                    continue
+                self._add_match(matches, fuzziness, fuzzies.weight(i),
+                                fuzzies.idval(i))
+        return list(matches)
+
+    def _get_edit_fuzziness(self, query_fields, instr, maxdist):
+        # Sum of the edit distances of the non-empty query fields from the
+        # corresponding fields of instr; empty query fields match anything
+        data_fields = instr.split(':')
+        fuzziness = 0
+        for i, query_field in enumerate(query_fields):
+            if not query_field:
+                continue
+            data_field = data_fields[i] if i < len(data_fields) else ''
+            d = bounded_levenshtein(query_field, data_field, maxdist-fuzziness)
+            if d is None:
+                return None
+            fuzziness += d
+        return fuzziness
+
+    def _add_match(self, matches, fuzziness, weight, idval):
+        # Every distinct "<fuzziness><weight>:<id>" string is kept: weights
+        # are compared as strings by _get_sorted_reasonably_weighted_matches(),
+        # so the lowest-sorting string for an id is not always the one that
+        # decides its rank
+        matches.add(str(fuzziness) + str(weight) + ":" + str(idval))
+
+    def _report_engine_differences(self, kind, variants, regex_ids, edit_ids):
+        if regex_ids == edit_ids or self.logger is None:
+            return
+        regex_only = [i for i in regex_ids if i not in edit_ids]
+        edit_only = [i for i in edit_ids if i not in regex_ids]
+        self.logger.info("Match engines differ for " + kind + " query " + \
+                         str(variants[0]) + ":\n  regex: " + str(regex_ids) +\
+                         "\n  editdistance: " + str(edit_ids) + \
+                         "\n  regex only: " + str(regex_only) + \
+                         "\n  editdistance only: " + str(edit_only))
+
+    def _make_org_regex(self,fuzziness,name,city,address):
         name_pat = make_regex(name,fuzziness) + '[^:]*'
         city_pat = make_regex(city,fuzziness) + '[^:]*'
         address_pat = make_regex(address,fuzziness) + '[^:]*'
-        #        rawpat = '^' + name_pat + ':' + city_pat + ':' + address_pat + '$'
-        rawpat = '^' + name_pat + ':' + city_pat + '.*:?$'
-        pattern = re.compile(rawpat)
-        matched_fuzzies = []
-        for fuzzy in fuzzies:
-            data = fuzzy['instr']
-            if pattern.match(data):
-                matched_fuzzies.append(fuzzy)
-        return matched_fuzzies
+        #        rawpat = name_pat + ':' + city_pat + ':' + address_pat + '$'
+        return name_pat + ':' + city_pat + '.*:?$'
 
     def _sort_unique_weighted(self, in_wo):
         sorted_objs = self._get_sorted_reasonably_weighted_matches(in_wo)
@@ -419,39 +930,38 @@ class PeopleClient(object):
 
 
     def get_person_by_upid(self, upid):
-        global PERSONS
-        if not PERSONS:
+        if not self.cache.have_persons():
             self._load_persons()
-        return PERSONS[int(upid)]
+        rec = self.cache.get_person(upid)
+        if rec is None:
+            return None
+        return PeoplePerson(rec)
         
     def get_persons(self):
-        global PERSONS
-        if not PERSONS:
+        if not self.cache.have_persons():
             self._load_persons()
-        upids = sorted(PERSONS.keys())
         persons = []
-        for upid in upids:
-            person = PERSONS[upid]
-            persons.append(person)
+        for rec in self.cache.iter_persons():
+            persons.append(PeoplePerson(rec))
         return persons
 
     def fuzzymatch_person(self, **kwargs):
-        global PERSONS
-        if not PERSONS:
+        global PERSON_FUZZIES
+        if not PERSON_FUZZIES:
             self._load_persons()
         
         first = PeoplePerson.get_normalized_match_param('firstName',kwargs)
         last = PeoplePerson.get_normalized_match_param('lastName',kwargs)
         middle = PeoplePerson.get_normalized_match_param('middleName',kwargs)
         preferred = PeoplePerson.get_normalized_match_param('preferredName',kwargs)
-        matches = []
-        matches.extend(self._fuzzyfind_person(first,last,middle,preferred,1))
+        variants = []
+        variants.append((first,last,middle,preferred,1))
         if middle:
-            matches.extend(self._fuzzyfind_person(first,last,'',preferred,2))
+            variants.append((first,last,'',preferred,2))
         if first:
-            matches.extend(self._fuzzyfind_person('',last,'',preferred,4))
+            variants.append(('',last,'',preferred,4))
 
-        weighted_unique_ids = self._sort_unique_weighted(matches)
+        weighted_unique_ids = self._match_persons(variants)
         matched_persons = []
         for upid in weighted_unique_ids:
             person = self.get_person_by_upid(upid)
@@ -465,84 +975,161 @@ class PeopleClient(object):
         return []
 
     def _load_persons(self):
-        global PERSONS
-        if not PERSONS:
+        global PERSON_FUZZIES
+        if not PERSON_FUZZIES:
             self._load_cached_persons()
             
-        persons = []
+        # Persons are processed a page at a time: each changed person is
+        # saved and merged before the next page is processed, so memory use
+        # depends on the page size rather than the number of changes. The
+        # watermark is only advanced once all pages have been processed.
         qtime = int(time.time())
-        last_run = str(int(self.cache.person_file_updated()))
-        persons.extend(self._load_typed_persons("internal",last_run))
-        persons.extend(self._load_typed_persons("external",last_run))
-        
-        if len(persons) == 0:
-            return
-        
-        updatefile = self.cache.personupdated
-        tmpupdatename = updatefile + ".t"
-        filename = self.cache.personfile
-        tmpname = filename + ".t"
-        mode = "w" if last_run == "0" else "a"
-        with open(tmpname,mode) as file:
+        last_run = str(int(self.cache.person_last_run()))
+        nchanged = 0
+        for ptype, records in self._iter_person_pages(("internal","external"),
+                                                      last_run):
+            persons = list(self._iter_changed_persons(ptype, records))
+            if not persons:
+                continue
+            self.cache.put_persons(persons)
             for person in persons:
-                file.write(json.dumps(person)+"\n")
-        size = os.stat(tmpname).st_size
-        mtime = os.stat(tmpname).st_mtime
-        with open(tmpupdatename,"w") as file:
-            file.write(str(qtime)+"\n"+str(size)+"\n"+str(mtime)+"\n")
-            
-        os.rename(tmpname,filename)
-        os.rename(tmpupdatename,updatefile)
-        for person in persons:
-            upid = int(person['upid'])
-            PERSONS[upid] = person
+                self._merge_person(person)
+            nchanged += len(persons)
+
+        if nchanged > 0:
+            self.cache.set_watermark("person", qtime)
 
     def _load_cached_persons(self):
-        if not self.cache.have_person_file():
-            return
-        filename = self.cache.personfile
-        with open(filename,"r") as file:
-            for rec in file:
-                if not rec:
-                    break
-                rdict = json.loads(rec)
-                person = PeoplePerson(rdict)
-                upid = int(person['upid'])
-                PERSONS[upid] = person
+        # Cached person records do not include fuzzies
+        for rec in self.cache.iter_persons():
+            person = PeoplePerson(rec)
+            person.add_fuzzies()
+            self._merge_person(person)
+
+    def _merge_person(self, person):
+        global PERSON_FUZZIES, PERSON_INDEX, PERSON_EDIT_INDEX
+        # PERSON_INDEX is a blocking index on the last-name field of each
+        # person's fuzzies; replace any entries for a previous version of
+        # the person before adding the new ones
+        upid = int(person['upid'])
+        existing_fuzzies = PERSON_FUZZIES.get(upid,None)
+        indexes = [PERSON_INDEX]
+        if self.match_engine != 'regex':
+            indexes.append(PERSON_EDIT_INDEX)
+        fuzzies = person.get('fuzzies',[])
+        for index in indexes:
+            if existing_fuzzies is not None:
+                for fuzzy in existing_fuzzies:
+                    index.remove(upid, fuzzy['instr'])
+            for fuzzy in fuzzies:
+                index.add(upid, fuzzy['instr'])
+        PERSON_FUZZIES[upid] = fuzzies
         
-    def _load_typed_persons(self, ptype, lastRun):
-        global PERSONS
-        start_idx = 0
-        count = 5000
-        results = []
-        while True:
-            partial_results = \
-                self._get_person_records(ptype, start_idx, count, lastRun)
-            if not partial_results:
-                break
-            results.extend(partial_results)
-            nrec = len(partial_results)
-            start_idx = start_idx + nrec
+    def _iter_person_pages(self, ptypes, lastRun):
+        # Generate (ptype, records) for each page of persons of each type, in
+        # the order they would be returned by fetching one page after another.
+        # Up to load_parallelism pages, of any of the types, are fetched
+        # concurrently, assuming each page is full; if a page is short, pages
+        # fetched beyond it are discarded and fetching resumes after its last
+        # record, as it would if pages were fetched one after another.
+        size = self.page_size
+        parallelism = self.load_parallelism
+        pending = dict()
+        next_start = dict()
+        for ptype in ptypes:
+            pending[ptype] = deque()
+            next_start[ptype] = 0
+        active = list(ptypes)
+        executor = ThreadPoolExecutor(max_workers=parallelism)
 
-        persons = []
-        for rec in results:
+        def fetch_ahead():
+            nfetching = sum(len(fetches) for fetches in pending.values())
+            while nfetching < parallelism:
+                for ptype in active:
+                    if nfetching >= parallelism:
+                        break
+                    start = next_start[ptype]
+                    future = executor.submit(self._get_person_records, ptype,
+                                             start, size, lastRun)
+                    pending[ptype].append((start, future))
+                    next_start[ptype] = start + size
+                    nfetching += 1
+
+        def discard(ptype, start):
+            for unused_start, future in pending[ptype]:
+                future.cancel()
+            pending[ptype].clear()
+            next_start[ptype] = start
+
+        try:
+            for ptype in ptypes:
+                while True:
+                    fetch_ahead()
+                    start, future = pending[ptype].popleft()
+                    records = future.result()
+                    if not records:
+                        break
+                    nrec = len(records)
+                    if nrec < size:
+                        discard(ptype, start + nrec)
+                    yield (ptype, records)
+                active.remove(ptype)
+                discard(ptype, 0)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _iter_changed_persons(self, ptype, records):
+        for rec in records:
             rec['type'] = ptype
             person = PeoplePerson(rec)
-            upid = int(person['upid'])
-            existing_person = PERSONS.get(upid,None)
-            if existing_person and \
-               existing_person['lastChanged'] >= person['lastChanged']:
+            last_changed = self.cache.get_person_last_changed(person['upid'])
+            if last_changed is not None and \
+               last_changed >= person['lastChanged']:
                 continue
             if not 'org' in person:
                 org = '(unknown)' if ptype == 'external' else "UCAR/NCAR"
                 person['org'] = org
             person.add_fuzzies()
-            persons.append(person)
-        return persons
+            yield person
 
     def _get_person_records(self, type, start, count, lastRun):
         return self._get(type+"Persons?name=%&includeInactive=true&size="+str(count)+"&start="+str(start)+"&lastRun="+lastRun)
 
+    def _match_persons(self, variants):
+        engine = self.match_engine
+        if engine == 'editdistance':
+            return self._sort_unique_weighted(self._editfind_person(variants))
+        matches = []
+        for first, last, middle, preferred, factor in variants:
+            matches.extend(self._fuzzyfind_person(first,last,middle,preferred,
+                                                  factor))
+        upids = self._sort_unique_weighted(matches)
+        if engine == 'compare':
+            edit_upids = \
+                self._sort_unique_weighted(self._editfind_person(variants))
+            self._report_engine_differences('person', variants, upids,
+                                            edit_upids)
+        return upids
+
+    def _editfind_person(self, variants):
+        global PERSON_FUZZIES, PERSON_EDIT_INDEX
+        matches = set()
+        for first, last, middle, preferred, factor in variants:
+            if last:
+                candidates = PERSON_EDIT_INDEX.search(last,2).keys()
+            else:
+                candidates = PERSON_FUZZIES.keys()
+            query_fields = (first,last,middle,preferred)
+            for upid in candidates:
+                for fuzzy in PERSON_FUZZIES[upid]:
+                    fuzziness = self._get_edit_fuzziness(query_fields,
+                                                         fuzzy['instr'],2)
+                    if fuzziness is None:
+                        continue
+                    self._add_match(matches, fuzziness,
+                                    factor*fuzzy['weight'], upid)
+        return list(matches)
+
     def _fuzzyfind_person(self,first,last,middle,preferred,factor):
         matches = []
         for fuzziness in range(0,3):
@@ -554,7 +1141,7 @@ class PeopleClient(object):
         return matches
 
     def _find_person(self,fuzziness,first,last,middle,preferred):
-        global PERSONS
+        global PERSON_FUZZIES, PERSON_INDEX
         first_pat = make_regex(first,fuzziness) + '[^:]*'
         last_pat = make_regex(last,fuzziness) + '[^:]*'
         middle_pat = make_regex(middle,fuzziness) + '[^:]*'
@@ -562,10 +1149,13 @@ class PeopleClient(object):
         rawpat = '^' + first_pat + ':' + last_pat + ':' + middle_pat + \
             ':' + preferred_pat + '$'
         pattern = re.compile(rawpat)
+        # Only visit persons with a last-name field the pattern could match
+        candidates = PERSON_INDEX.candidates(last,fuzziness)
+        if candidates is None:
+            candidates = PERSON_FUZZIES.keys()
         matched_fuzzies = []
-        for upid in PERSONS.keys():
-            person = PERSONS[upid]
-            for fuzzy in person['fuzzies']:
+        for upid in candidates:
+            for fuzzy in PERSON_FUZZIES[upid]:
                 data = fuzzy['instr']
                 if pattern.match(data) is not None:
                     matched_fuzzies.append(fuzzy)
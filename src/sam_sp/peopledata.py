@@ -1,4 +1,4 @@
-import re, json
+import sys, re, json
 from sam_sp.misc import *
 
 PREFERRED_PHONE_TYPES = [
@@ -31,6 +31,18 @@ def make_regex(instr, fuzziness):
     outarr.append(')?')
     return ''.join(outarr)
 
+def make_charclasses(instr, fuzziness):
+    # Return the sets of characters accepted by the required (non-optional)
+    # character classes of make_regex(instr, fuzziness), in order. The final
+    # character of instr is optional in the regex, so it is not included.
+    nchars = len(instr)
+    classes = []
+    for i in range(0,nchars-1):
+        lb = max(0,i-fuzziness)
+        la = i+fuzziness+1
+        classes.append(set(instr[lb:la]))
+    return classes
+
 def _get_charmatch_regex(inarr, fuzziness, outarr, lookback, lookahead):
     outarr.append('[')
     for i in range(lookback,lookahead):
@@ -44,17 +56,50 @@ def _replace_non_alnum(instr):
     tnpstr = RE_WS.sub(' ',npstr)
     return RE_ESC_SEQ.sub('_',tnpstr)
 
-class Fuzzy(dict):
+class Fuzzy(object):
+    # Fuzzies are made for every person and external org, so they use slots
+    # rather than a dict, and their instr strings are interned. Item access
+    # (e.g. fuzzy['instr']) works as it did when Fuzzy was a dict.
+    __slots__ = ('instr', 'idval', 'weight')
 
-    def __init__(self, idval, weight, *args) -> dict:
-        kval = dict()
-        kval['instr'] = ':'.join(args)
-        kval['idval'] = int(idval)
-        kval['weight'] = int(weight)
-        dict.__init__(self, **kval)
+    def __init__(self, idval, weight, *args):
+        self.instr = sys.intern(':'.join(args))
+        self.idval = int(idval)
+        self.weight = int(weight)
+
+    def to_dict(self):
+        return { 'instr': self.instr, 'idval': self.idval,
+                 'weight': self.weight }
+
+    def keys(self):
+        return Fuzzy.__slots__
+
+    def get(self, key, default=None):
+        if key in Fuzzy.__slots__:
+            return getattr(self, key)
+        return default
+
+    def __getitem__(self, key):
+        if key in Fuzzy.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in Fuzzy.__slots__
+
+    def __eq__(self, other):
+        if isinstance(other, Fuzzy):
+            return self.instr == other.instr and \
+                self.idval == other.idval and self.weight == other.weight
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(self.to_dict())
 
     def __str__(self):
-        return '%s:%d:%02d' % (self['instr'],self['idval'],self['weight'])
+        return '%s:%d:%02d' % (self.instr,self.idval,self.weight)
         
 
 
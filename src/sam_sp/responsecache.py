@@ -0,0 +1,176 @@
+import os, json, time, sqlite3, threading
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+# Default TTLs, in seconds, of SAM paths whose results rarely change
+DEFAULT_TTLS = 'aois=86400 fosaoi/*=86400 contracts/*=600'
+
+# Seconds between evictions of all expired entries
+SWEEP_INTERVAL = 300
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS response (
+    path    TEXT PRIMARY KEY,
+    expires REAL NOT NULL,
+    data    TEXT NOT NULL
+);
+'''
+
+def parse_ttls(spec):
+    """Parse a "<pattern>=<secs> ..." string into (pattern, secs) tuples
+
+    Patterns are shell-style (fnmatch) patterns matched against SAM paths,
+    e.g. "fosaoi/*"; the first matching pattern applies.
+    """
+    ttls = []
+    for item in spec.replace(',',' ').split():
+        pattern, sep, secs = item.rpartition('=')
+        if not sep or not pattern:
+            raise ValueError("Invalid response cache TTL: " + item)
+        ttls.append((pattern, float(secs)))
+    return ttls
+
+def _is_empty(result):
+    return result is None or result == []
+
+class ResponseCache(object):
+
+    def __init__(self, ttls, negative_ttl=60, cache_dir=None):
+        """Read-through cache of SAM GET results
+
+        Only paths matching one of the TTL patterns are cached. Empty results
+        (None or an empty list) are cached for at most negative_ttl seconds.
+        Expired entries are evicted when they are next read, and from all
+        entries at most every SWEEP_INTERVAL seconds. If cache_dir is given,
+        results are also stored in a SQLite database there, so they survive
+        restarts.
+
+        :param ttls: (pattern, secs) tuples, or a string for parse_ttls()
+        :type ttls: list or str
+        :param negative_ttl: Seconds to cache empty results (0 to not cache)
+        :type negative_ttl: float
+        :param cache_dir: If given, directory of the on-disk store
+        :type cache_dir: str or None
+        """
+        if isinstance(ttls, str):
+            ttls = parse_ttls(ttls)
+        self.ttls = list(ttls)
+        self.negative_ttl = float(negative_ttl)
+        self.lock = threading.Lock()
+        # path -> (expiry time, JSON text); results are kept as text so
+        # callers cannot modify the cached copy
+        self.responses = dict()
+        self.next_sweep = time.time() + SWEEP_INTERVAL
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.db = None
+        if cache_dir:
+            if not Path(cache_dir).is_dir():
+                os.makedirs(cache_dir)
+            self.db = sqlite3.connect(cache_dir + "/sam-responses.db",
+                                      check_same_thread=False)
+            with self.db:
+                self.db.executescript(SCHEMA)
+                self.db.execute("DELETE FROM response WHERE expires <= ?",
+                                (time.time(),))
+
+    def get_ttl(self, path):
+        """Return the TTL of a path, or None if it is not cached"""
+        for pattern, secs in self.ttls:
+            if fnmatchcase(path, pattern):
+                return secs
+        return None
+
+    def get(self, path):
+        """Return (True, result) for a cached path, else (False, None)"""
+        if self.get_ttl(path) is None:
+            return (False, None)
+        now = time.time()
+        with self.lock:
+            entry = self.responses.get(path,None)
+            if entry is None and self.db is not None:
+                row = self.db.execute(
+                    "SELECT expires, data FROM response WHERE path = ?",
+                    (path,)).fetchone()
+                if row is not None:
+                    entry = (row[0], row[1])
+                    self.responses[path] = entry
+            if entry is not None and entry[0] <= now:
+                self._remove(path)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return (False, None)
+            result = json.loads(entry[1])
+            if _is_empty(result):
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return (True, result)
+
+    def put(self, path, result):
+        """Cache the result of a GET of path, if the path is cached"""
+        ttl = self.get_ttl(path)
+        if ttl is None:
+            return
+        if _is_empty(result):
+            ttl = min(ttl, self.negative_ttl)
+        if ttl <= 0:
+            return
+        now = time.time()
+        entry = (now + ttl, json.dumps(result))
+        with self.lock:
+            if now >= self.next_sweep:
+                self._evict_expired(now)
+            self.responses[path] = entry
+            if self.db is not None:
+                with self.db:
+                    self.db.execute(
+                        "INSERT INTO response (path, expires, data) " +\
+                        "VALUES (?, ?, ?) ON CONFLICT(path) DO UPDATE " +\
+                        "SET expires = excluded.expires, data = excluded.data",
+                        (path,) + entry)
+
+    def invalidate(self, path):
+        with self.lock:
+            self._remove(path)
+
+    def invalidate_matching(self, pattern):
+        """Invalidate all cached paths matching a shell-style pattern"""
+        with self.lock:
+            for path in [p for p in self.responses if fnmatchcase(p, pattern)]:
+                del self.responses[path]
+            if self.db is not None:
+                paths = [row[0] for row in \
+                         self.db.execute("SELECT path FROM response") \
+                         if fnmatchcase(row[0], pattern)]
+                with self.db:
+                    self.db.executemany("DELETE FROM response WHERE path = ?",
+                                        [(path,) for path in paths])
+
+    def _remove(self, path):
+        self.responses.pop(path,None)
+        if self.db is not None:
+            with self.db:
+                self.db.execute("DELETE FROM response WHERE path = ?",
+                                (path,))
+
+    def _evict_expired(self, now):
+        for path in [p for p, e in self.responses.items() if e[0] <= now]:
+            del self.responses[path]
+        if self.db is not None:
+            with self.db:
+                self.db.execute("DELETE FROM response WHERE expires <= ?",
+                                (now,))
+        self.next_sweep = now + SWEEP_INTERVAL
+
+    def get_stats(self):
+        """Return a dict of hit and miss counts"""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'entries': len(self.responses),
+            }
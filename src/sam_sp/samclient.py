@@ -1,45 +1,85 @@
-import os
-import json
-import requests
-from urllib.error import HTTPError
-from miscfuncs import truthy, to_expanded_string
+import json, time, threading
+from miscfuncs import to_expanded_string
 from spexception import (ServiceProviderTemporaryError, ServiceProviderError)
 from taskstatus import TaskStatus
 from sam_sp.peopledata import PeopleExternalOrg
-from sam_sp.samdata import InternalOrg, MnemonicCode
+from sam_sp.samdata import InternalOrg, InternalOrgDirectory, MnemonicCode
+from sam_sp.misc import RE_PUNCT, RE_WS
 from sam_sp.mnemonic import MnemonicCodeMaker
+from sam_sp.transport import Transport
+from sam_sp.metrics import url_template
 
-INTERNAL_ORGS = dict()
+INTERNAL_ORGS = InternalOrgDirectory()
 MNEMONIC_CODES = dict()
+# Mnemonic codes by case-folded description, and by case-folded description
+# with punctuation and repeated whitespace replaced by single spaces
+MNEMONIC_CODES_BY_DESCRIPTION = dict()
+MNEMONIC_CODES_BY_NORMALIZED_DESCRIPTION = dict()
 FOS_AOIS = dict
+# Reference data is reloaded when it is older than the SAMClient's
+# reference_data_ttl. *_UPDATED is the time the data was last loaded or found
+# to be unchanged, *_VALIDATORS hold the ETag and Last-Modified headers of the
+# last response, and each lock lets only one thread reload the data at a time
+INTERNAL_ORGS_UPDATED = 0
+INTERNAL_ORGS_VALIDATORS = dict()
+INTERNAL_ORGS_LOCK = threading.Lock()
 MNEMONIC_CODES_UPDATED = 0
-VERIFY_SSL = truthy(os.environ.get("VERIFY_SSL","true"))
+MNEMONIC_CODES_VALIDATORS = dict()
+MNEMONIC_CODES_LOCK = threading.Lock()
 
 
 class SAMClient(object):
 
     def __init__(self, url, user, password, tmout_secs, people_client,
-                 mnemonic_code_maker):
+                 mnemonic_code_maker, transport=None, reference_data_ttl=300,
+                 response_cache=None):
         if not url.endswith("/"):
             url = url + "/"
         self.url = url
 
         self.user = user
         self.password = password
-        self.session = requests.Session()
-        self.session.auth = (user, password)
-        self.tmout = int(tmout_secs)
+        self.auth = (user, password)
+        # The read timeout of SAM requests; it must allow for long polls of
+        # tasks/AMIE?maxWaitSecs=..., so it overrides the read timeout of the
+        # transport, which may be shared with other clients
+        self.tmout = float(tmout_secs)
+        if transport is None:
+            transport = Transport()
+        self.transport = transport
         self.people_client = people_client
         self.mnemonic_code_maker = mnemonic_code_maker
-
-    def _reconnect(self):
-        self.session = requests.Session()
-        self.session.auth = (self.user, self.password)
-        
+        # Seconds to reuse internal orgs and mnemonic codes before checking
+        # SAM for changes
+        self.reference_data_ttl = float(reference_data_ttl)
+        # If given, a ResponseCache of GET results for rarely-changing paths
+        self.response_cache = response_cache
 
     def get(self, path):
+        if self.response_cache is None:
+            return self._get(path)
+        hit, data = self.response_cache.get(path)
+        if not hit:
+            data = self._get(path)
+            self.response_cache.put(path, data)
+        return data
+
+    def invalidate_contracts(self):
+        """Drop cached contracts/... results
+
+        Call this when a contract has been added.
+        """
+        if self.response_cache is not None:
+            self.response_cache.invalidate_matching("contracts/*")
+
+    def get_response_cache_stats(self):
+        if self.response_cache is None:
+            return None
+        return self.response_cache.get_stats()
+
+    def _get(self, path):
         url = self._build_full_url(path)
-        result = self._try_get(url)
+        result = self._try_get(url, url_template(path))
 
         if result.status_code == 200:
             if result.text is None or result.text == '':
@@ -48,26 +88,40 @@ class SAMClient(object):
 
         self._raise_request_error("GET", url, result)
 
-    def _try_get(self, url):
-        global VERIFY_SSL
-        try:
-            result = self.session.get(url,
-                                      verify=VERIFY_SSL,
-                                      timeout=self.tmout)
-            
-        except requests.exceptions.Timeout as te:
-            raise ServiceProviderTemporaryError(te)
-        except HTTPError as http_err:
-            if http_err.response.status_code == 503:
-                raise ServiceProviderTemporaryError(http_err)
-            else:
-                raise http_err
-        
-        return result
+    def _get_if_changed(self, path, validators):
+        # Conditional GET; return None if SAM reports that the data has not
+        # changed since the response with the given validators, otherwise
+        # the data and the new validators
+        url = self._build_full_url(path)
+        headers = dict()
+        if 'ETag' in validators:
+            headers['If-None-Match'] = validators['ETag']
+        if 'Last-Modified' in validators:
+            headers['If-Modified-Since'] = validators['Last-Modified']
+        result = self.transport.get(url, headers=headers, auth=self.auth,
+                                    timeout=self.tmout,
+                                    template=url_template(path))
+
+        if result.status_code == 304:
+            return None
+        if result.status_code == 200:
+            new_validators = dict()
+            for name in ('ETag', 'Last-Modified'):
+                value = result.headers.get(name,None)
+                if value:
+                    new_validators[name] = value
+            return json.loads(result.text), new_validators
+
+        self._raise_request_error("GET", url, result)
+
+    def _try_get(self, url, template=None):
+        # Timeouts and repeated 503 results raise ServiceProviderTemporaryError
+        return self.transport.get(url, auth=self.auth, timeout=self.tmout,
+                                  template=template)
 
     def put(self, path, data):
         url = self._build_full_url(path)
-        result = self._try_put(url, data)
+        result = self._try_put(url, data, url_template(path))
 
         if result.status_code == 200:
             if result.text is None or result.text == '':
@@ -76,28 +130,18 @@ class SAMClient(object):
 
         self._raise_request_error("PUT", url, result)
 
-    def _try_put(self, url, data):
-        global VERIFY_SSL
+    def _try_put(self, url, data, template=None):
         headers = {
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         }
-        try:
-            result = self.session.put(url, data=data, headers=headers,
-                                      verify=VERIFY_SSL, timeout=self.tmout)
-        except requests.exceptions.Timeout as te:
-            raise ServiceProviderTemporaryError(te);
-        except HTTPError as http_err:
-            if http_err.response.status_code == 503:
-                raise ServiceProviderTemporaryError(http_err)
-            else:
-                raise http_err
-        
-        return result
+        return self.transport.put(url, data=data, headers=headers,
+                                  auth=self.auth, timeout=self.tmout,
+                                  template=template)
         
     def post(self, path, data):
         url = self._build_full_url(path)
-        result = self._try_post(url, data)
+        result = self._try_post(url, data, url_template(path))
 
         if result.status_code == 200:
             if result.text is None or result.text == '':
@@ -106,19 +150,15 @@ class SAMClient(object):
 
         self._raise_request_error("POST", url, result)
 
-    def _try_post(self, url, data):
-        global VERIFY_SSL
+    def _try_post(self, url, data, template=None):
+        # POST requests are not retried by the transport
         headers = {
             'Content-Type': 'application/json',
             'Accept': 'application/json'
         }
-        try:
-            result = self.session.post(url, data=data, headers=headers,
-                                       verify=VERIFY_SSL, timeout=self.tmout)
-        except requests.exceptions.Timeout as te:
-            raise ServiceProviderTemporaryError(te);
-
-        return result
+        return self.transport.post(url, data=data, headers=headers,
+                                   auth=self.auth, timeout=self.tmout,
+                                   template=template)
         
     def _raise_request_error(self, method, url, result):
         if result.status_code == 404:
@@ -130,13 +170,9 @@ class SAMClient(object):
                            " result:\n" + to_expanded_string(result.text))
 
     def _check_server_status(self):
-        global VERIFY_SSL
         url = self._build_full_url("status")
-        result = None
-        try:
-            result = self.session.get(url, verify=VERIFY_SSL)
-        except requests.exceptions.Timeout as te:
-            raise ServiceProviderTemporaryError(te);
+        result = self.transport.get(url, auth=self.auth, timeout=self.tmout,
+                                    template="status")
 
         if result.status_code == 404:
             de = RuntimeError("SAM service not (yet) available")
@@ -147,25 +183,26 @@ class SAMClient(object):
     def get_internal_org(self, org_id):
         global INTERNAL_ORGS
         # Organizations do not change often and cannot be changed via API
-        if not INTERNAL_ORGS:
-            self.load_internal_orgs()
+        self.refresh_internal_orgs()
         return INTERNAL_ORGS[org_id]
 
     def get_internal_org_by_acronym(self, acronym):
         """Retrieve internal org by acronym
         """
         global INTERNAL_ORGS
-        if not INTERNAL_ORGS:
-            self.load_internal_orgs()
-        for org in INTERNAL_ORGS.values():
-            if org['acronym'] == acronym:
-                return org
-        return None
+        self.refresh_internal_orgs()
+        return INTERNAL_ORGS.get_by_acronym(acronym)
+
+    def get_internal_org_ancestors(self, org_id):
+        """Return the parent, grandparent, etc. of an internal org
+        """
+        global INTERNAL_ORGS
+        self.refresh_internal_orgs()
+        return INTERNAL_ORGS.get_ancestors(org_id)
 
     def get_internal_orgs(self):
         global INTERNAL_ORGS
-        if not INTERNAL_ORGS:
-            self.load_internal_orgs()
+        self.refresh_internal_orgs()
         ids = sorted(INTERNAL_ORGS.keys())
         orgs = []
         for org_id in ids:
@@ -173,17 +210,40 @@ class SAMClient(object):
             orgs.append(org)
         return orgs
 
+    def refresh_internal_orgs(self):
+        """Load internal orgs if they are not loaded or older than the TTL
+        """
+        global INTERNAL_ORGS, INTERNAL_ORGS_UPDATED
+        if not self._is_stale(INTERNAL_ORGS, INTERNAL_ORGS_UPDATED):
+            return
+        with INTERNAL_ORGS_LOCK:
+            # Another thread may have reloaded the orgs while we waited
+            if self._is_stale(INTERNAL_ORGS, INTERNAL_ORGS_UPDATED):
+                self._load_internal_orgs()
+
     def load_internal_orgs(self):
-        global INTERNAL_ORGS
-        results = self.get("organization")
-        allorgs = dict()
+        with INTERNAL_ORGS_LOCK:
+            self._load_internal_orgs()
+
+    def _load_internal_orgs(self):
+        global INTERNAL_ORGS, INTERNAL_ORGS_UPDATED, INTERNAL_ORGS_VALIDATORS
+        validators = INTERNAL_ORGS_VALIDATORS if INTERNAL_ORGS else dict()
+        changed = self._get_if_changed("organization", validators)
+        INTERNAL_ORGS_UPDATED = time.time()
+        if changed is None:
+            return
+        results, validators = changed
+        allorgs = []
         for rec in results:
             internal_org = InternalOrg(rec)
             if not internal_org['active']:
                 continue
-            idx = int(internal_org['org_id'])
-            allorgs[idx] = internal_org
-        INTERNAL_ORGS = allorgs
+            allorgs.append(internal_org)
+        INTERNAL_ORGS = InternalOrgDirectory(allorgs)
+        INTERNAL_ORGS_VALIDATORS = validators
+
+    def _is_stale(self, data, updated):
+        return not data or time.time() - updated >= self.reference_data_ttl
 
     def get_mnemonic_code_for_org(self, acronym):
         mc, desc, active = self._get_mnemonic_data_for_org(acronym)
@@ -237,19 +297,21 @@ class SAMClient(object):
         return code, desc, active
 
     def _get_mnemonic_code_by_description(self, desc):
-        if not MNEMONIC_CODES:
-            self.load_mnemonic_codes()
-        lcdesc = desc.lower()
-        for mc in MNEMONIC_CODES:
-            mobj = MNEMONIC_CODES[mc]
-            if mobj['description'].lower() == lcdesc:
-                return mobj
-        return None
+        global MNEMONIC_CODES, MNEMONIC_CODES_BY_DESCRIPTION, \
+            MNEMONIC_CODES_BY_NORMALIZED_DESCRIPTION
+        self.refresh_mnemonic_codes()
+        mobj = MNEMONIC_CODES_BY_DESCRIPTION.get(desc.casefold(),None)
+        if mobj is None:
+            mobj = MNEMONIC_CODES_BY_NORMALIZED_DESCRIPTION.get(
+                self._normalize_description(desc),None)
+        return mobj
+
+    def _normalize_description(self, desc):
+        return RE_WS.sub(' ',RE_PUNCT.sub(' ',desc.casefold())).strip()
     
     def get_mnemonic_codes(self):
         global MNEMONIC_CODES
-        if not MNEMONIC_CODES:
-            self.load_mnemonic_codes()
+        self.refresh_mnemonic_codes()
         codes = sorted(MNEMONIC_CODES.keys())
         mnemonic_codes = []
         for code in codes:
@@ -258,7 +320,7 @@ class SAMClient(object):
         return mnemonic_codes
 
     def build_mnemonic_code_choices(self, site_org, org_code):
-        self.load_mnemonic_codes()
+        self.refresh_mnemonic_codes()
         return self._build_mnemonic_code_choices(site_org, org_code)
 
     def _build_mnemonic_code_choices(self, site_org, org_code):
@@ -311,12 +373,12 @@ class SAMClient(object):
         return choices
 
     def suggest_mnemonic_codes(self, desc):
-        self.load_mnemonic_codes()
+        self.refresh_mnemonic_codes()
         maker = self.mnemonic_code_maker
         return maker.make_suggestions(MNEMONIC_CODES, desc)
         
     def suggest_mnemonic_codes_for_org(self, acronym):
-        self.load_mnemonic_codes()
+        self.refresh_mnemonic_codes()
         code = self.get_mnemonic_code_for_org(acronym)
         if code is not None:
             raise RuntimeError("org has mnemonic code: "+str(acronym)+"->"+code)
@@ -328,7 +390,7 @@ class SAMClient(object):
         return suggestions
 
     def suggest_mnemonic_codes_for_inst(self, org_id):
-        self.load_mnemonic_codes()
+        self.refresh_mnemonic_codes()
         code = self.get_mnemonic_code_for_inst(org_id)
         if code is not None:
             raise RuntimeError("inst has mnemonic code: "+str(org_id)+"->"+code)
@@ -339,15 +401,57 @@ class SAMClient(object):
         desc = name + ', ' + city
         return maker.make_suggestions(MNEMONIC_CODES, desc)
 
+    def refresh_mnemonic_codes(self):
+        """Load mnemonic codes if they are not loaded or older than the TTL
+        """
+        global MNEMONIC_CODES, MNEMONIC_CODES_UPDATED
+        if not self._is_stale(MNEMONIC_CODES, MNEMONIC_CODES_UPDATED):
+            return
+        with MNEMONIC_CODES_LOCK:
+            # Another thread may have reloaded the codes while we waited
+            if self._is_stale(MNEMONIC_CODES, MNEMONIC_CODES_UPDATED):
+                self._load_mnemonic_codes()
+
+    def invalidate_mnemonic_codes(self):
+        """Force the next refresh_mnemonic_codes() to download all codes
+
+        Call this when a mnemonic code has been added or changed.
+        """
+        global MNEMONIC_CODES_UPDATED, MNEMONIC_CODES_VALIDATORS
+        with MNEMONIC_CODES_LOCK:
+            MNEMONIC_CODES_UPDATED = 0
+            MNEMONIC_CODES_VALIDATORS = dict()
+
     def load_mnemonic_codes(self):
-        global MNEMONIC_CODES
-        results = self.get("mnemoniccode")
+        with MNEMONIC_CODES_LOCK:
+            self._load_mnemonic_codes()
+
+    def _load_mnemonic_codes(self):
+        global MNEMONIC_CODES, MNEMONIC_CODES_BY_DESCRIPTION, \
+            MNEMONIC_CODES_BY_NORMALIZED_DESCRIPTION, \
+            MNEMONIC_CODES_UPDATED, MNEMONIC_CODES_VALIDATORS
+        validators = MNEMONIC_CODES_VALIDATORS if MNEMONIC_CODES else dict()
+        changed = self._get_if_changed("mnemoniccode", validators)
+        MNEMONIC_CODES_UPDATED = time.time()
+        if changed is None:
+            return
+        results, validators = changed
         allcodes = dict()
+        by_description = dict()
+        by_normalized_description = dict()
         for rec in results:
             mnemonic_code = MnemonicCode(rec)
             code = mnemonic_code['code']
             allcodes[code] = mnemonic_code
+            # If descriptions collide, the first code wins
+            desc = mnemonic_code['description']
+            by_description.setdefault(desc.casefold(),mnemonic_code)
+            by_normalized_description.setdefault(
+                self._normalize_description(desc),mnemonic_code)
         MNEMONIC_CODES = allcodes
+        MNEMONIC_CODES_BY_DESCRIPTION = by_description
+        MNEMONIC_CODES_BY_NORMALIZED_DESCRIPTION = by_normalized_description
+        MNEMONIC_CODES_VALIDATORS = validators
 
     def _build_full_url(self, path):
         while path.startswith("/"):
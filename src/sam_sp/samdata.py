@@ -11,6 +11,65 @@ class InternalOrg(dict):
         kval['parent_org_id'] = kwargs.get('parentOrgId',None)
         dict.__init__(self, **kval)
 
+class InternalOrgDirectory(dict):
+
+    def __init__(self, orgs=()) -> dict:
+        """InternalOrgs keyed by org id, with acronym and parent indexes
+
+        The indexes and each org's chain of ancestors are built once, when the
+        directory is created; the directory should be replaced rather than
+        modified.
+        """
+        dict.__init__(self)
+        self.by_acronym = dict()
+        self.children = dict()
+        for org in orgs:
+            org_id = int(org['org_id'])
+            self[org_id] = org
+            # If acronyms collide, the first org wins
+            self.by_acronym.setdefault(org['acronym'],org)
+        for org_id, org in self.items():
+            parent_id = org['parent_org_id']
+            if parent_id is not None:
+                self.children.setdefault(int(parent_id),[]).append(org)
+        self.ancestors = dict()
+        for org_id in self.keys():
+            self._build_ancestors(org_id)
+
+    def get_by_acronym(self, acronym):
+        return self.by_acronym.get(acronym,None)
+
+    def get_children(self, org_id):
+        """Return the orgs whose parent is the given org"""
+        return self.children.get(org_id,[])
+
+    def get_ancestors(self, org_id):
+        """Return the parent, grandparent, etc. of the given org"""
+        return self.ancestors.get(org_id,())
+
+    def _build_ancestors(self, org_id):
+        # Walk up from org_id until reaching an org whose ancestors are known,
+        # a top-level org, a parent that is not in the directory (e.g. because
+        # it is inactive) or a cycle, then fill in the chains on the way down
+        path = []
+        seen = set()
+        curr_id = org_id
+        while curr_id not in self.ancestors and curr_id not in seen:
+            seen.add(curr_id)
+            path.append(curr_id)
+            parent_id = self[curr_id]['parent_org_id']
+            if parent_id is None or int(parent_id) not in self:
+                break
+            curr_id = int(parent_id)
+        chain = self.ancestors.get(curr_id,())
+        if curr_id in self.ancestors:
+            chain = (self[curr_id],) + chain
+        for path_id in reversed(path):
+            if path_id not in self.ancestors:
+                self.ancestors[path_id] = chain
+            chain = (self[path_id],) + chain
+        return self.ancestors[org_id]
+
 class AMIEPerson(dict):
 
     def __init__(self, kwargs) -> dict:
@@ -13,6 +13,9 @@ from sam_sp.samclient import SAMClient
 from sam_sp.datamapper import map_data
 from sam_sp.task import TaskService
 from sam_sp.mnemonic import MnemonicCodeMaker
+from sam_sp.transport import Transport
+from sam_sp.metrics import RequestMetrics
+from sam_sp.responsecache import ResponseCache, DEFAULT_TTLS
 
 class ServiceProvider(ServiceProviderIF):
     """SAM implementation of a ServiceProvider
@@ -36,25 +39,70 @@ class ServiceProvider(ServiceProviderIF):
         self.active_tasks = None
     
     def apply_config(self, config):
+        # SAM and PeopleDB requests share one pooled HTTP transport, which
+        # records per-endpoint metrics
+        self.http_metrics = RequestMetrics()
+        self.transport = Transport(
+            float(config.get('http_connect_timeout',10)),
+            float(config.get('http_read_timeout',120)),
+            int(config.get('http_pool_maxsize',10)),
+            int(config.get('http_max_retries',2)),
+            float(config.get('http_retry_backoff',0.5)),
+            float(config.get('http_retry_backoff_max',8)),
+            int(config.get('http_breaker_failures',5)),
+            float(config.get('http_breaker_reset_secs',60)),
+            self.logger,
+            self.http_metrics
+        )
+        http_metrics_dir = config.get('http_metrics_dir',None)
+        if http_metrics_dir:
+            self.http_metrics.start_export(
+                http_metrics_dir,
+                float(config.get('http_metrics_interval',60)),
+                config.get('http_metrics_format','prometheus'),
+                self.logger)
         self.people_client = PeopleClient(
             config['people_url'],
             config['people_user'],
             config['people_password'],
-            self.logger
+            self.logger,
+            config.get('people_match_engine','regex'),
+            int(config.get('people_max_org_matches',25)),
+            int(config.get('people_page_size',5000)),
+            int(config.get('people_load_parallelism',4)),
+            int(config.get('people_org_refresh_interval',3600)),
+            self.transport
         )
         self.mnemonic_code_maker = MnemonicCodeMaker(
             int(config['sam_mnem_code_suggestions_min']),
             int(config['sam_mnem_code_suggestions_max'])
         )
+        self.response_cache = ResponseCache(
+            config.get('sam_response_cache_ttls',DEFAULT_TTLS),
+            float(config.get('sam_response_cache_negative_ttl',60)),
+            config.get('sam_response_cache_dir',None) or None
+        )
         self.sam_client = SAMClient(
             config['sam_url'],
             config['sam_user'],
             config['sam_password'],
             int(config['pause_max']),
             self.people_client,
-            self.mnemonic_code_maker
+            self.mnemonic_code_maker,
+            self.transport,
+            float(config.get('sam_reference_data_ttl',300)),
+            self.response_cache
+        )
+        self.http_metrics.add_stats('response_cache',
+                                    self.sam_client.get_response_cache_stats)
+        self.task_service = TaskService(
+            self.sam_client,
+            self.people_client,
+            int(config.get('sam_task_concurrency',8)),
+            float(config.get('sam_task_deadline',60)),
+            float(config.get('sam_revisit_interval_min',5)),
+            float(config.get('sam_revisit_interval_max',300))
         )
-        self.task_service = TaskService(self.sam_client,self.people_client)
 
     def get_local_task_name(self, method_name, kwargs) -> str:
         self.logdumper.debug("Looking up task name for "+method_name,kwargs)
@@ -226,17 +274,19 @@ class ServiceProvider(ServiceProviderIF):
         
 
     def lookup_project_name_base(self, *args, **kwargs) -> str:
-        # The people_client load_internal_orgs() and load_external_orgs()
+        # The people_client refresh_internal_orgs() and refresh_external_orgs()
         # functions will populate local caches used by get_cached_internal_org()
         # and get_cached_org_by_nsf_code(), respectively. The sam_client
-        # load_mnemonic_codes() will populate a local cache used by
-        # get_mnemonic_code_by_description(); call the load*() functions to
-        # make sure the caches have the latest data. Note that this function
-        # is always called before choose_or_add_project_name_base(), so the
-        # latter can rely on caches being current.
-        self.people_client.load_internal_orgs()
-        self.people_client.load_external_orgs()
-        self.sam_client.load_mnemonic_codes()
+        # refresh_mnemonic_codes() will populate a local cache used by
+        # get_mnemonic_code_by_description(); call the refresh*() functions to
+        # make sure the caches are loaded and reasonably current (the caches
+        # are only reloaded when their data is older than the configured
+        # interval or TTL). Note that this function is always called before
+        # choose_or_add_project_name_base(), so the latter can rely on the
+        # caches being loaded.
+        self.people_client.refresh_internal_orgs()
+        self.people_client.refresh_external_orgs()
+        self.sam_client.refresh_mnemonic_codes()
 
         site_org = kwargs.get('site_org',None)
         org_code = kwargs.get('PiOrgCode',None)
@@ -261,7 +311,8 @@ class ServiceProvider(ServiceProviderIF):
         # See comments at start of lookup_project_name_base(). We will assume
         # that lookup_project_name_base will always be called before
         # choose_or_add_project_name_base(), so the mnemonic codes cache should
-        # be up-to-date
+        # be loaded; build_mnemonic_code_choices() reuses it unless it is
+        # older than the TTL
         site_org = kwargs.get('site_org',None)
         org_code = kwargs.get('PiOrgCode',None)
         choices = self.sam_client.build_mnemonic_code_choices(site_org,
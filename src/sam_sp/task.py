@@ -1,5 +1,7 @@
-import json
+import json, time, heapq
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from bisect import bisect_left, bisect_right
 from misctypes import TimeUtil
 from miscfuncs import to_expanded_string
 from logdumper import LogDumper
@@ -57,13 +59,14 @@ class SAMTask(object):
     def __init__(self, task_data):
         self.key = SAMTask.get_key(task_data)
         self.state = task_data['task_state']
-        ts = task_data['timestamp']
-        self.timestamp = SAMTask.timeutil.timestamp_to_isoformat(ts/1000)
+        # Milliseconds since the epoch
+        self.timestamp = int(task_data['timestamp'])
         self.task = task_data
         self.task_status = None
         
     def __str__(self):
-        return self.key + '(' + self.state + ')@' + self.timestamp
+        return self.key + '(' + self.state + ')@' + \
+            SAMTask.timeutil.timestamp_to_isoformat(self.timestamp/1000)
 
     @staticmethod
     def get_key(task_data, task_name=None):
@@ -74,23 +77,41 @@ class SAMTask(object):
 
 class SAMTaskCache(dict):
     def __init__(self, *args, **kwargs):
-        dict.__init__(self,**kwargs)
+        """SAMTasks keyed by SAMTask key, indexed by state and timestamp
 
+        The indexes are maintained by update(); tasks should not be added or
+        removed directly.
+        """
+        dict.__init__(self,**kwargs)
+        # state -> {key: SAMTask}
+        self.by_state = dict()
+        # Parallel lists of task timestamps and keys, sorted by timestamp
+        self.timestamps = []
+        self.timestamp_keys = []
 
     def update(self, task_data) -> SAMTask:
         # argument can be SAMTask or task dict
         if isinstance(task_data, dict):
             task = SAMTask(task_data)
         else:
-            task = task_or_list
+            task = task_data
 
         key = task.key
         state = task.state
-        if state == 'cleared':
-            if key in self.keys():
-                del self[key]
-        else:
+        old_task = self.get(key, None)
+        if old_task is not None and old_task.state == state and \
+           old_task.timestamp == task.timestamp:
+            # Unchanged position in the indexes
+            self[key] = task
+            self.by_state[state][key] = task
+            return task
+        self._remove(key)
+        if state != 'cleared':
             self[key] = task
+            self.by_state.setdefault(state,dict())[key] = task
+            i = bisect_right(self.timestamps, task.timestamp)
+            self.timestamps.insert(i, task.timestamp)
+            self.timestamp_keys.insert(i, key)
 
         return task
 
@@ -99,19 +120,130 @@ class SAMTaskCache(dict):
         if isinstance(task_data, dict):
             key = SAMTask.get_key(task_data, task_name)
         else:
-            key = task.key
+            key = task_data.key
             
         return self.get(key, None)
 
+    def get_tasks_for_state(self, state) -> list:
+        """Return the SAMTasks in a given state, sorted by timestamp"""
+        tasks = list(self.by_state.get(state,dict()).values())
+        tasks.sort(key=lambda t: t.timestamp)
+        return tasks
+
+    def get_tasks_since(self, since) -> list:
+        """Return the SAMTasks changed after since, sorted by timestamp
+
+        :param since: Milliseconds since the epoch, or None for all tasks
+        :type since: int or None
+        """
+        if since is None:
+            return [self[key] for key in self.timestamp_keys]
+        i = bisect_right(self.timestamps, since)
+        return [self[key] for key in self.timestamp_keys[i:]]
+
+    def _remove(self, key):
+        old_task = self.pop(key, None)
+        if old_task is None:
+            return
+        bucket = self.by_state[old_task.state]
+        del bucket[key]
+        if not bucket:
+            del self.by_state[old_task.state]
+        i = bisect_left(self.timestamps, old_task.timestamp)
+        while self.timestamp_keys[i] != key:
+            i += 1
+        del self.timestamps[i]
+        del self.timestamp_keys[i]
+
+class RevisitScheduler(object):
+
+    def __init__(self, min_interval=5, max_interval=300):
+        """Schedule of revisits of 'syncing' tasks
+
+        A task is due as soon as it is first seen. Each time it is taken for
+        a revisit, it is rescheduled after an interval that starts at
+        min_interval seconds and doubles with each revisit, up to
+        max_interval. The interval is reset, and the task is due again at
+        once, when the task's SAM timestamp changes other than as a result of
+        a revisit.
+        """
+        self.min_interval = float(min_interval)
+        self.max_interval = float(max_interval)
+        # key -> [due time, interval, SAM timestamp]
+        self.entries = dict()
+        # (due time, key); entries whose due time no longer matches
+        # self.entries are skipped
+        self.heap = []
+
+    def observe(self, st):
+        """Add a syncing SAMTask, or reset it if its timestamp has changed
+        """
+        entry = self.entries.get(st.key,None)
+        if entry is None or entry[2] != st.timestamp:
+            self._schedule(st.key, time.time(), self.min_interval,
+                           st.timestamp)
+
+    def record(self, st):
+        """Note the timestamp of a SAMTask returned by a revisit"""
+        entry = self.entries.get(st.key,None)
+        if entry is None:
+            self.observe(st)
+        else:
+            entry[2] = st.timestamp
+
+    def take_due(self):
+        """Return the keys of tasks that are due, and reschedule them"""
+        now = time.time()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due_time, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key,None)
+            if entry is None or entry[0] != due_time:
+                continue
+            due.append(key)
+        for key in due:
+            entry = self.entries[key]
+            interval = entry[1]
+            self._schedule(key, now + interval,
+                           min(2 * interval, self.max_interval), entry[2])
+        return due
+
+    def forget(self, key):
+        self.entries.pop(key,None)
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(entry[0], key) for key, entry \
+                         in self.entries.items()]
+            heapq.heapify(self.heap)
+
+    def _schedule(self, key, due_time, interval, timestamp):
+        self.entries[key] = [due_time, interval, timestamp]
+        heapq.heappush(self.heap, (due_time, key))
+
 class TaskService(object):
 
-    def __init__(self, sam_client, people_client):
+    def __init__(self, sam_client, people_client, max_workers=8,
+                 task_deadline=60, revisit_min_interval=5,
+                 revisit_max_interval=300):
         """Manager for "tasks" processed by the SAM service provider
 
         :param sam_client: SAM client
         :type sam_client: SAMClient
         :param people_client: PeopleSearch client
         :type people_client: PeopleClient
+        :param max_workers: Maximum number of tasks to delegate or revisit
+            concurrently
+        :type max_workers: int
+        :param task_deadline: Seconds after which get_tasks() stops waiting
+            for a delegation or revisit (0 for no limit); the task is not
+            started again while it is running, and its result is applied by a
+            later get_tasks()
+        :type task_deadline: float
+        :param revisit_min_interval: Seconds between the first and second
+            revisits of a 'syncing' task; the interval doubles with each
+            revisit
+        :type revisit_min_interval: float
+        :param revisit_max_interval: Maximum seconds between revisits
+        :type revisit_max_interval: float
         """
 
         self.sam_client = sam_client
@@ -120,6 +252,14 @@ class TaskService(object):
         self.logdumper = LogDumper(self.logger)
         self.timeutil = TimeUtil()
         self.task_cache = SAMTaskCache()
+        self.max_workers = max(1,int(max_workers))
+        self.task_deadline = float(task_deadline)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                           thread_name_prefix="sam-task")
+        # task key -> [Future, task dict, start time or None]
+        self.in_flight = dict()
+        self.revisit_scheduler = RevisitScheduler(revisit_min_interval,
+                                                  revisit_max_interval)
 
     def lookup_task_status(self, task_name, packet_dict):
         st = self.task_cache.lookup(packet_dict, task_name)
@@ -200,12 +340,29 @@ class TaskService(object):
         self.logger.debug("get_tasks:")
 
         for task in tasks:
+            prev_st = self.task_cache.lookup(task)
             st = self.task_cache.update(task)
             self.logger.debug("  %s",st)
+            self._check_reference_data(prev_st, st)
 
         updated_tasks = self._process_cached_tasks(start_time, wait, since)
         return updated_tasks
 
+    def _check_reference_data(self, prev_st, st):
+        # A successful choose_or_add_mnemonic_code or choose_or_add_contract
+        # task may have added a mnemonic code or contract, so the cached
+        # codes or contracts must be downloaded again
+        if st.state != 'successful' or \
+           (prev_st is not None and prev_st.state == 'successful'):
+            return
+        task_name = st.task['task_name']
+        if task_name == 'choose_or_add_mnemonic_code':
+            self.logger.debug("  invalidating cached mnemonic codes")
+            self.sam_client.invalidate_mnemonic_codes()
+        elif task_name == 'choose_or_add_contract':
+            self.logger.debug("  invalidating cached contracts")
+            self.sam_client.invalidate_contracts()
+
     def _get_tasks_from_SAM(self, active, wait, since) -> list:
         parms  = []
         if active:
@@ -246,59 +403,159 @@ class TaskService(object):
 
     def _process_cached_tasks(self, start_time, wait, since):
 
-        cached_tasks = list(self.task_cache.values())
-        cached_tasks.sort(key=lambda t: t.timestamp)
-
         delegated_tasks = self._get_cached_tasks_for_state('delegated')
         self._delegate_tasks(delegated_tasks)
 
-        syncing_tasks = self._get_cached_tasks_for_state('syncing')
+        syncing_tasks = self._get_syncing_tasks_due()
 
         if syncing_tasks:
             self._revisit_tasks(syncing_tasks)
 
-        cached_tasks = list(self.task_cache.values())
-        cached_tasks.sort(key=lambda t: t.timestamp)
-
-        if since is None:
-            iso_since = ""
-        else:
-            iso_since = self.timeutil.timestamp_to_isoformat(since/1000)
+        if since is not None:
+            since = int(since)
 
         updated_tasks = list()
-        for st in cached_tasks:
-            if st.timestamp > iso_since:
-                updated_tasks.append(st.task)
+        for st in self.task_cache.get_tasks_since(since):
+            updated_tasks.append(st.task)
 
         return updated_tasks
 
     def _get_cached_tasks_for_state(self, target_state):
         tasks = list()
-        for st in self.task_cache.values():
-            state = st.state
-            if state == target_state:
-                tasks.append(st.task)
+        for st in self.task_cache.get_tasks_for_state(target_state):
+            tasks.append(st.task)
         return tasks
    
+    def _get_syncing_tasks_due(self):
+        # Syncing tasks are revisited on a backoff schedule rather than on
+        # every poll; see RevisitScheduler
+        scheduler = self.revisit_scheduler
+        for st in self.task_cache.get_tasks_for_state('syncing'):
+            scheduler.observe(st)
+        tasks = list()
+        for key in scheduler.take_due():
+            st = self.task_cache.get(key, None)
+            if st is None or st.state != 'syncing':
+                scheduler.forget(key)
+            else:
+                tasks.append(st.task)
+        return tasks
+
     def _delegate_tasks(self, delegated_tasks):
         if delegated_tasks:
             self.logger.debug("_delegate_tasks:")
-            for task in delegated_tasks:
-                self._delegate_task(task)
+            self._run_tasks(self._delegate_task, delegated_tasks)
         
     def _delegate_task(self, task):
-        start_st = self.task_cache.lookup(task)
         taskname = task['task_name']
         if taskname == "choose_or_add_institution":
             updated_task = self._choose_or_add_institution(task)
         else:
             updated_task = self._change_SAM_task_state_to_syncing(task)
-        
+        return updated_task
+
+    def _run_tasks(self, func, tasks):
+        # Run func(task), which returns the updated task dict, for each task
+        # in the service's pool of threads. The task cache is only updated in
+        # this thread. A task that is still running from an earlier call is
+        # not submitted again. This call stops waiting for a task
+        # task_deadline seconds after it starts; the task keeps running and
+        # its result is applied by the first call after it is done. If any
+        # func() submitted by this call raises an exception, the first one is
+        # re-raised after the other results have been applied.
+        self._apply_finished_tasks()
+
+        futures = dict()
+        for task in tasks:
+            key = SAMTask.get_key(task)
+            if key in self.in_flight:
+                self.logger.debug("  %s still running", key)
+                continue
+            entry = [None, task, None]
+            entry[0] = self.executor.submit(self._run_task, func, entry)
+            self.in_flight[key] = entry
+            futures[entry[0]] = key
+
+        error = None
+        pending = set(futures)
+        while pending:
+            timeout = self._get_next_deadline(futures, pending)
+            done, pending = wait(pending, timeout=timeout,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                e = self._finish_task(futures[future])
+                if error is None:
+                    error = e
+            if self.task_deadline > 0:
+                now = time.time()
+                for future in list(pending):
+                    key = futures[future]
+                    started = self.in_flight[key][2]
+                    if started is not None and \
+                       now - started >= self.task_deadline:
+                        self.logger.warning(
+                            "Task " + key + " not done after " + \
+                            str(self.task_deadline) + "s; leaving it running")
+                        pending.discard(future)
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _run_task(func, entry):
+        entry[2] = time.time()
+        return func(entry[1])
+
+    def _apply_finished_tasks(self):
+        # Apply the results of tasks left running by earlier calls
+        for key, entry in list(self.in_flight.items()):
+            if entry[0].done():
+                error = self._finish_task(key)
+                if error is not None:
+                    self.logger.warning("Task " + key + " failed: " + \
+                                        str(error))
+
+    def _finish_task(self, key):
+        # Remove a done task from in_flight and apply its result; return the
+        # exception it raised, if any
+        future, task, started = self.in_flight.pop(key)
+        try:
+            updated_task = future.result()
+        except Exception as e:
+            return e
+        self._apply_task_update(task, updated_task)
+        return None
+
+    def _get_next_deadline(self, futures, pending):
+        # Seconds until the earliest deadline of a started pending task, or
+        # the full deadline if none has started yet
+        if self.task_deadline <= 0:
+            return None
+        starts = [self.in_flight[futures[f]][2] for f in pending]
+        starts = [t for t in starts if t is not None]
+        if not starts:
+            return self.task_deadline
+        return max(0, min(starts) + self.task_deadline - time.time())
+
+    def _apply_task_update(self, task, updated_task):
+        start_st = self.task_cache.lookup(task)
+        if start_st is not None and \
+           int(updated_task['timestamp']) < start_st.timestamp:
+            # A late result, superseded by a newer copy from SAM
+            self.logger.debug("  %s: ignoring older result", start_st)
+            return
         st = self.task_cache.update(updated_task)
         self.logger.debug("  %s -> %s", start_st, st)
+        # A revisit may be the first to see a task succeed
+        self._check_reference_data(start_st, st)
+        if st.state == 'syncing':
+            self.revisit_scheduler.record(st)
+        else:
+            self.revisit_scheduler.forget(st.key)
 
     def _choose_or_add_institution(self, task):
-        task['timestamp'] = self.timeutil.timestamp()*1000
+        # This runs in a worker thread (see _run_tasks()), and task is the
+        # dict held by the task cache, so it is copied before it is changed
+        task = dict(task, timestamp=int(self.timeutil.timestamp()*1000))
 
         ts = TaskStatus(task)
         org_id = ts.get_product_value('external_org_id')
@@ -338,12 +595,9 @@ class TaskService(object):
     def _revisit_tasks(self, tasks):
         self.logger.debug("_revisit_tasks:")
 
-        for task in tasks:
-            self._revisit_task(task)
+        self._run_tasks(self._revisit_task, tasks)
     
     def _revisit_task(self, task):
-        start_st = self.task_cache.lookup(task)
-
         task_key = SAMTask.get_key(task)
         url = 'tasks/AMIE/' + task_key
         request = map_data('APacket','SAMRequest', task)
@@ -357,8 +611,6 @@ class TaskService(object):
         self.logdumper.debug("PUT result:",result)
 
         updated_task = self._convert_result(result, task)
-        st = self.task_cache.update(updated_task)
-        self.logger.debug("  %s -> %s", start_st, st)
-        return
+        return updated_task
         
     
@@ -0,0 +1,228 @@
+import os, time, random, threading
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from miscfuncs import truthy
+from spexception import ServiceProviderTemporaryError
+
+VERIFY_SSL = truthy(os.environ.get("VERIFY_SSL","true"))
+
+# Methods that can be safely repeated if a request fails
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# Status codes that indicate a temporary problem with the server (or a proxy
+# in front of it); requests with these results are retried
+RETRY_STATUS_CODES = (502, 503, 504)
+
+class CircuitBreaker(object):
+
+    def __init__(self, failure_threshold=5, reset_secs=60):
+        """Fail fast after repeated failures of requests to one host
+
+        After failure_threshold consecutive failures the breaker "opens", and
+        requests fail immediately until reset_secs have passed. The next
+        request is then allowed through; if it succeeds the breaker closes,
+        otherwise it opens again.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_secs = reset_secs
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if time.time() - self.opened_at >= self.reset_secs:
+            # Let one trial request through
+            self.opened_at = time.time()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failure_threshold > 0 and \
+           self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+
+
+class Transport(object):
+
+    def __init__(self, connect_timeout=10, read_timeout=120, pool_maxsize=10,
+                 max_retries=2, retry_backoff=0.5, retry_backoff_max=8,
+                 breaker_failures=5, breaker_reset_secs=60, logger=None,
+                 metrics=None):
+        """Pooled HTTP transport with timeouts, retries and circuit breakers
+
+        A single Transport can be shared by several clients; credentials are
+        given with each request. Requests with idempotent methods are retried
+        after connection errors (including connect timeouts) and 502/503/504
+        results, with jittered exponential backoff. Read timeouts are not
+        retried: the server may still be working on the request, and a
+        retry could wait for read_timeout again. Each host has its own
+        circuit breaker.
+
+        Errors that persist after all retries, and requests refused by an open
+        circuit breaker, raise ServiceProviderTemporaryError.
+
+        :param connect_timeout: Seconds to wait for a connection
+        :type connect_timeout: float
+        :param read_timeout: Seconds to wait for data from the server
+        :type read_timeout: float
+        :param pool_maxsize: Maximum connections kept per host
+        :type pool_maxsize: int
+        :param max_retries: Maximum retries of an idempotent request
+        :type max_retries: int
+        :param retry_backoff: Backoff before the first retry, in seconds; it
+            doubles with each retry
+        :type retry_backoff: float
+        :param retry_backoff_max: Maximum backoff, in seconds
+        :type retry_backoff_max: float
+        :param breaker_failures: Consecutive failures that open a host's
+            circuit breaker (0 to never open)
+        :type breaker_failures: int
+        :param breaker_reset_secs: Seconds a circuit breaker stays open
+        :type breaker_reset_secs: float
+        :param metrics: If given, per-endpoint metrics are recorded here
+        :type metrics: sam_sp.metrics.RequestMetrics
+        """
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.pool_maxsize = int(pool_maxsize)
+        self.max_retries = int(max_retries)
+        self.retry_backoff = float(retry_backoff)
+        self.retry_backoff_max = float(retry_backoff_max)
+        self.breaker_failures = int(breaker_failures)
+        self.breaker_reset_secs = float(breaker_reset_secs)
+        self.logger = logger
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.breakers = dict()
+        self.session = self._make_session()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, timeout=None, template=None, **kwargs):
+        """Send a request and return the requests.Response
+
+        timeout may be a read timeout or a (connect, read) tuple; the
+        Transport's timeouts are used by default. template is the URL template
+        under which metrics are recorded (the URL path by default). Other
+        keyword arguments (e.g. auth, data, headers) are passed to requests.
+        """
+        global VERIFY_SSL
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        elif not isinstance(timeout, tuple):
+            timeout = (self.connect_timeout, float(timeout))
+        kwargs.setdefault('verify', VERIFY_SSL)
+        host = urlsplit(url).netloc
+        if template is None:
+            template = urlsplit(url).path
+        data = kwargs.get('data',None)
+        bytes_out = len(data) if isinstance(data, (str, bytes)) else 0
+        retries = self.max_retries if method in IDEMPOTENT_METHODS else 0
+        attempt = 0
+        while True:
+            self._check_breaker(host, method, url)
+            start = time.time()
+            error = None
+            retryable = True
+            result = None
+            try:
+                result = self.session.request(method, url, timeout=timeout,
+                                              **kwargs)
+            except requests.exceptions.ConnectionError as ce:
+                # Includes connect timeouts. The session is kept: the pool
+                # discards a broken connection, and checks pooled connections
+                # before reusing them
+                error = ce
+            except requests.exceptions.Timeout as te:
+                # A read timeout
+                error = te
+                retryable = False
+            failed = error is not None or \
+                result.status_code in RETRY_STATUS_CODES
+            secs = time.time() - start
+            self._record_breaker(host, failed)
+            if self.metrics is not None:
+                if result is None:
+                    self.metrics.record(host, method, template, secs, 'error',
+                                        bytes_out)
+                else:
+                    self.metrics.record(host, method, template, secs,
+                                        result.status_code, bytes_out,
+                                        len(result.content))
+
+            if not failed:
+                return result
+            if error is None and method not in IDEMPOTENT_METHODS:
+                # The request may have been processed; leave it to the caller
+                # to decide what to do
+                return result
+            if attempt >= retries or not retryable:
+                if error is not None:
+                    raise ServiceProviderTemporaryError(error)
+                raise ServiceProviderTemporaryError(
+                    RuntimeError(method + " " + url + " returned " + \
+                                 str(result.status_code)))
+            attempt += 1
+            if self.metrics is not None:
+                self.metrics.record_retry(host, method, template)
+            delay = self._get_backoff(attempt)
+            if self.logger is not None:
+                reason = str(error) if error is not None else \
+                    "status " + str(result.status_code)
+                self.logger.debug("Retrying " + method + " " + url + \
+                                  " in " + format(delay,'.2f') + "s: " + reason)
+            time.sleep(delay)
+
+    def _get_backoff(self, attempt):
+        # "Full jitter": a random delay up to the exponential backoff, so
+        # clients that failed together do not retry together
+        cap = min(self.retry_backoff_max,
+                  self.retry_backoff * (2 ** (attempt - 1)))
+        return random.uniform(0, cap)
+
+    def _check_breaker(self, host, method, url):
+        with self.lock:
+            breaker = self._get_breaker(host)
+            allowed = breaker.allow()
+        if not allowed:
+            raise ServiceProviderTemporaryError(
+                RuntimeError("Circuit breaker open for " + host + \
+                             "; not sending " + method + " " + url))
+
+    def _record_breaker(self, host, failed):
+        with self.lock:
+            breaker = self._get_breaker(host)
+            if failed:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+
+    def _get_breaker(self, host):
+        breaker = self.breakers.get(host,None)
+        if breaker is None:
+            breaker = CircuitBreaker(self.breaker_failures,
+                                     self.breaker_reset_secs)
+            self.breakers[host] = breaker
+        return breaker
+
+    def _make_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_maxsize,
+                              pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+import unittest
+import os
+import json
+import time
+import asyncio
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from sam_sp.metrics import RequestMetrics
+from sam_sp.transport import Transport
+from sam_sp.samclient import SAMClient
+from sam_sp.asyncclients import AsyncSAMClient, AsyncPeopleClient, SyncAdapter
+
+SLOW_SECS = 0.3
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # A stand-in for the SAM and PeopleDB APIs:
+    #   GET  .../slow/<n>  -> {"n": <n>} after SLOW_SECS
+    #   GET  .../flaky     -> 503 twice, then {"flaky": "ok"}
+    #   GET  .../missing   -> 404
+    #   GET  other         -> {"path": <path>}
+    #   PUT/POST           -> the request body
+    flaky_count = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path
+        if '/slow/' in path:
+            time.sleep(SLOW_SECS)
+            self._send(200, {'n': int(path.split('/')[-1])})
+        elif path.endswith('/flaky'):
+            StandInHandler.flaky_count += 1
+            if StandInHandler.flaky_count % 3 != 0:
+                self._send(503, None)
+            else:
+                self._send(200, {'flaky': 'ok'})
+        elif path.endswith('/missing'):
+            self._send(404, None)
+        else:
+            self._send(200, {'path': path})
+
+    def do_PUT(self):
+        length = int(self.headers.get('Content-Length',0))
+        self._send(200, json.loads(self.rfile.read(length)))
+
+    do_POST = do_PUT
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class Test_AsyncClients(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempdir = tempfile.TemporaryDirectory()
+        os.environ['PEOPLECLIENT_TEMPDIR'] = cls.tempdir.name
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever,
+                                             daemon=True)
+        cls.server_thread.start()
+        cls.base_url = 'http://127.0.0.1:' + str(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.tempdir.cleanup()
+
+    def setUp(self):
+        self.metrics = RequestMetrics()
+        self.transport = Transport(retry_backoff=0.01, metrics=self.metrics)
+        self.sam_client = SAMClient(self.base_url + '/sam', 'u', 'p', 10,
+                                    None, None, self.transport)
+
+    def test_sam_get_put_post(self):
+        client = AsyncSAMClient(client=self.sam_client)
+        async def calls():
+            return await asyncio.gather(client.get('tasks'),
+                                        client.put('tasks/1', '{"a": 1}'),
+                                        client.post('tasks', '{"b": 2}'))
+        results = asyncio.run(calls())
+        self.assertEqual(results, [{'path': '/sam/tasks'}, {'a': 1},
+                                   {'b': 2}])
+
+    def test_concurrent_gets(self):
+        client = AsyncSAMClient(client=self.sam_client)
+        async def calls():
+            return await asyncio.gather(*[client.get('slow/'+str(n)) \
+                                          for n in range(0,5)])
+        start = time.time()
+        results = asyncio.run(calls())
+        elapsed = time.time() - start
+        self.assertEqual(results, [{'n': n} for n in range(0,5)])
+        self.assertLess(elapsed, 3 * SLOW_SECS)
+
+    def test_people_get_put(self):
+        client = AsyncPeopleClient(self.base_url + '/api', 'u', 'p',
+                                   transport=self.transport)
+        async def calls():
+            return await asyncio.gather(client._get('orgs/NCAR'),
+                                        client._get('missing'),
+                                        client._put('orgs/NCAR', '[1]'))
+        results = asyncio.run(calls())
+        self.assertEqual(results, [{'path': '/api/orgs/NCAR'}, None, [1]])
+
+    def test_sync_adapter(self):
+        adapter = SyncAdapter(AsyncSAMClient(client=self.sam_client))
+        try:
+            self.assertEqual(adapter.get('tasks'), self.sam_client.get('tasks'))
+            self.assertEqual(adapter.url, self.sam_client.url)
+            self.assertEqual(adapter.call('get', 'tasks'),
+                             {'path': '/sam/tasks'})
+            client = adapter.async_client
+            results = adapter.gather(client.get('slow/1'),
+                                     client.get('slow/2'))
+            self.assertEqual(results, [{'n': 1}, {'n': 2}])
+        finally:
+            adapter.close()
+
+    def test_retry_temporary_errors(self):
+        client = AsyncSAMClient(client=self.sam_client)
+        StandInHandler.flaky_count = 0
+        self.assertEqual(asyncio.run(client.get('flaky')), {'flaky': 'ok'})
+        retries = [ep['retries'] for ep in self.metrics.to_dict()['endpoints'] \
+                   if ep['endpoint'] == 'flaky']
+        self.assertEqual(retries, [2])
+
+if __name__ == '__main__':
+    unittest.main()
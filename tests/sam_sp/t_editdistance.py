@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+import unittest
+import random
+from sam_sp.editdistance import (EditDistanceIndex, levenshtein,
+                                 bounded_levenshtein)
+
+WORDS = [ 'UNIVERSITY', 'OF', 'COLORADO', 'BOULDER', 'STATE', 'INSTITUTE',
+          'TEXAS', 'AUSTIN', 'THE', 'AT', 'LI', 'WU', 'CENTER' ]
+
+QUERIES = [ 'UNIVERSITY OF COLORADO', 'UNIVERSTY OF COLORDO', 'COLORADO',
+            'TEXAS', 'TX', 'LI', 'WU CENTER', 'STATE UNIVERSITY', '', 'X' ]
+
+class Test_Levenshtein(unittest.TestCase):
+
+    def test_levenshtein(self):
+        self.assertEqual(levenshtein('KITTEN', 'SITTING'), 3)
+        self.assertEqual(levenshtein('', 'ABC'), 3)
+        self.assertEqual(levenshtein('ABC', 'ABC'), 0)
+
+    def test_bounded_levenshtein(self):
+        self.assertEqual(bounded_levenshtein('KITTEN', 'SITTEN', 2), 1)
+        self.assertIsNone(bounded_levenshtein('KITTEN', 'SITTING', 2))
+        self.assertIsNone(bounded_levenshtein('A', 'ABCD', 2))
+
+class Test_EditDistanceIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(12345)
+        self.instrs = []
+        for i in range(0,500):
+            nwords = rng.randint(1,3)
+            name = ' '.join(rng.choice(WORDS) for j in range(0,nwords))
+            self.instrs.append(name + ':BOULDER:1 MAIN ST')
+        self.index = EditDistanceIndex(0)
+        for i, instr in enumerate(self.instrs):
+            self.index.add(i, instr)
+
+    def test_search_matches_full_scan(self):
+        for query in QUERIES:
+            for maxdist in range(0,3):
+                expected = dict()
+                for i, instr in enumerate(self.instrs):
+                    d = levenshtein(query, instr.split(':')[0])
+                    if d <= maxdist:
+                        expected[i] = d
+                self.assertEqual(self.index.search(query, maxdist), expected,
+                                 msg="query='" + query + "' maxdist=" + \
+                                 str(maxdist))
+
+    def test_distances(self):
+        index = EditDistanceIndex(0)
+        index.add(1, 'COLORADO:BOULDER:')
+        index.add(2, 'COLORADO:DENVER:')
+        index.add(3, 'COLORDO:BOULDER:')
+        index.add(4, 'COLRDO:BOULDER:')
+        self.assertEqual(index.search('COLORADO', 0), {1: 0, 2: 0})
+        self.assertEqual(index.search('COLORADO', 1), {1: 0, 2: 0, 3: 1})
+        self.assertEqual(index.search('COLORADO', 2),
+                         {1: 0, 2: 0, 3: 1, 4: 2})
+
+    def test_remove(self):
+        index = EditDistanceIndex(0)
+        index.add(1, 'COLORADO:BOULDER:')
+        index.add(2, 'COLORADO:DENVER:')
+        index.remove(1, 'COLORADO:BOULDER:')
+        self.assertEqual(index.search('COLORADO', 1), {2: 0})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import unittest
+import re
+import random
+from sam_sp.peopledata import PeopleExternalOrg, make_regex
+from sam_sp.fuzzyindex import FuzzyIndex
+
+WORDS = [ 'UNIVERSITY', 'OF', 'COLORADO', 'BOULDER', 'STATE', 'INSTITUTE',
+          'TECHNOLOGY', 'COLLEGE', 'NORTH', 'CAROLINA', 'TEXAS', 'AUSTIN',
+          'MASSACHUSETTS', 'THE', 'AT', 'LI', 'WU', 'CENTER', 'RESEARCH' ]
+
+CITIES = [ 'BOULDER', 'AUSTIN', 'CAMBRIDGE', 'RALEIGH', '' ]
+
+QUERIES = [ 'UNIVERSITY OF COLORADO', 'UNIVERSTY OF COLORDO', 'COLORADO',
+            'MASACHUSETS INSTITUTE', 'TEXAS', 'TX', 'LI', 'WU CENTER',
+            'STATE UNIVERSITY', 'RESEARCH CENTRE', 'NRTH CAROLNA', '', 'X' ]
+
+def make_org(org_id, rng):
+    nwords = rng.randint(1,4)
+    name = ' '.join(rng.choice(WORDS) for i in range(0,nwords))
+    rec = {
+        'id': org_id,
+        'shortName': name[0:8],
+        'name': name,
+        'city': rng.choice(CITIES),
+        'address': str(rng.randint(1,999)) + ' MAIN ST',
+    }
+    return PeopleExternalOrg(rec)
+
+def find(pattern, fuzzies, keys):
+    return [ i for i in keys if pattern.match(fuzzies[i]['instr']) ]
+
+class Test_FuzzyIndex(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(12345)
+        self.fuzzies = []
+        for org_id in range(1,400):
+            self.fuzzies.extend(make_org(org_id, rng).make_fuzzies())
+        self.index = FuzzyIndex(0)
+        for i, fuzzy in enumerate(self.fuzzies):
+            self.index.add(i, fuzzy['instr'])
+
+    def test_candidates_match_full_scan(self):
+        all_keys = range(0,len(self.fuzzies))
+        for query in QUERIES:
+            for fuzziness in range(0,3):
+                rawpat = '^' + make_regex(query,fuzziness) + '[^:]*:'
+                pattern = re.compile(rawpat)
+                expected = find(pattern, self.fuzzies, all_keys)
+                candidates = self.index.candidates(query, fuzziness)
+                if candidates is None:
+                    candidates = all_keys
+                else:
+                    self.assertLessEqual(len(candidates), len(self.fuzzies))
+                actual = find(pattern, self.fuzzies, sorted(candidates))
+                self.assertEqual(expected, actual,
+                                 msg="query='" + query + "' fuzziness=" + \
+                                 str(fuzziness))
+
+    def test_short_query_is_unfiltered(self):
+        self.assertIsNone(self.index.candidates('LI', 2))
+        self.assertIsNone(self.index.candidates('', 0))
+
+    def test_remove(self):
+        instr = self.fuzzies[0]['instr']
+        self.assertIn(0, self.index.candidates(instr.split(':')[0], 0))
+        self.index.remove(0, instr)
+        candidates = self.index.candidates(instr.split(':')[0], 0)
+        self.assertNotIn(0, candidates if candidates else set())
+
+if __name__ == '__main__':
+    unittest.main()
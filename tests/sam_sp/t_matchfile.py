@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+import unittest
+import os
+import re
+import sys
+import subprocess
+import tempfile
+from sam_sp.peopledata import Fuzzy
+from sam_sp.fuzzyindex import FuzzyIndex
+from sam_sp.matchfile import (MatchFile, MatchTable, MatchIndex,
+                              write_matchfile, read_text_matchfile,
+                              append_journal, apply_journal)
+
+CONVERT_MATCHFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 '..', '..', 'bin', 'convert-matchfile')
+
+ENTRIES = [
+    ('UNIVERSITY OF SOMEWHERE:BOULDER:1 MAIN ST', 1, 0),
+    ('UNIVERSITY OF SOMEWHERE BOULDER:BOULDER:1 MAIN ST', 1, 5),
+    ('INSTITUTE OF ELSEWHERE:BOULDER:2 MAIN ST', 2, 0),
+    ('COLLÈGE DE NULLE PART:BOULDER:3 MAIN ST', 3, 1),
+    ]
+
+class MatchFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.binfile = os.path.join(self.tempdir.name, 'match.bin')
+        write_matchfile(self.binfile, ENTRIES)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+class Test_MatchFile(MatchFileTestCase):
+
+    def test_round_trip(self):
+        textfile = os.path.join(self.tempdir.name, 'match')
+        with open(textfile, 'w') as file:
+            for instr, idval, weight in ENTRIES:
+                file.write(str(Fuzzy(idval,weight,instr)) + "\n")
+        self.assertEqual(list(read_text_matchfile(textfile)), ENTRIES)
+
+        result = subprocess.run([sys.executable, CONVERT_MATCHFILE, textfile],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, textfile + '.bin: 4 entries\n')
+        matchfile = MatchFile(textfile + '.bin')
+        self.assertEqual([(matchfile.instr(i), matchfile.idval(i),
+                           matchfile.weight(i)) for i in range(0,4)], ENTRIES)
+        self.assertEqual(matchfile[3]['instr'], ENTRIES[3][0])
+
+    def test_bad_file(self):
+        with open(self.binfile, 'wb') as file:
+            file.write(b'SAMFUZZ\0' + bytes(16))
+        self.assertRaises(RuntimeError, MatchFile, self.binfile)
+
+    def test_index(self):
+        # The stored index gives the same candidates as a FuzzyIndex
+        table = MatchTable(MatchFile(self.binfile))
+        index = FuzzyIndex(0)
+        for i, entry in enumerate(ENTRIES):
+            index.add(i, entry[0])
+        mapped_index = MatchIndex(table)
+        for instr in ('UNIVERSITY OF SOMEWHERE', 'INSTITUT OF ELSEWHERE',
+                      'COLLEGE DE NULLE PART', 'NOWHERE', 'AB'):
+            for fuzziness in range(0,3):
+                self.assertEqual(mapped_index.candidates(instr, fuzziness),
+                                 index.candidates(instr, fuzziness))
+
+        # Added entries are indexed in memory
+        for i in table.add([('INSTITUTE OF ANYWHERE:DENVER:', 4, 0)]):
+            mapped_index.add(i, table.instr(i))
+        self.assertEqual(mapped_index.candidates('INSTITUTE OF', 0), {2, 4})
+
+class Test_MatchTable(MatchFileTestCase):
+
+    def test_add_remove(self):
+        table = MatchTable(MatchFile(self.binfile))
+        self.assertEqual(list(table.entries()), ENTRIES)
+        self.assertEqual(table.remove(1), [0, 1])
+        self.assertEqual(table.add([('UNIVERSITY OF ANYWHERE:DENVER:', 1, 0)]),
+                         [4])
+        # Positions are stable; removed entries are not matched
+        self.assertEqual(len(table), 5)
+        self.assertEqual(table.instr(0), ENTRIES[0][0])
+        self.assertEqual(list(table.live_positions()), [2, 3, 4])
+        self.assertEqual(table.get_entries(1),
+                         [('UNIVERSITY OF ANYWHERE:DENVER:', 1, 0)])
+        pattern = re.compile('UNIVERSITY OF')
+        self.assertEqual([i for i in range(0,len(table)) \
+                          if table.match(pattern, i)], [4])
+        self.assertEqual(table.remove(99), [])
+
+    def test_journal(self):
+        journal = os.path.join(self.tempdir.name, 'match.journal')
+        append_journal(journal, [1], [('UNIVERSITY OF ANYWHERE:DENVER:', 1, 0)])
+        append_journal(journal, [2], [])
+        table = MatchTable(MatchFile(self.binfile))
+        self.assertEqual(apply_journal(journal, table), 3)
+        self.assertEqual(list(table.entries()),
+                         [ENTRIES[3], ('UNIVERSITY OF ANYWHERE:DENVER:', 1, 0)])
+
+        # The merged entries can be written and read back
+        write_matchfile(self.binfile, table.entries())
+        table = MatchTable(MatchFile(self.binfile))
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.get_entries(1),
+                         [('UNIVERSITY OF ANYWHERE:DENVER:', 1, 0)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+import unittest
+import os
+import json
+import time
+import tempfile
+from sam_sp.metrics import RequestMetrics, url_template
+
+class Test_Metrics(unittest.TestCase):
+
+    def test_url_template(self):
+        for path, template in [
+                ('aois', 'aois'),
+                ('fosaoi/12', 'fosaoi/*'),
+                ('person/jdoe?idtype=accessglobalid', 'person/*?idtype'),
+                ('tasks/AMIE?maxWaitSecs=30&active=true',
+                 'tasks/AMIE?active&maxWaitSecs'),
+                ('tasks/AMIE/123/456/create_account/state',
+                 'tasks/AMIE/*/*/*/state'),
+                ('task/AMIE/789/create_project',
+                 'task/AMIE/*/create_project'),
+                ('protected/admin/externalOrgs/42',
+                 'protected/admin/externalOrgs/*'),
+                ('staffPersons?name=%&start=0&size=10',
+                 'staffPersons?name&size&start')]:
+            self.assertEqual(url_template(path), template)
+
+    def test_record(self):
+        metrics = RequestMetrics()
+        metrics.record('sam', 'GET', 'aois', 0.02, 200, 0, 100)
+        metrics.record('sam', 'GET', 'aois', 3.0, 503, 0, 0)
+        metrics.record_retry('sam', 'GET', 'aois')
+        metrics.record('sam', 'PUT', 'tasks/AMIE/*/*/*', 0.2, 'error', 50)
+
+        endpoints = metrics.to_dict()['endpoints']
+        self.assertEqual([(ep['method'], ep['endpoint']) for ep in endpoints],
+                         [('GET', 'aois'), ('PUT', 'tasks/AMIE/*/*/*')])
+        aois = endpoints[0]
+        self.assertEqual(aois['count'], 2)
+        self.assertEqual(aois['statuses'], {'200': 1, '503': 1})
+        self.assertEqual(aois['retries'], 1)
+        self.assertEqual(aois['bytes_in'], 100)
+        self.assertEqual(dict((str(le), n) for le, n in aois['buckets'])
+                         ['0.025'], 1)
+        self.assertEqual(aois['buckets'][-1], ['+Inf', 2])
+
+        text = metrics.to_prometheus()
+        self.assertIn('sam_sp_http_request_duration_seconds_bucket{host="sam",'+
+                      'method="GET",endpoint="aois",le="+Inf"} 2', text)
+        self.assertIn('sam_sp_http_requests_total{host="sam",method="PUT",' +
+                      'endpoint="tasks/AMIE/*/*/*",status="error"} 1', text)
+        self.assertIn('sam_sp_http_request_bytes_total{host="sam",' +
+                      'method="PUT",endpoint="tasks/AMIE/*/*/*"} 50', text)
+
+        with tempfile.TemporaryDirectory() as dirname:
+            filename = metrics.write(dirname, 'json')
+            with open(filename) as file:
+                self.assertEqual(json.load(file)['endpoints'][1]['statuses'],
+                                 {'error': 1})
+
+    def test_status_and_error(self):
+        # An int status and 'error' on one endpoint must not break sorting
+        metrics = RequestMetrics()
+        metrics.record('sam', 'GET', 'aois', 0.1, 200)
+        metrics.record('sam', 'GET', 'aois', 0.1, 'error')
+        metrics.record('sam', 'GET', 'aois', 0.1, 503)
+        self.assertEqual(metrics.to_dict()['endpoints'][0]['statuses'],
+                         {'200': 1, '503': 1, 'error': 1})
+        text = metrics.to_prometheus()
+        self.assertIn('endpoint="aois",status="200"} 1', text)
+        self.assertIn('endpoint="aois",status="error"} 1', text)
+
+    def test_stats(self):
+        metrics = RequestMetrics()
+        stats = {'hits': 3, 'misses': 1}
+        metrics.add_stats('response_cache', lambda: stats)
+        metrics.add_stats('none', lambda: None)
+        result = metrics.to_dict()
+        self.assertEqual(result['response_cache'], {'hits': 3, 'misses': 1})
+        self.assertNotIn('none', result)
+        # The numbers are read each time the metrics are written
+        stats['hits'] = 4
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE sam_sp_response_cache_hits gauge\n' + \
+                      'sam_sp_response_cache_hits 4\n', text)
+        self.assertIn('sam_sp_response_cache_misses 1\n', text)
+        self.assertNotIn('sam_sp_none', text)
+
+    def test_export(self):
+        metrics = RequestMetrics()
+        metrics.record('sam', 'GET', 'aois', 0.1, 200)
+        metrics.record('sam', 'GET', 'aois', 0.1, 'error')
+        with tempfile.TemporaryDirectory() as dirname:
+            metrics.start_export(dirname, 0.05)
+            try:
+                time.sleep(0.3)
+                self.assertTrue(metrics.export_thread.is_alive())
+                with open(os.path.join(dirname,
+                                       'sam-sp-http-metrics.prom')) as file:
+                    self.assertIn('status="error"', file.read())
+            finally:
+                metrics.stop_export()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,644 @@
+#!/usr/bin/env python
+import unittest
+import os
+import json
+import time
+import re
+import random
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import sam_sp.peopleclient as peopleclient
+from unittest import mock
+from sam_sp.peopleclient import PeopleClient, PeopleCache
+from sam_sp.peopledata import PeoplePerson
+from sam_sp.fuzzyindex import FuzzyIndex
+from sam_sp.matchfile import MatchFile, MatchTable, MatchIndex, write_matchfile
+
+def make_org(org_id, name, city='Boulder', address='1 Main St',
+             nsf_org_code=None):
+    org = {'id': org_id, 'shortName': name[0:8], 'name': name,
+           'city': city, 'address': address}
+    if nsf_org_code is not None:
+        org['nsfOrgCode'] = nsf_org_code
+    return org
+
+class StandInPeopleClient(PeopleClient):
+    # Serves external orgs from self.orgs instead of PeopleDB, and records
+    # the paths requested
+    def __init__(self, orgs, **kwargs):
+        PeopleClient.__init__(self, **kwargs)
+        self.orgs = orgs
+        self.paths = []
+
+    def _get(self, path):
+        self.paths.append(path)
+        if path.startswith('protected/admin/externalOrgs?'):
+            return list(self.orgs.values())
+        return None
+
+class PeopleClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.saved_tempdir = os.environ.get('PEOPLECLIENT_TEMPDIR',None)
+        os.environ['PEOPLECLIENT_TEMPDIR'] = self.tempdir.name
+        peopleclient.EXTERNAL_ORGS = dict()
+        peopleclient.EXTERNAL_ORGS_BY_NSF_CODE = dict()
+        peopleclient.EXTERNAL_ORG_FUZZIES = []
+        peopleclient.PERSON_FUZZIES = dict()
+        peopleclient.PERSON_INDEX = FuzzyIndex(1)
+
+    def tearDown(self):
+        if self.saved_tempdir is None:
+            del os.environ['PEOPLECLIENT_TEMPDIR']
+        else:
+            os.environ['PEOPLECLIENT_TEMPDIR'] = self.saved_tempdir
+        self.tempdir.cleanup()
+
+class Test_CachedExternalOrgs(PeopleClientTestCase):
+
+    def test_missing_orgs(self):
+        orgs = {1: make_org(1, 'University of Somewhere'),
+                2: make_org(2, 'Institute of Elsewhere')}
+        client = StandInPeopleClient(orgs)
+        client.load_external_orgs()
+        self.assertEqual(client.paths, ['protected/admin/externalOrgs?name=%%'])
+
+        # A missing org is merged from the orgs changed since the download
+        orgs[3] = make_org(3, 'College of Nowhere')
+        client.paths = []
+        found = client._get_cached_external_orgs([1, 3])
+        self.assertEqual(sorted(found), [1, 3])
+        self.assertEqual(len(client.paths), 1)
+        self.assertIn('lastRun=', client.paths[0])
+
+        # An org that is still missing does not cause another request
+        client.paths = []
+        self.assertEqual(client._get_cached_external_orgs([99]), {})
+        self.assertEqual(client._get_cached_external_orgs([99]), {})
+        self.assertEqual(len(client.paths), 1)
+        self.assertIn('lastRun=', client.paths[0])
+
+class Test_NSFCodes(PeopleClientTestCase):
+
+    def test_lookup(self):
+        orgs = {1: make_org(1, 'University of Somewhere', nsf_org_code='001'),
+                2: make_org(2, 'Institute of Elsewhere', nsf_org_code='002'),
+                3: make_org(3, 'College of Nowhere')}
+        client = StandInPeopleClient(orgs)
+        self.assertEqual(client.get_cached_org_by_nsf_code('002')['org_id'],
+                         2)
+        self.assertIsNone(client.get_cached_org_by_nsf_code('003'))
+        self.assertIsNone(client.get_cached_org_by_nsf_code(None))
+        # The orgs are loaded once
+        self.assertEqual(len(client.paths), 1)
+
+        # The index follows codes that are set, changed or added by an
+        # incremental refresh
+        orgs[1] = make_org(1, 'University of Somewhere', nsf_org_code='009')
+        orgs[3] = make_org(3, 'College of Nowhere', nsf_org_code='003')
+        orgs[4] = make_org(4, 'School of Anywhere', nsf_org_code='004')
+        client._refresh_external_orgs(force=True)
+        self.assertIn('lastRun=', client.paths[-1])
+        self.assertIsNone(client.get_cached_org_by_nsf_code('001'))
+        for code, org_id in (('009', 1), ('002', 2), ('003', 3), ('004', 4)):
+            self.assertEqual(
+                client.get_cached_org_by_nsf_code(code)['org_id'], org_id)
+
+        # The index is rebuilt when the orgs are loaded from the cache
+        peopleclient.EXTERNAL_ORGS = dict()
+        peopleclient.EXTERNAL_ORGS_BY_NSF_CODE = dict()
+        self.assertEqual(client.get_cached_org_by_nsf_code('003')['org_id'],
+                         3)
+
+class Test_OrgRefresh(PeopleClientTestCase):
+
+    def setUp(self):
+        PeopleClientTestCase.setUp(self)
+        self.now = 100000.0
+        patcher = mock.patch('sam_sp.peopleclient.time.time',
+                             lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def match_ids(self, client, name):
+        matches = client.fuzzymatch_org(name=name, city='Boulder',
+                                        address='1 Main St')
+        return [org[0] for org in matches[1:]]
+
+    def test_refresh(self):
+        orgs = {1: make_org(1, 'University of Somewhere'),
+                2: make_org(2, 'Institute of Elsewhere')}
+        client = StandInPeopleClient(orgs, org_refresh_interval=3600)
+        client.load_external_orgs()
+        self.assertEqual(client.cache.get_watermark('external_org'), 100000)
+        self.assertEqual(self.match_ids(client, 'Institute of Elsewhere'), [2])
+        unchanged_org = peopleclient.EXTERNAL_ORGS[1]
+
+        # Changes are not requested until the refresh interval has passed
+        orgs[2] = make_org(2, 'Institute of Anywhere')
+        orgs[3] = make_org(3, 'College of Nowhere')
+        client.paths = []
+        self.now += 3599
+        client.refresh_external_orgs()
+        self.assertEqual(client.paths, [])
+
+        # Orgs changed since the watermark are merged, and the watermark
+        # advances to the time of the request
+        self.now += 1
+        client.refresh_external_orgs()
+        self.assertEqual(client.paths, [
+            'protected/admin/externalOrgs?name=%%&lastRun=100000'])
+        self.assertEqual(client.cache.get_watermark('external_org'), 103600)
+        self.assertEqual(sorted(peopleclient.EXTERNAL_ORGS), [1, 2, 3])
+        self.assertEqual(peopleclient.EXTERNAL_ORGS[2]['name'],
+                         'Institute of Anywhere')
+        self.assertIs(peopleclient.EXTERNAL_ORGS[1], unchanged_org)
+        cached = client.cache.get_external_orgs()
+        self.assertEqual([org['name'] for org in cached],
+                         ['University of Somewhere', 'Institute of Anywhere',
+                          'College of Nowhere'])
+        # Only the match data of the changed orgs is replaced
+        self.assertEqual(self.match_ids(client, 'Institute of Anywhere'), [2])
+        self.assertEqual(self.match_ids(client, 'Institute of Elsewhere'), [])
+        self.assertEqual(self.match_ids(client, 'College of Nowhere'), [3])
+        self.assertEqual(self.match_ids(client, 'University of Somewhere'),
+                         [1])
+
+        # The next refresh asks for changes since the new watermark
+        self.now += 3600
+        client.paths = []
+        client.refresh_external_orgs()
+        self.assertEqual(client.paths, [
+            'protected/admin/externalOrgs?name=%%&lastRun=103600'])
+
+    def test_no_refresh(self):
+        orgs = {1: make_org(1, 'University of Somewhere')}
+        client = StandInPeopleClient(orgs, org_refresh_interval=0)
+        client.load_external_orgs()
+        self.now += 100000
+        client.paths = []
+        client.refresh_external_orgs()
+        self.assertEqual(client.paths, [])
+
+class Test_DeletedOrgs(PeopleClientTestCase):
+
+    def match_ids(self, client, name):
+        matches = client.fuzzymatch_org(name=name, city='Boulder',
+                                        address='1 Main St')
+        return [org[0] for org in matches[1:]]
+
+    def test_deleted_org(self):
+        orgs = {1: make_org(1, 'University of Somewhere'),
+                2: make_org(2, 'Institute of Elsewhere')}
+        client = StandInPeopleClient(orgs)
+        self.assertEqual(self.match_ids(client, 'Institute of Elsewhere'), [2])
+
+        # A full download drops the fuzzies of orgs that have been deleted
+        del orgs[2]
+        client._download_external_orgs()
+        self.assertEqual(self.match_ids(client, 'Institute of Elsewhere'), [])
+        self.assertEqual(self.match_ids(client, 'University of Somewhere'),
+                         [1])
+
+        # The removal is replayed from the journal when the match file is
+        # loaded again
+        peopleclient.EXTERNAL_ORGS = dict()
+        peopleclient.EXTERNAL_ORG_FUZZIES = []
+        client = StandInPeopleClient(orgs)
+        self.assertEqual(self.match_ids(client, 'Institute of Elsewhere'), [])
+
+    def test_missing_org(self):
+        # An org in the match file that is missing after a refresh is
+        # dropped from the match file
+        orgs = {1: make_org(1, 'University of Somewhere'),
+                2: make_org(2, 'Institute of Elsewhere')}
+        client = StandInPeopleClient(orgs)
+        self.assertEqual(self.match_ids(client, 'Institute of Elsewhere'), [2])
+        del peopleclient.EXTERNAL_ORGS[2]
+        del orgs[2]
+        self.assertEqual(self.match_ids(client, 'Institute of Elsewhere'), [])
+        fuzzies = peopleclient.EXTERNAL_ORG_FUZZIES
+        self.assertEqual(fuzzies.get_entries(2), [])
+
+def make_person(upid, last_name, last_changed=1000):
+    return {'upid': upid, 'username': 'u' + str(upid), 'firstName': 'Pat',
+            'lastName': last_name, 'lastChanged': last_changed}
+
+class Test_PeopleCache(PeopleClientTestCase):
+
+    def test_format(self):
+        cache = PeopleCache()
+        cache.put_persons([make_person(1, 'Smith')], 5000)
+        cache.put_external_orgs([(1, make_org(1, 'University of Somewhere'))])
+        self.assertEqual(cache.get_watermark('cache_format'),
+                         peopleclient.CACHE_FORMAT)
+
+        # A cache of the current format is kept
+        cache = PeopleCache()
+        self.assertEqual(cache.get_person(1)['lastName'], 'Smith')
+        self.assertEqual(cache.person_last_run(), 5000)
+
+        # A cache of any other format is emptied, so it is downloaded again
+        new_format = peopleclient.CACHE_FORMAT + 1
+        with mock.patch('sam_sp.peopleclient.CACHE_FORMAT', new_format):
+            cache = PeopleCache()
+            self.assertIsNone(cache.get_person(1))
+            self.assertFalse(cache.have_ext_orgs())
+            self.assertEqual(cache.person_last_run(), 0)
+            self.assertEqual(cache.get_watermark('cache_format'), new_format)
+
+    def test_persons(self):
+        cache = PeopleCache()
+        self.assertFalse(cache.have_persons())
+        person = make_person(2, 'Smith')
+        person['fuzzies'] = ['SMITH']
+        cache.put_persons([person, make_person(1, 'Jones')])
+        self.assertTrue(cache.have_persons())
+        # Fuzzies are not saved
+        self.assertEqual(cache.get_person(2), make_person(2, 'Smith'))
+        self.assertIn('fuzzies', person)
+        self.assertIsNone(cache.get_person(3))
+        self.assertEqual(cache.get_person_last_changed(1), 1000)
+        self.assertIsNone(cache.get_person_last_changed(3))
+        # Without a qtime, the watermark is not changed
+        self.assertEqual(cache.person_last_run(), 0)
+
+        # A person is replaced by a newer version
+        cache.put_persons([make_person(1, 'Jones-Smith', 2000)], 3000)
+        self.assertEqual([p['lastName'] for p in cache.iter_persons()],
+                         ['Jones-Smith', 'Smith'])
+        self.assertEqual(cache.get_person_last_changed(1), 2000)
+        self.assertEqual(cache.person_last_run(), 3000)
+
+    def test_orgs(self):
+        cache = PeopleCache()
+        self.assertFalse(cache.have_ext_orgs())
+        cache.put_external_orgs([(2, make_org(2, 'Institute of Elsewhere')),
+                                 ('1', make_org(1, 'University of Nowhere'))])
+        cache.put_external_orgs([(1, make_org(1, 'University of Somewhere'))])
+        self.assertEqual([org['name'] for org in cache.get_external_orgs()],
+                         ['University of Somewhere', 'Institute of Elsewhere'])
+        cache.put_external_orgs([(3, make_org(3, 'College of Nowhere'))],
+                                replace=True)
+        self.assertEqual([org['id'] for org in cache.get_external_orgs()],
+                         [3])
+
+        self.assertFalse(cache.have_int_orgs())
+        cache.put_internal_orgs([{'acronym': 'NCAR', 'name': 'NCAR'},
+                                 {'acronym': 'HAO', 'name': 'HAO'}])
+        cache.put_internal_orgs([{'acronym': 'HAO', 'name': 'HAO Lab'}])
+        self.assertEqual([org['name'] for org in cache.get_internal_orgs()],
+                         ['HAO Lab', 'NCAR'])
+
+    def test_watermarks(self):
+        cache = PeopleCache()
+        self.assertEqual(cache.get_watermark('external_org'), 0)
+        cache.set_watermark('external_org', 1000.5)
+        cache.set_watermark('external_org', 2000)
+        cache.set_watermark('internal_org', 3000)
+        cache = PeopleCache()
+        self.assertEqual(cache.get_watermark('external_org'), 2000)
+        self.assertEqual(cache.get_watermark('internal_org'), 3000)
+
+    def write_legacy_files(self, valid_qtime=True):
+        tempdir = self.tempdir.name
+        with open(os.path.join(tempdir, 'internal-org'), 'w') as file:
+            json.dump({'NCAR': {'acronym': 'NCAR', 'name': 'NCAR'}}, file)
+        with open(os.path.join(tempdir, 'external-org'), 'w') as file:
+            json.dump({'1': make_org(1, 'University of Somewhere')}, file)
+        personfile = os.path.join(tempdir, 'person')
+        with open(personfile, 'w') as file:
+            # Later records of a person supersede earlier ones
+            for person in (make_person(1, 'Jones'), make_person(2, 'Smith'),
+                           make_person(1, 'Jones-Smith', 2000)):
+                person['fuzzies'] = ['X']
+                file.write(json.dumps(person) + '\n')
+        stat = os.stat(personfile)
+        size = stat.st_size if valid_qtime else stat.st_size + 1
+        with open(os.path.join(tempdir, 'person-updated'), 'w') as file:
+            file.write('5000\n' + str(size) + '\n' + \
+                       str(int(stat.st_mtime)) + '\n')
+
+    def test_legacy_files(self):
+        self.write_legacy_files()
+        cache = PeopleCache()
+        self.assertEqual(cache.get_internal_orgs(),
+                         [{'acronym': 'NCAR', 'name': 'NCAR'}])
+        self.assertEqual([org['id'] for org in cache.get_external_orgs()],
+                         [1])
+        self.assertEqual([p['lastName'] for p in cache.iter_persons()],
+                         ['Jones-Smith', 'Smith'])
+        self.assertNotIn('fuzzies', cache.get_person(1))
+        self.assertEqual(cache.person_last_run(), 5000)
+        # The files are removed once imported
+        self.assertEqual(sorted(os.listdir(self.tempdir.name)), ['people.db'])
+
+    def test_legacy_files_changed(self):
+        # The person watermark is not used if the person file was changed
+        # after it was written, so all persons are checked again
+        self.write_legacy_files(valid_qtime=False)
+        cache = PeopleCache()
+        self.assertEqual(len(list(cache.iter_persons())), 2)
+        self.assertEqual(cache.person_last_run(), 0)
+
+PERSON_NAMES = [ 'LI', 'WU', 'SMITH', 'SMYTHE', "O'BRIEN", 'OBRIEN',
+                 'VAN DER BERG', 'DE LA CRUZ', 'JOHNSON', 'JONSON', 'MARY',
+                 'ANN', 'JO' ]
+
+PERSON_QUERIES = [ ('MARY','SMITH'), ('','SMITH'), ('ANN','SMITH'),
+                   ('MARY','SMTH'), ('','LI'), ('JO',''), ('','OBRIEN'),
+                   ("", "O'BRIEN"), ('','VAN DER BERG'), ('JO','JOHNSON'),
+                   ('MARY','X'), ('','') ]
+
+class Test_PersonMatching(PeopleClientTestCase):
+
+    def make_person(self, rng, upid):
+        rec = {'upid': upid, 'type': 'internal', 'active': True,
+               'lastChanged': 1000}
+        for field in ('firstName', 'lastName', 'middleName',
+                      'preferredName'):
+            # Fields are missing, empty or one or two names
+            choice = rng.randint(0,5)
+            if choice == 1:
+                rec[field] = ''
+            elif choice > 1:
+                rec[field] = ' '.join(rng.choice(PERSON_NAMES) \
+                                      for i in range(0,rng.randint(1,2)))
+        person = PeoplePerson(rec)
+        person.add_fuzzies()
+        return person
+
+    def test_same_as_full_scan(self):
+        rng = random.Random(2468)
+        client = StandInPeopleClient(dict())
+        for upid in range(1,300):
+            client._merge_person(self.make_person(rng, upid))
+        # Replaced persons are dropped from the index
+        for upid in range(1,300,7):
+            client._merge_person(self.make_person(rng, upid))
+        persons = peopleclient.PERSON_FUZZIES
+        nempty = sum(1 for fuzzies in persons.values() \
+                     if fuzzies and fuzzies[0]['instr'].split(':')[1] == '')
+        self.assertGreater(nempty, 10)
+
+        nmatched = 0
+        for first, last in PERSON_QUERIES:
+            variants = [(first,last,'','',1), ('',last,'','',4)]
+            with mock.patch.object(peopleclient.PERSON_INDEX, 'candidates',
+                                   return_value=None):
+                expected = client._match_persons(variants)
+            self.assertEqual(client._match_persons(variants), expected,
+                             msg="first=" + first + " last=" + last)
+            if expected:
+                nmatched += 1
+        self.assertGreater(nmatched, 5)
+
+class StandInPersonPages(PeopleClient):
+    # Serves pages of self.persons[ptype] from the *Persons? paths after a
+    # random delay, so pages finish out of order; requests for the pages
+    # starting at self.fail_start raise an error
+    def __init__(self, persons, **kwargs):
+        PeopleClient.__init__(self, **kwargs)
+        self.persons = persons
+        self.fail_start = None
+        self.rng = random.Random(1357)
+        self.lock = threading.Lock()
+        self.starts = []
+
+    def _get(self, path):
+        ptype = path.split('Persons?')[0]
+        parms = dict(p.split('=') for p in path.split('?')[1].split('&'))
+        start = int(parms['start'])
+        with self.lock:
+            self.starts.append((ptype, start))
+            delay = self.rng.random() / 100
+        time.sleep(delay)
+        if start == self.fail_start:
+            raise RuntimeError('page ' + str(start))
+        return self.persons[ptype][start:start + int(parms['size'])]
+
+class RecordingExecutor(ThreadPoolExecutor):
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        ThreadPoolExecutor.__init__(self, *args, **kwargs)
+        self.shut_down = False
+        RecordingExecutor.instances.append(self)
+
+    def shutdown(self, *args, **kwargs):
+        self.shut_down = True
+        ThreadPoolExecutor.shutdown(self, *args, **kwargs)
+
+class Test_PersonPages(PeopleClientTestCase):
+
+    def setUp(self):
+        PeopleClientTestCase.setUp(self)
+        RecordingExecutor.instances = []
+        patcher = mock.patch('sam_sp.peopleclient.ThreadPoolExecutor',
+                             RecordingExecutor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.persons = {'internal': [{'upid': i} for i in range(0,7)],
+                        'external': [{'upid': i} for i in range(100,106)]}
+        self.client = StandInPersonPages(self.persons, page_size=3,
+                                         load_parallelism=4)
+
+    def pages(self):
+        return [(ptype, [rec['upid'] for rec in records]) for ptype, records \
+                in self.client._iter_person_pages(('internal','external'),
+                                                  '0')]
+
+    def test_order(self):
+        self.assertEqual(self.pages(),
+                         [('internal', [0, 1, 2]), ('internal', [3, 4, 5]),
+                          ('internal', [6]),
+                          ('external', [100, 101, 102]),
+                          ('external', [103, 104, 105])])
+        self.assertTrue(RecordingExecutor.instances[0].shut_down)
+        # Every page is requested at most once
+        self.assertEqual(len(self.client.starts), len(set(self.client.starts)))
+
+    def test_sequential(self):
+        # One page at a time, persons are read until an empty page, as they
+        # were before pages were fetched concurrently
+        self.client.load_parallelism = 1
+        self.assertEqual(len(self.pages()), 5)
+        self.assertEqual(self.client.starts,
+                         [('internal', 0), ('internal', 3), ('internal', 6),
+                          ('internal', 7), ('external', 0), ('external', 3),
+                          ('external', 6)])
+
+    def test_error(self):
+        self.client.fail_start = 3
+        pages = self.client._iter_person_pages(('internal','external'), '0')
+        self.assertEqual(next(pages)[1][0]['upid'], 0)
+        self.assertRaises(RuntimeError, next, pages)
+        self.assertTrue(RecordingExecutor.instances[0].shut_down)
+
+    def test_stop_early(self):
+        pages = self.client._iter_person_pages(('internal','external'), '0')
+        next(pages)
+        pages.close()
+        executor = RecordingExecutor.instances[0]
+        self.assertTrue(executor.shut_down)
+        # No pages are requested after the iteration stops
+        nstarts = len(self.client.starts)
+        time.sleep(0.05)
+        self.assertEqual(len(self.client.starts), nstarts)
+        self.assertLessEqual(nstarts, 1 + self.client.load_parallelism)
+
+ORG_WORDS = [ 'A.B.', 'A', 'B', 'UNIVERSITY', 'OF', 'COLORADO', 'STATE',
+              'INSTITUTE', 'TEXAS', 'A&M', 'ST.', 'LI', 'WU', 'CENTER',
+              'RESEARCH', 'THE' ]
+
+ORG_QUERIES = [ 'A.B.', 'A B', 'UNIVERSITY OF COLORADO', 'UNIVERSTY COLORDO',
+                'TEXAS A&M', 'ST. LI', 'THE CENTER', 'RESEARCH INSTITUTE',
+                'WU', 'X' ]
+
+class Test_OrgMatching(PeopleClientTestCase):
+
+    def find_per_variant(self, client, variants):
+        # The matching done before all variants were matched in one pass:
+        # one scan per (variant,fuzziness) pattern
+        fuzzies = list(peopleclient.EXTERNAL_ORG_FUZZIES)
+        matches = []
+        for name, city, address in variants:
+            for fuzziness in range(0,3):
+                pattern = re.compile('^' + client._make_org_regex(
+                    fuzziness,name,city,address))
+                for fuzzy in fuzzies:
+                    if pattern.match(fuzzy['instr']):
+                        matches.append(str(fuzziness) + str(fuzzy['weight']) +
+                                       ":" + str(fuzzy['idval']))
+        return client._sort_unique_weighted(matches)
+
+    def test_same_as_per_variant(self):
+        rng = random.Random(4321)
+        orgs = dict()
+        for org_id in range(1,200):
+            name = ' '.join(rng.choice(ORG_WORDS) \
+                            for i in range(0,rng.randint(1,4)))
+            orgs[org_id] = make_org(org_id, name,
+                                    rng.choice(['Boulder', 'Austin', '']))
+        client = StandInPeopleClient(orgs)
+        client._load_org_matchfile()
+        nmatched = 0
+        for query in ORG_QUERIES:
+            for city in ('', 'Boulder'):
+                variants = client._make_org_variants({'name': query,
+                                                      'city': city})
+                expected = self.find_per_variant(client, variants)
+                self.assertEqual(
+                    client._sort_unique_weighted(
+                        client._fuzzyfind_org(variants)),
+                    expected, msg="query='" + query + "' city=" + city)
+                if expected:
+                    nmatched += 1
+        self.assertGreater(nmatched, 5)
+
+    def test_weights_compared_as_strings(self):
+        # "015:1" sorts below "01:1", but only "01:1" passes the weight
+        # filter of _get_sorted_reasonably_weighted_matches()
+        binfile = os.path.join(self.tempdir.name, 'match.bin')
+        write_matchfile(binfile, [('A B:BOULDER:', 30, 10),
+                                  ('A B:BOULDER:', 1, 1),
+                                  ('A B:AUSTIN:', 1, 15)])
+        fuzzies = MatchTable(MatchFile(binfile))
+        peopleclient.EXTERNAL_ORG_FUZZIES = fuzzies
+        peopleclient.EXTERNAL_ORG_INDEX = MatchIndex(fuzzies)
+        client = StandInPeopleClient(dict())
+        variants = [('A B','','')]
+        self.assertEqual(self.find_per_variant(client, variants), ['30', '1'])
+        self.assertEqual(
+            client._sort_unique_weighted(client._fuzzyfind_org(variants)),
+            ['30', '1'])
+
+class Test_OrgLock(PeopleClientTestCase):
+
+    def test_match_waits_for_update(self):
+        orgs = {1: make_org(1, 'University of Somewhere')}
+        client = StandInPeopleClient(orgs)
+        client._load_org_matchfile()
+        # All clients share the lock of the org data they share
+        self.assertIs(StandInPeopleClient(orgs).org_update_lock,
+                      client.org_update_lock)
+
+        results = []
+        def match():
+            variants = client._make_org_variants(
+                {'name': 'University of Somewhere'})
+            results.append(client._match_orgs(variants))
+        with client.org_update_lock:
+            thread = threading.Thread(target=match)
+            thread.start()
+            thread.join(0.2)
+            # The match waits until the update is done
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(results, [])
+        thread.join(5)
+        self.assertEqual(results, [['1']])
+
+class Test_MatchEngines(PeopleClientTestCase):
+
+    def setUp(self):
+        PeopleClientTestCase.setUp(self)
+        self.orgs = {1: make_org(1, 'University of Somewhere'),
+                     2: make_org(2, 'Institute of Elsewhere')}
+
+    def match_ids(self, engine, name):
+        peopleclient.EXTERNAL_ORGS = dict()
+        peopleclient.EXTERNAL_ORG_FUZZIES = []
+        client = StandInPeopleClient(self.orgs, match_engine=engine,
+                                     logger=logging.getLogger('sp.people'))
+        matches = client.fuzzymatch_org(name=name, city='Boulder',
+                                        address='1 Main St')
+        return [org[0] for org in matches[1:]]
+
+    def test_engines(self):
+        self.assertEqual(self.match_ids('regex', 'Institue of Elsewhere'), [2])
+        self.assertEqual(self.match_ids('editdistance',
+                                        'Institue of Elsewhere'), [2])
+        # Two inserted characters are within an edit distance of 2, but do
+        # not match the regex
+        query = 'UniversityXY of Somewhere'
+        self.assertEqual(self.match_ids('regex', query), [])
+        self.assertEqual(self.match_ids('editdistance', query), [1])
+
+    def test_compare(self):
+        # "compare" returns the regex results and logs the differences
+        with self.assertLogs('sp.people', level='INFO') as logs:
+            self.assertEqual(self.match_ids('compare',
+                                            'Institue of Elsewhere'), [2])
+            self.assertEqual(self.match_ids('compare',
+                                            'UniversityXY of Somewhere'), [])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("editdistance only: ['1']", logs.output[0])
+
+    def test_unknown_engine(self):
+        self.assertRaises(RuntimeError, PeopleClient, match_engine='soundex')
+
+class Test_OrgMatchFile(PeopleClientTestCase):
+
+    def test_text_file_replaced(self):
+        orgs = {1: make_org(1, 'University of Somewhere'),
+                2: make_org(2, 'Institute of Elsewhere')}
+        client = StandInPeopleClient(orgs)
+        client.fuzzymatch_org(name='University of Somewhere')
+
+        # The binary match file is rebuilt from a newer text match file
+        textfile = client.cache.eorgmatchfile
+        binfile = client.cache.eorgmatchbinfile
+        with open(textfile, 'w') as file:
+            file.write('INSTITUTE OF ELSEWHERE:BOULDER:1 MAIN ST:2:0\n')
+        mtime = os.path.getmtime(textfile)
+        os.utime(binfile, (mtime - 10, mtime - 10))
+        peopleclient.EXTERNAL_ORG_FUZZIES = []
+        matches = client.fuzzymatch_org(name='University of Somewhere')
+        self.assertEqual(matches, [])
+        self.assertEqual(len(peopleclient.EXTERNAL_ORG_FUZZIES), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+import unittest
+import time
+import tempfile
+import sam_sp.responsecache as responsecache
+from sam_sp.responsecache import ResponseCache, parse_ttls
+
+class Test_ResponseCache(unittest.TestCase):
+
+    def test_parse_ttls(self):
+        self.assertEqual(parse_ttls('aois=60 fosaoi/*=30, contracts/*=0'),
+                         [('aois',60.0), ('fosaoi/*',30.0),
+                          ('contracts/*',0.0)])
+        self.assertRaises(ValueError, parse_ttls, 'aois')
+
+    def test_read_through(self):
+        cache = ResponseCache('aois=60 fosaoi/*=60', negative_ttl=0.2)
+        self.assertEqual(cache.get('aois'), (False, None))
+        cache.put('aois', [{'areaOfInterest': 'Other'}])
+        hit, data = cache.get('aois')
+        self.assertTrue(hit)
+        data.append('modified')
+        self.assertEqual(cache.get('aois'),
+                         (True, [{'areaOfInterest': 'Other'}]))
+
+        # Paths that match no pattern are neither cached nor counted
+        cache.put('person/x', {'username': 'x'})
+        self.assertEqual(cache.get('person/x'), (False, None))
+
+        cache.put('fosaoi/99', None)
+        self.assertEqual(cache.get('fosaoi/99'), (True, None))
+        time.sleep(0.3)
+        self.assertEqual(cache.get('fosaoi/99'), (False, None))
+
+        # The expired entry has been evicted
+        self.assertEqual(cache.get_stats(),
+                         {'hits': 2, 'negative_hits': 1, 'misses': 2,
+                          'entries': 1})
+
+    def test_empty_results(self):
+        cache = ResponseCache('contracts/*=60', negative_ttl=0.2)
+        cache.put('contracts/G1', [])
+        self.assertEqual(cache.get('contracts/G1'), (True, []))
+        time.sleep(0.3)
+        self.assertEqual(cache.get('contracts/G1'), (False, None))
+        self.assertEqual(cache.get_stats(),
+                         {'hits': 0, 'negative_hits': 1, 'misses': 1,
+                          'entries': 0})
+
+    def test_evict_expired(self):
+        saved_interval = responsecache.SWEEP_INTERVAL
+        responsecache.SWEEP_INTERVAL = 0
+        try:
+            cache = ResponseCache('contracts/*=60', negative_ttl=0.1)
+            for i in range(0,10):
+                cache.put('contracts/G' + str(i), None)
+            time.sleep(0.2)
+            cache.put('contracts/G10', [{'contractNumber': 'C1'}])
+            self.assertEqual(list(cache.responses), ['contracts/G10'])
+        finally:
+            responsecache.SWEEP_INTERVAL = saved_interval
+
+    def test_invalidate_matching(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache('aois=60 contracts/*=60',
+                                  cache_dir=cache_dir)
+            cache.put('aois', [{'areaOfInterest': 'Other'}])
+            cache.put('contracts/G1', [{'contractNumber': 'C1'}])
+            cache.invalidate_matching('contracts/*')
+            self.assertEqual(cache.get('contracts/G1'), (False, None))
+
+            cache = ResponseCache('aois=60 contracts/*=60',
+                                  cache_dir=cache_dir)
+            self.assertEqual(cache.get('contracts/G1'), (False, None))
+            self.assertEqual(cache.get('aois')[0], True)
+
+    def test_disk_store(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = ResponseCache('contracts/*=60', cache_dir=cache_dir)
+            cache.put('contracts/G1', [{'contractNumber': 'C1'}])
+            cache.put('contracts/G2', [])
+            cache.invalidate('contracts/G2')
+
+            cache = ResponseCache('contracts/*=60', cache_dir=cache_dir)
+            self.assertEqual(cache.get('contracts/G1'),
+                             (True, [{'contractNumber': 'C1'}]))
+            self.assertEqual(cache.get('contracts/G2'), (False, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+import unittest
+import json
+import time
+import threading
+from unittest import mock
+import sam_sp.samclient as samclient
+from sam_sp.samclient import SAMClient
+
+def make_code(code, description, active=True):
+    return {'code': code, 'description': description, 'active': active}
+
+class StandInResponse(object):
+    def __init__(self, status_code, data=None, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps(data) if data is not None else ''
+        self.headers = headers if headers is not None else dict()
+
+class StandInTransport(object):
+    # Serves self.codes from "mnemoniccode" with ETag self.etag, honouring
+    # If-None-Match, and records the headers of each request. If self.release
+    # is set, requests wait for it.
+    def __init__(self, codes, etag='"1"'):
+        self.codes = codes
+        self.etag = etag
+        self.requests = []
+        self.release = None
+
+    def get(self, url, headers=None, **kwargs):
+        headers = headers if headers is not None else dict()
+        self.requests.append(headers)
+        if self.release is not None:
+            self.release.wait(5)
+        if headers.get('If-None-Match',None) == self.etag:
+            return StandInResponse(304)
+        return StandInResponse(200, self.codes, {'ETag': self.etag})
+
+class SAMClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('sam_sp.samclient.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        samclient.MNEMONIC_CODES = dict()
+        samclient.MNEMONIC_CODES_UPDATED = 0
+        samclient.MNEMONIC_CODES_VALIDATORS = dict()
+        self.transport = StandInTransport([make_code('NCAR', 'NCAR')])
+        self.client = SAMClient('http://sam', 'u', 'p', 10, None, None,
+                                self.transport, reference_data_ttl=60)
+
+class Test_ReferenceDataRefresh(SAMClientTestCase):
+
+    def codes(self):
+        return sorted(samclient.MNEMONIC_CODES)
+
+    def test_ttl(self):
+        client = self.client
+        transport = self.transport
+        client.refresh_mnemonic_codes()
+        self.assertEqual(transport.requests, [{}])
+
+        # The codes are reused until they are older than the TTL
+        self.now += 59
+        client.refresh_mnemonic_codes()
+        self.assertEqual(len(transport.requests), 1)
+        self.now += 1
+        client.refresh_mnemonic_codes()
+        self.assertEqual(len(transport.requests), 2)
+
+    def test_not_modified(self):
+        client = self.client
+        transport = self.transport
+        client.refresh_mnemonic_codes()
+        codes = samclient.MNEMONIC_CODES
+
+        # A 304 result keeps the codes and restarts the TTL
+        transport.codes = []
+        self.now += 60
+        client.refresh_mnemonic_codes()
+        self.assertEqual(transport.requests[1], {'If-None-Match': '"1"'})
+        self.assertIs(samclient.MNEMONIC_CODES, codes)
+        self.now += 59
+        client.refresh_mnemonic_codes()
+        self.assertEqual(len(transport.requests), 2)
+
+        # Changed codes replace the codes and their ETag
+        transport.codes = [make_code('HAO', 'High Altitude Observatory')]
+        transport.etag = '"2"'
+        self.now += 1
+        client.refresh_mnemonic_codes()
+        self.assertEqual(self.codes(), ['HAO'])
+        self.assertEqual(samclient.MNEMONIC_CODES_VALIDATORS,
+                         {'ETag': '"2"'})
+
+    def test_invalidate(self):
+        # Invalidated codes are downloaded in full at once
+        client = self.client
+        client.refresh_mnemonic_codes()
+        client.invalidate_mnemonic_codes()
+        client.refresh_mnemonic_codes()
+        self.assertEqual(self.transport.requests, [{}, {}])
+
+    def test_single_flight(self):
+        # Threads that find the codes stale while another thread is loading
+        # them wait for it instead of loading them again
+        transport = self.transport
+        transport.release = threading.Event()
+        threads = [threading.Thread(target=self.client.refresh_mnemonic_codes)
+                   for i in range(0,4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        transport.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(transport.requests), 1)
+        self.assertEqual(self.codes(), ['NCAR'])
+
+class Test_MnemonicCodeDescriptions(SAMClientTestCase):
+
+    def setUp(self):
+        SAMClientTestCase.setUp(self)
+        self.transport.codes = [
+            make_code('UCB', 'University of Colorado, Boulder'),
+            make_code('CSU', "St. Mary's College -- Fort Collins"),
+            make_code('UCX', 'UNIVERSITY OF COLORADO, BOULDER'),
+            make_code('OLD', 'Old Lab', False)]
+
+    def find(self, desc):
+        mobj = self.client._get_mnemonic_code_by_description(desc)
+        return mobj['code'] if mobj is not None else None
+
+    def test_normalize(self):
+        normalize = self.client._normalize_description
+        self.assertEqual(normalize("St. Mary's College -- Fort Collins"),
+                         'st mary s college fort collins')
+        self.assertEqual(normalize('  University of\tColorado,Boulder '),
+                         'university of colorado boulder')
+        self.assertEqual(normalize('Ecole Polytechnique Fédérale'),
+                         'ecole polytechnique fédérale')
+        self.assertEqual(normalize(''), '')
+
+    def test_lookup(self):
+        # Descriptions match case-insensitively; if descriptions collide, the
+        # first code wins
+        self.assertEqual(self.find('University of Colorado, Boulder'), 'UCB')
+        self.assertEqual(self.find('university of colorado, boulder'), 'UCB')
+        # Otherwise they match with punctuation and spacing normalized
+        self.assertEqual(self.find('University of Colorado Boulder'), 'UCB')
+        self.assertEqual(self.find("St Mary's College, Fort  Collins"), 'CSU')
+        self.assertEqual(self.find('Old Lab'), 'OLD')
+        self.assertIsNone(self.find('University of Colorado'))
+        self.assertEqual(len(self.transport.requests), 1)
+
+    def test_rebuilt(self):
+        self.assertEqual(self.find('Old Lab'), 'OLD')
+        # The index is rebuilt when changed codes are loaded after the TTL,
+        # or at once after the codes are invalidated
+        self.transport.codes = [make_code('NEW', 'Old Lab'),
+                                make_code('HAO', 'High Altitude Observatory')]
+        self.transport.etag = '"2"'
+        self.now += 60
+        self.assertEqual(self.find('Old Lab'), 'NEW')
+        self.assertIsNone(self.find('University of Colorado, Boulder'))
+
+        self.transport.codes = [make_code('HAO', 'High Altitude Observatory')]
+        self.transport.etag = '"3"'
+        self.assertEqual(self.find('Old Lab'), 'NEW')
+        self.client.invalidate_mnemonic_codes()
+        self.assertIsNone(self.find('Old Lab'))
+        self.assertEqual(self.find('high altitude observatory!'), 'HAO')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+import unittest
+from sam_sp.samdata import InternalOrg, InternalOrgDirectory
+
+def make_org(org_id, acronym, parent_id=None):
+    return InternalOrg({'id': org_id, 'name': acronym + ' Lab',
+                        'acronym': acronym, 'active': True,
+                        'parentOrgId': parent_id})
+
+class Test_InternalOrgDirectory(unittest.TestCase):
+
+    def test_lookup(self):
+        orgs = InternalOrgDirectory([make_org(1, 'NCAR'),
+                                     make_org('2', 'CISL', 1),
+                                     make_org(3, 'CISL', 1)])
+        self.assertEqual(sorted(orgs), [1, 2, 3])
+        self.assertEqual(orgs[2]['acronym'], 'CISL')
+        # If acronyms collide, the first org wins
+        self.assertEqual(orgs.get_by_acronym('CISL')['org_id'], '2')
+        self.assertIsNone(orgs.get_by_acronym('HAO'))
+        self.assertEqual(len(InternalOrgDirectory()), 0)
+
+    def ids(self, orgs):
+        return [int(org['org_id']) for org in orgs]
+
+    def test_parents(self):
+        # 4 -> 3 -> 2 -> 1; 5's parent is not in the directory; 6 and 7 are
+        # each other's parent
+        orgs = InternalOrgDirectory([make_org(4, 'D', 3), make_org(1, 'A'),
+                                     make_org(3, 'C', '2'), make_org(2, 'B', 1),
+                                     make_org(5, 'E', 99), make_org(6, 'F', 7),
+                                     make_org(7, 'G', 6)])
+        self.assertEqual(self.ids(orgs.get_ancestors(4)), [3, 2, 1])
+        self.assertEqual(self.ids(orgs.get_ancestors(3)), [2, 1])
+        self.assertEqual(self.ids(orgs.get_ancestors(1)), [])
+        self.assertEqual(self.ids(orgs.get_ancestors(5)), [])
+        self.assertEqual(self.ids(orgs.get_ancestors(42)), [])
+        self.assertEqual(self.ids(orgs.get_children(2)), [3])
+        self.assertEqual(self.ids(orgs.get_children(4)), [])
+        # A cycle ends the chain before it gets back to the org
+        for org_id in (6, 7):
+            self.assertNotIn(org_id, self.ids(orgs.get_ancestors(org_id)))
+        self.assertEqual(self.ids(orgs.get_children(7)), [6])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+import unittest
+import time
+import threading
+from unittest import mock
+from sam_sp.task import SAMTask, SAMTaskCache, RevisitScheduler, TaskService
+
+def make_task(tid, state='delegated', timestamp=1000, name='create_account'):
+    return {
+        'amie_transaction_id': tid,
+        'amie_packet_id': '1',
+        'task_name': name,
+        'task_state': state,
+        'timestamp': timestamp,
+        }
+
+class Test_SAMTaskCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SAMTaskCache()
+        self.cache.update(make_task('1', 'delegated', 3000))
+        self.cache.update(make_task('2', 'syncing', 1000))
+        self.cache.update(make_task('3', 'delegated', 2000))
+        self.cache.update(make_task('4', 'syncing', 2000))
+
+    def keys(self, tasks):
+        return [st.key.split('/')[0] for st in tasks]
+
+    def test_by_state(self):
+        cache = self.cache
+        self.assertEqual(self.keys(cache.get_tasks_for_state('delegated')),
+                         ['3', '1'])
+        self.assertEqual(self.keys(cache.get_tasks_for_state('syncing')),
+                         ['2', '4'])
+        self.assertEqual(cache.get_tasks_for_state('successful'), [])
+
+        cache.update(make_task('1', 'syncing', 3000))
+        self.assertEqual(self.keys(cache.get_tasks_for_state('delegated')),
+                         ['3'])
+        self.assertEqual(self.keys(cache.get_tasks_for_state('syncing')),
+                         ['2', '4', '1'])
+
+    def test_tasks_since(self):
+        cache = self.cache
+        self.assertEqual(self.keys(cache.get_tasks_since(None)),
+                         ['2', '3', '4', '1'])
+        self.assertEqual(self.keys(cache.get_tasks_since(1000)),
+                         ['3', '4', '1'])
+        self.assertEqual(self.keys(cache.get_tasks_since(2000)), ['1'])
+        self.assertEqual(cache.get_tasks_since(3000), [])
+
+        # A new timestamp moves the task in the timestamp index
+        cache.update(make_task('2', 'syncing', 4000))
+        self.assertEqual(self.keys(cache.get_tasks_since(2000)), ['1', '2'])
+        self.assertEqual(cache.timestamps, [2000, 2000, 3000, 4000])
+
+    def test_cleared(self):
+        cache = self.cache
+        cache.update(make_task('3', 'cleared', 5000))
+        self.assertIsNone(cache.lookup(make_task('3')))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(self.keys(cache.get_tasks_for_state('delegated')),
+                         ['1'])
+        self.assertEqual(self.keys(cache.get_tasks_since(None)),
+                         ['2', '4', '1'])
+
+        # The last task in a state removes the state from the index
+        cache.update(make_task('1', 'cleared', 5000))
+        self.assertNotIn('delegated', cache.by_state)
+        self.assertEqual(len(cache.timestamps), len(cache))
+
+class Test_Timestamps(unittest.TestCase):
+    # SAM task timestamps are milliseconds since the epoch
+
+    def test_round_trip(self):
+        st = SAMTask(make_task('1', 'syncing', '1700000000123'))
+        self.assertEqual(st.timestamp, 1700000000123)
+        self.assertIn(SAMTask.timeutil.timestamp_to_isoformat(1700000000.123),
+                      str(st))
+
+    def test_same_second(self):
+        # Tasks changed within the same second are ordered and selected by
+        # their milliseconds
+        cache = SAMTaskCache()
+        cache.update(make_task('1', 'syncing', 1700000000456))
+        cache.update(make_task('2', 'syncing', 1700000000123))
+        cache.update(make_task('3', 'syncing', 1700000000999))
+        self.assertEqual([st.key[0] for st in cache.get_tasks_since(None)],
+                         ['2', '1', '3'])
+        self.assertEqual([st.key[0] for st in \
+                          cache.get_tasks_since(1700000000123)], ['1', '3'])
+        self.assertEqual([st.key[0] for st in \
+                          cache.get_tasks_since(1700000000998)], ['3'])
+
+    def test_local_timestamps(self):
+        # Timestamps set locally are in milliseconds, so they sort after
+        # timestamps from SAM
+        service = TaskService(None, StandInPeopleClient())
+        service.executor.shutdown()
+        before = int(time.time() * 1000)
+        with mock.patch('sam_sp.task.TaskStatus') as task_status:
+            service.create_failed_TaskStatus(
+                'create_account', {'amie_transaction_id': '2',
+                                   'amie_packet_id': '1'}, 'failed')
+            failed_task = task_status.call_args[0][0]
+            task_status.return_value.get_product_value.return_value = '7'
+            synced = []
+            service._change_SAM_task_state_to_syncing = synced.append
+            task = make_task('1', name='choose_or_add_institution')
+            task['data'] = {'parameters': {'OrgCode': '0012345'}}
+            service._choose_or_add_institution(task)
+        after = int(time.time() * 1000)
+        cache = service.task_cache
+        cache.update(make_task('0', 'syncing', before - 1))
+        for local_task in (failed_task, synced[0]):
+            self.assertGreaterEqual(local_task['timestamp'], before)
+            self.assertLessEqual(local_task['timestamp'], after)
+            cache.update(local_task)
+        self.assertEqual(sorted(st.key[0] for st in \
+                                cache.get_tasks_since(before - 1)),
+                         ['1', '2'])
+
+class Test_RevisitScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('sam_sp.task.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scheduler = RevisitScheduler(5, 20)
+        self.st = SAMTask(make_task('1', 'syncing', 1000))
+
+    def test_first_seen_is_due(self):
+        self.scheduler.observe(self.st)
+        self.assertEqual(self.scheduler.take_due(), [self.st.key])
+        self.assertEqual(self.scheduler.take_due(), [])
+
+    def test_backoff(self):
+        scheduler = self.scheduler
+        scheduler.observe(self.st)
+        start = self.now
+        due_times = []
+        while self.now < start + 100:
+            scheduler.observe(self.st)
+            if scheduler.take_due():
+                due_times.append(self.now - start)
+            self.now += 1
+        # The interval doubles from 5 to at most 20 seconds
+        self.assertEqual(due_times, [0, 5, 15, 35, 55, 75, 95])
+
+    def test_reset_on_new_timestamp(self):
+        scheduler = self.scheduler
+        scheduler.observe(self.st)
+        for i in range(0,3):
+            scheduler.take_due()
+            self.now += 20
+        self.now += 1
+        st = SAMTask(make_task('1', 'syncing', 2000))
+        scheduler.observe(st)
+        self.assertEqual(scheduler.take_due(), [st.key])
+        self.now += 5
+        self.assertEqual(scheduler.take_due(), [st.key])
+
+    def test_record_does_not_reset(self):
+        # A timestamp returned by a revisit does not make the task due again
+        scheduler = self.scheduler
+        scheduler.observe(self.st)
+        self.assertEqual(scheduler.take_due(), [self.st.key])
+        st = SAMTask(make_task('1', 'syncing', 2000))
+        scheduler.record(st)
+        scheduler.observe(st)
+        self.assertEqual(scheduler.take_due(), [])
+        self.now += 5
+        self.assertEqual(scheduler.take_due(), [st.key])
+
+    def test_forget(self):
+        scheduler = self.scheduler
+        scheduler.observe(self.st)
+        scheduler.forget(self.st.key)
+        self.assertEqual(scheduler.take_due(), [])
+
+class Test_RunTasks(unittest.TestCase):
+
+    def setUp(self):
+        self.service = TaskService(None, None, max_workers=4,
+                                   task_deadline=0.1)
+        self.calls = []
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.service.executor.shutdown(wait=True)
+
+    def sync(self, task):
+        # Stand-in for _delegate_task(); task 'slow' blocks until released,
+        # and task 'bad' fails
+        self.calls.append(task['amie_transaction_id'])
+        if task['amie_transaction_id'] == 'slow':
+            self.release.wait(5)
+        elif task['amie_transaction_id'] == 'bad':
+            raise ValueError('bad task')
+        return dict(task, task_state='syncing', timestamp=task['timestamp']+1)
+
+    def test_results_applied(self):
+        tasks = [make_task(str(i)) for i in range(0,6)]
+        self.service._run_tasks(self.sync, tasks)
+        cache = self.service.task_cache
+        self.assertEqual(len(cache.get_tasks_for_state('syncing')), 6)
+        self.assertEqual(self.service.in_flight, {})
+
+    def test_deadline(self):
+        service = self.service
+        slow = make_task('slow')
+        t0 = time.time()
+        service._run_tasks(self.sync, [slow, make_task('fast')])
+        self.assertLess(time.time() - t0, 1)
+        self.assertEqual(list(service.in_flight), ['slow/1/create_account'])
+        self.assertEqual(service.task_cache.lookup(slow), None)
+
+        # A task that is still running is not submitted again
+        service._run_tasks(self.sync, [slow])
+        self.assertEqual(sorted(self.calls), ['fast', 'slow'])
+
+        # Its result is applied by the next call after it is done
+        self.release.set()
+        service.in_flight['slow/1/create_account'][0].result(5)
+        service._run_tasks(self.sync, [])
+        self.assertEqual(service.in_flight, {})
+        self.assertEqual(service.task_cache.lookup(slow).state, 'syncing')
+
+    def test_late_result_superseded(self):
+        service = self.service
+        slow = make_task('slow')
+        service.task_cache.update(slow)
+        service._run_tasks(self.sync, [slow])
+        # SAM reports a newer version of the task while the call is running
+        service.task_cache.update(make_task('slow', 'successful', 5000))
+        self.release.set()
+        service.in_flight['slow/1/create_account'][0].result(5)
+        service._run_tasks(self.sync, [])
+        self.assertEqual(service.task_cache.lookup(slow).state, 'successful')
+
+    def test_error(self):
+        service = self.service
+        tasks = [make_task('bad'), make_task('good')]
+        self.assertRaises(ValueError, service._run_tasks, self.sync, tasks)
+        self.assertEqual(service.in_flight, {})
+        self.assertEqual(service.task_cache.lookup(tasks[1]).state, 'syncing')
+        self.assertEqual(service.task_cache.lookup(tasks[0]), None)
+
+    def test_late_error(self):
+        # An error from a task left running by an earlier call is logged,
+        # not raised
+        service = self.service
+        def fail_late(task):
+            self.release.wait(5)
+            raise ValueError('late')
+        service._run_tasks(fail_late, [make_task('late')])
+        self.assertEqual(len(service.in_flight), 1)
+        self.release.set()
+        service.in_flight['late/1/create_account'][0].exception(5)
+        with self.assertLogs('sp.sam', level='WARNING'):
+            service._run_tasks(self.sync, [])
+        self.assertEqual(service.in_flight, {})
+
+class StandInPeopleClient(object):
+    def set_nsf_code_for_external_org(self, org_id, nsf_org_code):
+        return {'id': org_id, 'nsfOrgCode': nsf_org_code}
+
+class Test_ChooseOrAddInstitution(unittest.TestCase):
+
+    def test_task_not_changed(self):
+        # The task dict is shared with the task cache, and the delegation
+        # runs in a worker thread, so it must not be changed in place
+        service = TaskService(None, StandInPeopleClient())
+        synced = []
+        service._change_SAM_task_state_to_syncing = synced.append
+        task = make_task('1', name='choose_or_add_institution')
+        task['data'] = {'parameters': {'OrgCode': '0012345'}}
+        with mock.patch('sam_sp.task.TaskStatus') as task_status:
+            task_status.return_value.get_product_value.return_value = '7'
+            service._delegate_task(task)
+        service.executor.shutdown()
+        self.assertEqual(task['timestamp'], 1000)
+        self.assertEqual(len(synced), 1)
+        self.assertIsNot(synced[0], task)
+        self.assertGreater(synced[0]['timestamp'], 1000)
+        self.assertEqual(synced[0]['data'], task['data'])
+
+class StandInSAMClient(object):
+    def __init__(self):
+        self.invalidated = []
+
+    def invalidate_mnemonic_codes(self):
+        self.invalidated.append('mnemoniccode')
+
+    def invalidate_contracts(self):
+        self.invalidated.append('contracts')
+
+class Test_ReferenceData(unittest.TestCase):
+
+    def test_invalidate(self):
+        sam_client = StandInSAMClient()
+        service = TaskService(sam_client, None)
+        cache = service.task_cache
+        for name in ('choose_or_add_contract', 'choose_or_add_mnemonic_code',
+                     'create_account'):
+            prev_st = cache.update(make_task('1', 'syncing', 1000, name))
+            st = cache.update(make_task('1', 'successful', 2000, name))
+            service._check_reference_data(prev_st, st)
+            # Only the first successful update invalidates
+            service._check_reference_data(st, st)
+        self.assertEqual(sam_client.invalidated,
+                         ['contracts', 'mnemoniccode'])
+        service.executor.shutdown()
+
+    def test_invalidate_on_revisit(self):
+        # A successful result returned by a revisit also invalidates
+        sam_client = StandInSAMClient()
+        service = TaskService(sam_client, None)
+        task = make_task('1', 'syncing', 1000, 'choose_or_add_mnemonic_code')
+        service.task_cache.update(task)
+        def revisit(task):
+            return dict(task, task_state='successful', timestamp=2000)
+        service._run_tasks(revisit, [task])
+        self.assertEqual(service.task_cache.lookup(task).state, 'successful')
+        self.assertEqual(sam_client.invalidated, ['mnemoniccode'])
+        service.executor.shutdown()
+
+if __name__ == '__main__':
+    unittest.main()
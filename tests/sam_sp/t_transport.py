@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+import unittest
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from spexception import ServiceProviderTemporaryError
+from sam_sp.metrics import RequestMetrics
+from sam_sp.transport import Transport
+from sam_sp.samclient import SAMClient
+
+SLOW_SECS = 0.5
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # A stand-in for the SAM API:
+    #   .../slow   -> {"slow": "ok"} after SLOW_SECS
+    #   .../flaky  -> 503 twice, then {"flaky": "ok"}
+    #   .../down   -> 503
+    #   other      -> {"path": <path>}
+    flaky_count = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path
+        if path.endswith('/slow'):
+            time.sleep(SLOW_SECS)
+            self._send(200, {'slow': 'ok'})
+        elif path.endswith('/flaky'):
+            StandInHandler.flaky_count += 1
+            if StandInHandler.flaky_count % 3 != 0:
+                self._send(503, None)
+            else:
+                self._send(200, {'flaky': 'ok'})
+        elif path.endswith('/down'):
+            self._send(503, None)
+        else:
+            self._send(200, {'path': path})
+
+    do_POST = do_GET
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode() if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class Test_Transport(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.server_thread = threading.Thread(target=cls.server.serve_forever,
+                                             daemon=True)
+        cls.server_thread.start()
+        cls.host = '127.0.0.1:' + str(cls.server.server_port)
+        cls.base_url = 'http://' + cls.host
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.metrics = RequestMetrics()
+        self.transport = Transport(retry_backoff=0.01, breaker_failures=0,
+                                   metrics=self.metrics)
+
+    def _get_endpoint(self, method, template):
+        for ep in self.metrics.to_dict()['endpoints']:
+            if ep['method'] == method and ep['endpoint'] == template:
+                return ep
+        return None
+
+    def test_retry_temporary_errors(self):
+        StandInHandler.flaky_count = 0
+        result = self.transport.get(self.base_url + '/sam/flaky',
+                                    template='flaky')
+        self.assertEqual(result.json(), {'flaky': 'ok'})
+        ep = self._get_endpoint('GET', 'flaky')
+        self.assertEqual(ep['retries'], 2)
+        self.assertEqual(ep['statuses'], {'200': 1, '503': 2})
+
+    def test_retries_exhausted(self):
+        self.assertRaises(ServiceProviderTemporaryError, self.transport.get,
+                          self.base_url + '/sam/down', template='down')
+        self.assertEqual(self._get_endpoint('GET', 'down')['count'], 3)
+
+    def test_post_not_retried(self):
+        result = self.transport.post(self.base_url + '/sam/down',
+                                     template='down')
+        self.assertEqual(result.status_code, 503)
+        self.assertEqual(self._get_endpoint('POST', 'down')['count'], 1)
+
+    def test_read_timeout_not_retried(self):
+        transport = Transport(read_timeout=SLOW_SECS/5, max_retries=2,
+                              retry_backoff=0.01, metrics=self.metrics)
+        start = time.time()
+        self.assertRaises(ServiceProviderTemporaryError, transport.get,
+                          self.base_url + '/sam/slow', template='slow')
+        self.assertLess(time.time() - start, SLOW_SECS)
+        ep = self._get_endpoint('GET', 'slow')
+        self.assertEqual(ep['count'], 1)
+        self.assertEqual(ep['retries'], 0)
+
+    def test_circuit_breaker(self):
+        transport = Transport(max_retries=0, breaker_failures=2,
+                              breaker_reset_secs=60)
+        for i in range(0,2):
+            self.assertRaises(ServiceProviderTemporaryError, transport.get,
+                              self.base_url + '/sam/down')
+        # Requests to the host now fail without being sent
+        self.assertRaises(ServiceProviderTemporaryError, transport.get,
+                          self.base_url + '/sam/other')
+
+    def test_sam_client_timeout(self):
+        # SAMClient's timeout overrides the transport's read timeout
+        transport = Transport(read_timeout=SLOW_SECS/5, max_retries=0)
+        sam_client = SAMClient(self.base_url + '/sam', 'u', 'p', 10, None,
+                               None, transport)
+        self.assertEqual(sam_client.get('slow'), {'slow': 'ok'})
+        sam_client = SAMClient(self.base_url + '/sam', 'u', 'p',
+                               SLOW_SECS/5, None, None, transport)
+        self.assertRaises(ServiceProviderTemporaryError, sam_client.get,
+                          'slow')
+
+if __name__ == '__main__':
+    unittest.main()